@@ -0,0 +1,129 @@
+"""Measures the throughput of SyncAsyncServer.emit when called from background threads, which is how
+sessions flush events to clients. Compares the event loop bridge against the previous behavior of
+running each emit in a new event loop. Receiving clients run in separate processes so that they do
+not compete with the server for the GIL.
+
+Run with: python benchmarks/emit_throughput.py [--events 5000] [--threads 4] [--clients 4]
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import socket
+import threading
+import time
+
+import socketio
+import uvicorn
+
+from icefarm.utils.web import SyncAsyncServer
+
+class NewLoopPerEmitServer(SyncAsyncServer):
+    """Previous behavior, every emit from a background thread runs in its own event loop."""
+    def _run_coro(self, coro):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(coro)
+        else:
+            return asyncio.ensure_future(coro)
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def receive(url: str, events: int, connected, finished):
+    """Client process, sets finished once events have been received."""
+    client = socketio.Client()
+    received = 0
+
+    @client.on("event")
+    def on_event(data):
+        nonlocal received
+        received += 1
+        if received == events:
+            finished.set()
+
+    client.connect(url, transports=["websocket"])
+    connected.set()
+    finished.wait()
+    client.disconnect()
+
+def run(server_cls, events: int, threads: int, clients: int) -> tuple[float, float]:
+    """Emits events to each client, split over threads background threads. Returns the rate at which
+    the threads could emit and the rate at which the events were delivered, in events per second."""
+    sio = server_cls(async_mode="asgi")
+    sids = []
+
+    @sio.on("connect")
+    async def connect(sock_id, environ, auth):
+        sids.append(sock_id)
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(socketio.ASGIApp(sio), port=port, log_level="error"))
+    server_thread = threading.Thread(target=server.run, daemon=True)
+    server_thread.start()
+
+    while not server.started:
+        time.sleep(0.05)
+
+    ctx = multiprocessing.get_context("spawn")
+    procs = []
+    for _ in range(clients):
+        connected, finished = ctx.Event(), ctx.Event()
+        proc = ctx.Process(target=receive, args=(f"http://127.0.0.1:{port}", events // clients, connected, finished), daemon=True)
+        proc.start()
+        connected.wait(30)
+        procs.append((proc, finished))
+
+    while len(sids) < clients:
+        time.sleep(0.05)
+
+    per_thread = events // threads
+
+    def emit(offset):
+        for i in range(per_thread):
+            sio.emit("event", {"i": i}, to=sids[(offset + i) % clients])
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=emit, args=(n,)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    emitted = time.perf_counter() - start
+
+    completed = all(finished.wait(120) for _, finished in procs)
+    delivered = time.perf_counter() - start
+
+    for proc, finished in procs:
+        finished.set()
+        proc.join(5)
+
+    server.should_exit = True
+    server_thread.join(5)
+
+    if not completed:
+        print(f"{server_cls.__name__}: not all events were received")
+
+    return events / emitted, events / delivered
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--clients", type=int, default=4)
+    args = parser.parse_args()
+
+    logging.getLogger("socketio").setLevel(logging.ERROR)
+    step = args.threads * args.clients
+    events = args.events - args.events % step
+
+    for server_cls in [NewLoopPerEmitServer, SyncAsyncServer]:
+        emit_rate, delivery_rate = run(server_cls, events, args.threads, args.clients)
+        print(f"{server_cls.__name__}: {emit_rate:.0f} emits/s, {delivery_rate:.0f} delivered/s "
+              f"({events} events, {args.threads} threads, {args.clients} clients)")
+
+if __name__ == "__main__":
+    main()
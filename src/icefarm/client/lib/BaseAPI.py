@@ -24,6 +24,8 @@ class BaseAPI:
         self.connection_info = {}
         self.lock = Lock()
         self.logger = logger
+        self.lease = None
+        self.idle = None
 
     def addSerial(self, serial, conn_info: ConnectionInfo):
         with self.lock:
@@ -54,6 +56,19 @@ class BaseAPI:
         with self.lock:
             return info in self.connection_info.values()
 
+    def setLease(self, seconds: int):
+        """Sets the lease duration in seconds of future reservations. Leases are renewed automatically while
+        the client is connected to the control server and expire shortly after it disconnects, so this only
+        bounds how long devices stay reserved if the client is not connected. The control server clamps
+        the value to its allowed range."""
+        self.lease = seconds
+
+    def setIdleTimeout(self, seconds: int):
+        """Sets how long devices of future reservations may go without evaluations before the control server
+        releases them. A 'reservation idle' event is sent before a device is released. Use 0 to keep idle
+        devices reserved. If not set, the control server default is used."""
+        self.idle = seconds
+
     def request(self, url: str, endpoint: str, json: dict, files=None) -> dict:
         """Sends a GET to url/endpoint with json. If files is specified, the data
         is instead sent as a multipart forum."""
@@ -102,6 +117,12 @@ class BaseAPI:
             "args": args
         }
 
+        if self.lease:
+            json["lease"] = self.lease
+
+        if self.idle is not None:
+            json["idle"] = self.idle
+
         return self._addConnectionData(self.requestControl("reserve", json))
 
     def reserveSpecific(self, serials: list[str], kind: str, args: dict) -> dict:
@@ -112,6 +133,12 @@ class BaseAPI:
             "serials": serials
         }
 
+        if self.lease:
+            json["lease"] = self.lease
+
+        if self.idle is not None:
+            json["idle"] = self.idle
+
         return self._addConnectionData(self.requestControl("reserveserials", json))
 
     def available(self) -> int:
@@ -125,7 +152,7 @@ class BaseAPI:
         return self.requestControl("devices", {})
 
     def extend(self, serials: list[str]) -> list[str]:
-        """Extends the reservation on serials for by hour. The serials must be reserved under the client's name.
+        """Renews the lease of the reservation on serials. The serials must be reserved under the client's name.
         Returns the serials that were extended."""
         return self.requestControl("extend", {
             "name": self.name,
@@ -133,7 +160,7 @@ class BaseAPI:
         })
 
     def extendAll(self) -> list[str]:
-        """Extends all reservations by the under the client's name for by hour. Returns the serials that were extended."""
+        """Renews the leases of all reservations under the client's name. Returns the serials that were extended."""
         return self.requestControl("extendall", {
             "name": self.name
         })
@@ -25,6 +25,10 @@ class BaseClientEventHandler(AbstractEventHandler):
         self.client.removeSerial(serial)
         self.client.logger.warning(f"reservation for {serial} ended")
 
+    @register("reservation idle", "serial", "remaining")
+    def handleReservationIdle(self, serial: str, remaining: int):
+        self.client.logger.warning(f"reservation for {serial} is idle and ends in {remaining} seconds")
+
     @register("failure", "serial")
     def handleFailure(self, serial: str):
         self.client.removeSerial(serial)
@@ -33,6 +37,8 @@ class BaseClientEventHandler(AbstractEventHandler):
     @register("initialized", "serial")
     def handleInitialization(self, serial):
         with self.cond:
+            # devices that skip flashing may initialize before waitUntilInitilized is called
+            self.recently_added_serials.append(serial)
             self.awaiting_serials.discard(serial)
             if not self.awaiting_serials:
                 self.cond.notify_all()
@@ -60,11 +66,11 @@ class BaseClientEventHandler(AbstractEventHandler):
             timer.name = "client-waitUntilInitialized-timeout-detection"
             timer.start()
 
-        self.awaiting_serials = set(serials)
-
         with self.cond:
+            self.awaiting_serials = set(serials)
+
             for serial in self.recently_added_serials:
-                self.awaiting_serials.pop(serial, None)
+                self.awaiting_serials.discard(serial)
 
             if self.awaiting_serials:
                 self.cond.wait_for(lambda : not self.awaiting_serials or time_passed())
@@ -123,6 +129,7 @@ class BaseClient(BaseAPI):
                 timer.cancel()
 
         with self.reservation_lock:
+            self.eh.recently_added_serials = []
             serials = super().reserve(amount, kind, args)
 
             if not serials:
@@ -144,6 +151,7 @@ class BaseClient(BaseAPI):
 
     def reserveSpecific(self, serials, kind, args):
         """Reserves specific serials from the iCEFARM system. The serials must be available."""
+        self.eh.recently_added_serials = []
         serials = super().reserveSpecific(serials, kind, args)
 
         if not serials:
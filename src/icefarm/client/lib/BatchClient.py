@@ -3,12 +3,14 @@ import uuid
 import threading
 import math
 from collections import Counter
+from itertools import groupby
 from collections.abc import Generator
 from abc import ABC, abstractmethod
 from typing import Any, List, Dict
 import time
 
 from icefarm.utils import MappedQueues
+from icefarm.utils.compression import choose_codec, compress
 from icefarm.client.lib import BaseClient
 from icefarm.client.lib.AbstractEventHandler import AbstractEventHandler, register
 
@@ -31,9 +33,16 @@ class Evaluation(ABC):
     def __hash__(self):
         return hash(self.id)
 
-    def toJson(self, batch_id: str) -> dict:
+    def toJson(self, batch_id: str, compression: str=None) -> dict:
+        """Converts the evaluation into a request for batch_id. If compression is provided,
+        the bitstreams under "files" are compressed with that codec."""
         json = self._toJson()
         json["batch_id"] = batch_id
+
+        if compression and "files" in json:
+            json["files"] = {name: compress(data, compression) for name, data in json["files"].items()}
+            json["compression"] = compression
+
         return json
 
     @abstractmethod
@@ -250,6 +259,10 @@ class ResultHandler(AbstractEventHandler):
         super().__init__(event_server)
         self.client = client
 
+    @register("initialized", "serial", "compression")
+    def initialized(self, serial: str, compression: list[str]):
+        self.client.compression[serial] = choose_codec(compression)
+
     @register("results", "batch_id", "serial", "results")
     def results(self, batch_id: str, serial: str, results: Dict[str, int]):
         factory = self.client.batch_factories.get(batch_id)
@@ -261,17 +274,26 @@ class ResultHandler(AbstractEventHandler):
 
 class BatchClient(BaseClient):
     def __init__(self, url, client_name, logger):
+        # serial -> codec used for bitstreams, workers that do not advertise codecs receive them uncompressed.
+        # Set before connecting since events that remove serials may arrive straight away.
+        self.compression: dict[str, str] = {}
         super().__init__(url, client_name, logger)
 
         self.batch_factories: dict[str, AbstractBatchFactory] = {}
         self.addEventHandler(ResultHandler(self.server, self))
 
+    def removeSerial(self, serial):
+        super().removeSerial(serial)
+        self.compression.pop(serial, None)
+
     # TODO figure out better design for broken devices during batches
     # Need to improve EvaluationBundle first
     def _evaluateBatch(self, evaluations: list[Evaluation], batch_id: str, bad_serials: set[str]):
         out = []
         for evaluation in evaluations:
-            out.append(self.requestBatchWorker(list(evaluation.serials - bad_serials), "evaluate", evaluation.toJson(batch_id)))
+            serials = sorted(evaluation.serials - bad_serials, key=lambda serial: self.compression.get(serial) or "")
+            for compression, group in groupby(serials, lambda serial: self.compression.get(serial)):
+                out.append(self.requestBatchWorker(list(group), "evaluate", evaluation.toJson(batch_id, compression)))
 
         return out
 
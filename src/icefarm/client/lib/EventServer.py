@@ -1,28 +1,31 @@
 from __future__ import annotations
-from logging import LoggerAdapter
 import threading
-import json
+import time
 import msgpack
 from dataclasses import dataclass
 
 import socketio
 
+from icefarm.utils.ContextLogger import ContextLogger, CATEGORY_EVENT
+from icefarm.utils.encoding import ENCODING_MSGPACK, decode
+
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from icefarm.client.lib import AbstractEventHandler
 
-class EventLogger(LoggerAdapter):
-    def process(self, msg, kwargs):
-        return f"[EventServer] {msg}", kwargs
+# sequenced frames are acknowledged once this many seconds or messages have passed since the last ack
+ACK_INTERVAL = 1
+ACK_MESSAGES = 256
+
+class EventLogger(ContextLogger):
+    def __init__(self, logger, extra=None):
+        super().__init__(logger, "[EventServer]")
 
-class SocketLogger(LoggerAdapter):
+class SocketLogger(ContextLogger):
     def __init__(self, logger, url, extra = None):
-        super().__init__(logger, extra)
+        super().__init__(logger, f"[socket@{url}]", url=url)
         self.url = url
 
-    def process(self, msg, kwargs):
-        return f"[socket@{self.url}] {msg}", kwargs
-
 @dataclass
 class Event:
     serial: str
@@ -64,6 +67,13 @@ class EventServer:
 
         logger = SocketLogger(self.logger, url)
 
+        # last sequenced message received, sent on reconnect so that the stream resumes after it
+        stream = {"session": None, "seq": -1}
+        acked = {"seq": -1, "time": 0}
+
+        def auth():
+            return {"client_id": self.client_id, "frames": True, "resume": dict(stream), "encoding": ENCODING_MSGPACK}
+
         @sio.event
         def connect():
             logger.info("connected")
@@ -73,12 +83,9 @@ class EventServer:
         @sio.event
         def disconnect(reason):
             logger.error(f"disconnected: {reason}")
-        @sio.event
-        def event(data):
-            try:
-                msg = json.loads(data)
-            except Exception:
-                logger.error("received unparsable data")
+        def handle_message(msg):
+            if not isinstance(msg, dict):
+                logger.error("bad message")
                 return
 
             serial = msg.get("serial")
@@ -100,13 +107,79 @@ class EventServer:
                 # TODO this is hacky, need to update eventhandlers to use event.serial instead of contents.serial
                 # TODO need to update design docs with protocol changes
                 content["serial"] = serial
-                logger.debug(f"received {event} event")
+                logger.debug("received %s event", event, category=CATEGORY_EVENT)
                 event = Event(serial, event, content)
                 self.handleEvent(event)
 
+        @sio.event
+        def event(data):
+            try:
+                msg = decode(data)
+            except Exception:
+                logger.error("received unparsable data")
+                return
+
+            handle_message(msg)
+
+        @sio.event
+        def events(data):
+            """Frame containing multiple messages, sent when the socket is connected with frames enabled.
+            Sockets connected with resume receive sequenced frames instead. Frames are msgpack
+            if the socket negotiated it, in which case sample arrays are decoded as array.array."""
+            try:
+                msgs = decode(data)
+            except Exception:
+                logger.error("received unparsable data")
+                return
+
+            if isinstance(msgs, dict):
+                handle_sequenced(msgs)
+                return
+
+            if not isinstance(msgs, list):
+                logger.error("bad frame")
+                return
+
+            for msg in msgs:
+                handle_message(msg)
+
+        def handle_sequenced(frame):
+            session = frame.get("session")
+            seq = frame.get("seq")
+            msgs = frame.get("events")
+
+            if not isinstance(seq, int) or not isinstance(msgs, list):
+                logger.error("bad sequenced frame")
+                return
+
+            if session != stream["session"]:
+                stream["session"] = session
+                stream["seq"] = -1
+                acked["seq"] = -1
+            elif seq > stream["seq"] + 1:
+                logger.error(f"missed {seq - stream['seq'] - 1} events")
+
+            # messages before stream["seq"] were already handled before a reconnect
+            for msg in msgs[max(stream["seq"] + 1 - seq, 0):]:
+                handle_message(msg)
+
+            stream["seq"] = max(stream["seq"], seq + len(msgs) - 1)
+
+            now = time.monotonic()
+            if now - acked["time"] >= ACK_INTERVAL or stream["seq"] - acked["seq"] >= ACK_MESSAGES:
+                try:
+                    sio.emit("ack", {"session": session, "seq": stream["seq"]})
+                except socketio.exceptions.SocketIOError:
+                    # the socket is reconnecting, resume covers what was not acknowledged
+                    logger.debug("failed to acknowledge events")
+                    return
+
+                acked["seq"] = stream["seq"]
+                acked["time"] = now
+
         # TODO
         try:
-            sio.connect(url, auth={"client_id": self.client_id}, wait_timeout=10)
+            sio.connect(url, auth=auth, wait_timeout=10)
             return sio
         except Exception:
             return False
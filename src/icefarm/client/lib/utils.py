@@ -16,6 +16,11 @@ class DefaultBaseEventHandler(AbstractEventHandler):
     def handleReservationEnd(self, serial: str):
         """Called when the reservation has ended."""
 
+    @register("reservation idle", "serial", "remaining")
+    def handleReservationIdle(self, serial: str, remaining: int):
+        """Called when the device has not been used for a while. The reservation
+        ends after remaining seconds unless the device is used."""
+
     @register("failure", "serial")
     def handleFailure(self, serial: str):
         """Called when the device experiences an unexpected failure
@@ -32,7 +37,8 @@ class LoggerEventHandler(AbstractEventHandler):
         self.logger.info(f"Received event: {event.event} serial: {event.serial} contents: {event.contents}")
 
 class ReservationExtender(AbstractEventHandler):
-    """Automatically extends device reservations when they are nearing completion."""
+    """Automatically extends device reservations when they are nearing completion. Leases are renewed by the
+    control server while the client is connected, so this only takes effect while disconnected."""
     def __init__(self, event_server, client, logger: Logger):
         super().__init__(event_server)
         self.client = client
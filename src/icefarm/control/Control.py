@@ -5,17 +5,27 @@ import threading
 import requests
 
 from icefarm.control import ControlDatabase
-from icefarm.control.webapp import build_page
+from icefarm.control.Dashboard import Dashboard
+from icefarm.control.webapp import build_page, build_state
 
 import typing
 if typing.TYPE_CHECKING:
-    from icefarm.control import ControlEventSender
+    from icefarm.control import ControlEventSender, WorkerChannels, WarmPool
+
+DEFAULT_LEASE_SECONDS = 3600
+# must stay above twice the disconnect grace period so reconnecting clients are renewed
+MIN_LEASE_SECONDS = 300
+MAX_LEASE_SECONDS = 24 * 3600
+# reservations without device activity for this long are released, 0 disables
+DEFAULT_IDLE_SECONDS = 30 * 60
 
 class Control:
-    def __init__(self, event_sender: ControlEventSender, database_url: str, logger: Logger):
+    def __init__(self, event_sender: ControlEventSender, channels: WorkerChannels, database_url: str, logger: Logger, warm_pool: WarmPool=None):
         self.event_sender = event_sender
+        self.channels = channels
         self.database = ControlDatabase(database_url)
         self.logger = logger
+        self.warm_pool = warm_pool
 
         self.database.listenAvailable(self.event_sender.sendDevicesAvailableChange)
 
@@ -25,9 +35,27 @@ class Control:
 
         self.database.listenReservations(reservation_end)
 
+        self.dashboard = Dashboard(self.event_sender, self.database, self.logger)
+
+    def verifyWorker(self, name: str, url: str, remote_addr: str) -> bool:
+        """Checks that a worker channel connection comes from the worker it claims to be, i.e. the worker
+        registered itself with url and the connection comes from its host."""
+        if not (address := self.database.getWorkerAddress(name)):
+            return False
+
+        host, port = address
+        return url == f"http://{host}:{port}" and remote_addr == host
+
     # TODO this feels out of place
     def getApp(self):
-        return build_page(self.database)
+        return build_page()
+
+    def getStateVersion(self) -> str:
+        return self.dashboard.version
+
+    def getState(self, version: str, limit: int, offset: int, status: str=None, worker: str=None) -> dict:
+        """Returns a page of the dashboard state. Raises ValueError on a bad filter or page."""
+        return build_state(self.database, version, limit=limit, offset=offset, status=status, worker=worker)
 
     def extend(self, client_id: str, serials: list[str]) -> list[str]:
         return self.database.extend(client_id, serials)
@@ -35,24 +63,34 @@ class Control:
     def extendAll(self, client_id: str) -> list[str]:
         return self.database.extendAll(client_id)
 
+    def _requestWorker(self, url: str, command: str, args: dict, timeout: float=10):
+        """Sends a command to a worker. Uses the worker's control channel when it has one,
+        otherwise falls back to calling the worker endpoint. Returns the result of the
+        command, or False on failure."""
+        if self.channels.isConnected(url):
+            return self.channels.request(url, command, args, timeout=timeout)
+
+        try:
+            res = requests.get(f"{url}/{command}", json=args, timeout=timeout)
+
+            if res.status_code != 200:
+                return False
+        except Exception:
+            return False
+
+        return True
+
     def reboot(self, serials: list[str]):
         out = []
         for serial in serials:
             if not (url := self.database.getDeviceWorkerUrl(serial)):
                 return False
 
-            try:
-                res = requests.get(f"{url}/reboot", json={
-                    "serial": serial
-                }, timeout=10)
-
-                if res.status_code != 200:
-                    raise Exception
-
-                out.append(serial)
-
-            except Exception:
+            if self._requestWorker(url, "reboot", {"serial": serial}) is False:
                 self.logger.warning(f"[Control] failed to send reboot command to worker {url} device {serial}")
+                continue
+
+            out.append(serial)
 
         return out
 
@@ -62,17 +100,11 @@ class Control:
             if not (url := self.database.getDeviceWorkerUrl(serial)):
                 return False
 
-            try:
-                res = requests.get(f"{url}/delete", json={
-                    "serial": serial
-                    }, timeout=10)
-
-                if res.status_code != 200:
-                    raise Exception
-
-                out.append(serial)
-            except Exception:
+            if self._requestWorker(url, "delete", {"serial": serial}) is False:
                 self.logger.warning(f"[Control] failed to send delete command to worker {url} device {serial}")
+                continue
+
+            out.append(serial)
 
         return out
 
@@ -111,35 +143,43 @@ class Control:
 
     def _sendReservationNotifications(self, con_info, kind, args):
         for row in con_info:
-            def send_reserve():
-                ip = row["ip"]
-                port = row["serverport"]
+            def send_reserve(row=row):
+                url = f"http://{row['ip']}:{row['serverport']}"
                 serial = row["serial"]
 
-                try:
-                    res = requests.get(f"http://{ip}:{port}/reserve", json={
-                        "serial": serial,
-                        "kind": kind,
-                        "args": args
-                    }, timeout=15)
-
-                    if res.status_code != 200:
-                        raise Exception
-                except Exception:
-                    pass
+                if self._requestWorker(url, "reserve", {
+                    "serial": serial,
+                    "kind": kind,
+                    "args": args
+                }, timeout=15) is False:
+                    self.logger.warning(f"[Control] failed to send reserve command to worker {url} device {serial}")
 
             thread = threading.Thread(target=send_reserve, name="send-reservation")
             thread.start()
 
-    def reserve(self, client_id: str, amount: int, kind: str, args: dict) -> dict:
-        if (con_info := self.database.reserve(amount, client_id, kind)) is False:
+    def _recordDemand(self, kind: str, amount: int):
+        # requested rather than granted amount, so that demand that could not be met still counts
+        if self.warm_pool:
+            self.warm_pool.recordReservation(kind, amount)
+
+    def reserve(self, client_id: str, amount: int, kind: str, args: dict, lease: int=DEFAULT_LEASE_SECONDS, idle: int=DEFAULT_IDLE_SECONDS) -> dict:
+        """Reserves amount devices. The reservations last lease seconds and are renewed while the
+        client's socket is connected. The lease is clamped to the allowed range. Reservations whose
+        devices have no activity for idle seconds are released, or never if idle is 0."""
+        lease = min(max(lease, MIN_LEASE_SECONDS), MAX_LEASE_SECONDS)
+        self._recordDemand(kind, amount)
+
+        if (con_info := self.database.reserve(amount, client_id, kind, lease, max(idle, 0))) is False:
             return False
 
         self._sendReservationNotifications(con_info, kind, args)
         return con_info
 
-    def reserveSerials(self, client_id: str, serials: list[str], kind: str, args: dict) -> dict:
-        if (con_info := self.database.reserveSerials(client_id, serials, kind)) is False:
+    def reserveSerials(self, client_id: str, serials: list[str], kind: str, args: dict, lease: int=DEFAULT_LEASE_SECONDS, idle: int=DEFAULT_IDLE_SECONDS) -> dict:
+        lease = min(max(lease, MIN_LEASE_SECONDS), MAX_LEASE_SECONDS)
+        self._recordDemand(kind, len(serials))
+
+        if (con_info := self.database.reserveSerials(client_id, serials, kind, lease, max(idle, 0))) is False:
             return False
 
         self._sendReservationNotifications(con_info, kind, args)
@@ -1,4 +1,9 @@
 from __future__ import annotations
+import json
+import threading
+
+import psycopg
+
 from icefarm.utils import Database
 
 class ControlDatabase(Database):
@@ -12,16 +17,24 @@ class ControlDatabase(Database):
         ip, port = row[0], row[1]
         return f"http://{ip}:{port}"
 
-    def reserve(self, amount: int, clientname: str, reservation_type: str) -> dict:
-        """Reserves amount devices for clientname. Returns as {serial, ip, serverport}"""
+    def getWorkerAddress(self, name: str) -> tuple[str, int]:
+        """Obtains the host and port a worker registered itself with."""
+        if not (data := self.execute("SELECT host, port FROM worker WHERE id = %s::varchar(255)", (name,))):
+            return False
+
+        return data[0][0], data[0][1]
+
+    def reserve(self, amount: int, clientname: str, reservation_type: str, lease: int, idle: int) -> dict:
+        """Reserves amount devices for clientname with a lease of lease seconds. The reservations are released
+        once their devices have been idle for idle seconds, or never if idle is 0. Returns as {serial, ip, serverport}"""
         return self.getData(
-            "SELECT * FROM make_reservations(%s::int, %s::varchar(255), %s::varchar(255))", (amount, clientname, reservation_type),
+            "SELECT * FROM make_reservations(%s::int, %s::varchar(255), %s::varchar(255), %s::int, %s::int)", (amount, clientname, reservation_type, lease, idle),
             ["serial", "ip", "serverport"], stringify=["ip"]
         )
 
-    def reserveSerials(self, client_id: str, serials: list[str], kind: str) -> dict:
+    def reserveSerials(self, client_id: str, serials: list[str], kind: str, lease: int, idle: int) -> dict:
         return self.getData(
-            "SELECT * FROM make_specific_reservations(%s::varchar(255), %s::varchar(255)[], %s::varchar(255))", (client_id, serials, kind),
+            "SELECT * FROM make_specific_reservations(%s::varchar(255), %s::varchar(255)[], %s::varchar(255), %s::int, %s::int)", (client_id, serials, kind, lease, idle),
             ["serial", "ip", "serverport"], stringify=["ip"]
         )
 
@@ -39,6 +52,21 @@ class ControlDatabase(Database):
 
         return False
 
+    def renewLeases(self, client_ids: list[str]) -> int:
+        """Renews the reservation leases of the clients. Returns the amount of reservations renewed."""
+        if not (data := self.execute("SELECT * FROM renew_leases(%s::varchar(255)[])", (client_ids,))):
+            return False
+
+        return data[0][0]
+
+    def expireLeases(self, name: str, grace: int) -> int:
+        """Shortens the reservation leases of the client to expire in grace seconds. Returns
+        the amount of reservations shortened."""
+        if not (data := self.execute("SELECT * FROM expire_leases(%s::varchar(255), %s::int)", (name, grace))):
+            return False
+
+        return data[0][0]
+
     def end(self, name: str, serials: list[str]):
         """Ends the reservation of serials under the name of the client.
         Returns as {serial, workerip, workerport}"""
@@ -62,6 +90,14 @@ class ControlDatabase(Database):
             ["name", "ip", "port", "heartbeat", "version", "reservables", "shutting_down"], stringify=["ip", "port"]
         )
 
+    def getIdleDevices(self) -> dict:
+        """Returns the amount of available or warming devices of each worker that is not shutting down,
+        as a list of {name, ip, port, reservables, idle}."""
+        return self.getData(
+            "SELECT * FROM get_idle_devices()", tuple(),
+            ["name", "ip", "port", "reservables", "idle"], stringify=["ip", "port"]
+        )
+
     def getDevices(self) -> dict:
         """Returns current devices, as a list of {serial, worker, status}."""
         return self.getData(
@@ -69,6 +105,62 @@ class ControlDatabase(Database):
             ["serial", "worker", "status", "client_id"], stringify=["status"]
         )
 
+    def getDeviceSummary(self) -> dict:
+        """Returns device counts aggregated by the database, as {total, available, reserved, broken}."""
+        if not (data := self.getData(
+            "SELECT * FROM get_device_summary()", tuple(),
+            ["total", "available", "reserved", "broken"]
+        )):
+            return False
+
+        return data[0]
+
+    def getDevicesPage(self, limit: int, offset: int, status: str=None, worker: str=None) -> dict:
+        """Returns a page of devices ordered by serial, optionally filtered by status and worker.
+        Returns as {devices: list of {serial, worker, status, client_id}, matching}, where matching
+        is the amount of devices that pass the filter."""
+        data = self.getData(
+            "SELECT * FROM get_devices_page(%s::int, %s::int, %s::devicestatus, %s::varchar(255))", (limit, offset, status, worker),
+            ["serial", "worker", "status", "client_id", "matching"], stringify=["status"]
+        )
+
+        if data is False:
+            return False
+
+        matching = data[0]["matching"] if data else 0
+        for row in data:
+            del row["matching"]
+
+        return {
+            "devices": data,
+            "matching": matching
+        }
+
+    def getDevicesById(self, serials: list[str]) -> list[dict]:
+        """Returns the devices with the specified serials, as a list of {serial, worker, status, client_id}.
+        Serials that do not exist are omitted."""
+        return self.getData(
+            "SELECT * FROM get_devices_by_id(%s::varchar(255)[])", (serials,),
+            ["serial", "worker", "status", "client_id"], stringify=["status"]
+        )
+
+    def listenDashboard(self, callback):
+        """Calls callback(kind, id) whenever a device or worker shown on the dashboard changes. Kind
+        is either 'device' or 'worker'."""
+        def l():
+            with psycopg.connect(self.url, autocommit=True) as conn:
+                conn.execute("LISTEN dashboard_updates")
+                gen = conn.notifies()
+
+                for notif in gen:
+                    try:
+                        js = json.loads(notif.payload)
+                        callback(js["kind"], js["id"])
+                    except Exception:
+                        pass
+
+        threading.Thread(target=l, daemon=True, name="dashboard-update-listener").start()
+
     def heartbeatWorker(self, name: str):
         """Updates the last heartbeat time on a worker to the current time"""
         return self.proc("CALL heartbeat_worker(%s::varchar(255))", (name,))
@@ -81,9 +173,9 @@ class ControlDatabase(Database):
             ["serial", "client_id", "worker"]
         )
 
-    def getReservationEndingSoon(self, minutes: int) -> list[str]:
-        """Gets reservations that are ending soon, returns the serials."""
-        data = self.execute("SELECT * FROM get_reservations_ending_soon(%s::int)", (minutes,))
+    def getReservationEndingSoon(self, minutes: int, excluded_clients: list[str]) -> list[str]:
+        """Gets reservations that are ending soon, ignoring the reservations of excluded_clients. Returns the serials."""
+        data = self.execute("SELECT * FROM get_reservations_ending_soon(%s::int, %s::varchar(255)[])", (minutes, excluded_clients))
         if not data:
             return False
 
@@ -96,6 +188,22 @@ class ControlDatabase(Database):
             ["serial", "client_id", "workerip", "workerport"], stringify=["workerip", "workerport"]
         )
 
+    def getIdleWarnings(self, warn_before: int) -> list[dict]:
+        """Gets reservations that will be released for inactivity within warn_before seconds and have
+        not been warned yet. Returns as {serial, client_id, remaining}"""
+        return self.getData(
+            "SELECT * FROM get_idle_warnings(%s::int)", (warn_before,),
+            ["serial", "client_id", "remaining"]
+        )
+
+    def getIdleTimeouts(self) -> list[dict]:
+        """Releases reservations that have been idle for longer than their idle period.
+        Returns as {serial, client_id}"""
+        return self.getData(
+            "SELECT * FROM handle_idle_reservations()", tuple(),
+            ["serial", "client_id"]
+        )
+
     def endAllReservations(self):
         """Deletes all reservations. Triggers reservation_end notification for each,
         causing workers to unreserve and reset devices."""
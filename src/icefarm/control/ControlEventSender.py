@@ -1,4 +1,5 @@
 from logging import LoggerAdapter
+import threading
 
 from icefarm.utils import EventSender
 
@@ -13,6 +14,39 @@ class ControlEventSender(EventSender):
     def __init__(self, socketio, dburl, logger):
         super().__init__(socketio, dburl, ControlEventSenderLogger(logger))
 
+        self.dashboard_socks: set[str] = set()
+        self.dashboard_lock = threading.Lock()
+
+    def addDashboard(self, sock_id):
+        """Subscribes a debug panel socket to dashboard deltas."""
+        with self.dashboard_lock:
+            self.dashboard_socks.add(sock_id)
+
+    def removeDashboard(self, sock_id) -> bool:
+        """Unsubscribes a debug panel socket. Returns whether the socket was subscribed."""
+        with self.dashboard_lock:
+            if sock_id not in self.dashboard_socks:
+                return False
+
+            self.dashboard_socks.discard(sock_id)
+            return True
+
+    def hasDashboards(self) -> bool:
+        with self.dashboard_lock:
+            return bool(self.dashboard_socks)
+
+    def sendDashboard(self, delta: dict):
+        """Pushes a dashboard delta to the subscribed debug panels. Dashboards are not
+        sessions, deltas sent while a panel is disconnected are dropped."""
+        with self.dashboard_lock:
+            socks = list(self.dashboard_socks)
+
+        for sock_id in socks:
+            try:
+                self.socketio.emit("dashboard", delta, to=sock_id)
+            except Exception:
+                self.logger.warning(f"failed to send dashboard delta to {sock_id}")
+
     def sendDeviceReservationEnd(self, serial: str, client_id: str) -> bool:
         """Sends a reservation end event for serial."""
         if not self.sendClientJson(serial, client_id, [{
@@ -40,6 +74,17 @@ class ControlEventSender(EventSender):
         else:
             self.logger.info(f"sent reservation ending soon to device {serial}")
 
+    def sendDeviceIdleWarning(self, serial: str, client_id: str, remaining: int) -> bool:
+        """Sends an idle event for serial, warning the client that the reservation will be
+        released in remaining seconds unless the device is used."""
+        if not self.sendClientJson(serial, client_id, [{
+            "event": "reservation idle",
+            "remaining": remaining
+        }]):
+            self.logger.warning(f"failed to send idle warning to {client_id} for device {serial}")
+        else:
+            self.logger.info(f"sent idle warning to {client_id} for device {serial}")
+
     def sendDevicesAvailableChange(self, amount):
         self.sendAllJson([{
             "event": "devices_available",
@@ -0,0 +1,105 @@
+from __future__ import annotations
+from logging import Logger, LoggerAdapter
+import threading
+import time
+import uuid
+
+from icefarm.control.webapp import build_workers
+
+import typing
+if typing.TYPE_CHECKING:
+    from icefarm.control import ControlDatabase, ControlEventSender
+
+class DashboardLogger(LoggerAdapter):
+    def process(self, msg, kwargs):
+        return f"[Dashboard] {msg}", kwargs
+
+class Dashboard:
+    """Tracks changes to the state shown on the debug panel. Database notifications are coalesced
+    for interval seconds, then the changed rows are fetched in bulk and pushed to dashboard sockets.
+    The version is used as the ETag of the state endpoint."""
+    def __init__(self, event_sender: ControlEventSender, database: ControlDatabase, logger: Logger, interval: float=1):
+        self.event_sender = event_sender
+        self.database = database
+        self.logger = DashboardLogger(logger)
+        self.interval = interval
+
+        # version is unique between control restarts so that stale ETags are never matched
+        self._boot_id = uuid.uuid4().hex[:8]
+        self._version = 0
+
+        self._pending_devices: set[str] = set()
+        self._pending_workers = False
+        self.cv = threading.Condition()
+
+        self.database.listenDashboard(self.handleUpdate)
+
+        self.thread = threading.Thread(target=self._run, name="dashboard-delta-sender", daemon=True)
+        self.thread.start()
+
+    @property
+    def version(self) -> str:
+        with self.cv:
+            return f"{self._boot_id}-{self._version}"
+
+    def handleUpdate(self, kind: str, id_: str):
+        """Callback for database dashboard notifications."""
+        with self.cv:
+            self._version += 1
+
+            if kind == "device":
+                self._pending_devices.add(id_)
+            elif kind == "worker":
+                self._pending_workers = True
+            else:
+                return
+
+            self.cv.notify_all()
+
+    def _run(self):
+        while True:
+            with self.cv:
+                self.cv.wait_for(lambda : self._pending_devices or self._pending_workers)
+
+            # let bursts of notifications (e.g. worker removal) accumulate
+            time.sleep(self.interval)
+
+            with self.cv:
+                serials, self._pending_devices = self._pending_devices, set()
+                workers_changed, self._pending_workers = self._pending_workers, False
+                version = f"{self._boot_id}-{self._version}"
+
+            if not self.event_sender.hasDashboards():
+                continue
+
+            try:
+                self._sendDelta(serials, workers_changed, version)
+            except Exception as e:
+                self.logger.error(f"failed to send dashboard delta: {e}")
+
+    def _sendDelta(self, serials: set[str], workers_changed: bool, version: str):
+        delta = {}
+
+        if serials:
+            if (devices := self.database.getDevicesById(list(serials))) is False:
+                self.logger.error("failed to fetch changed devices")
+                return
+
+            delta["devices"] = devices
+            delta["removed"] = list(serials - set(row["serial"] for row in devices))
+
+        if workers_changed:
+            if (workers := build_workers(self.database)) is False:
+                self.logger.error("failed to fetch workers")
+                return
+
+            delta["workers"] = workers
+
+        if (summary := self.database.getDeviceSummary()) is False:
+            self.logger.error("failed to fetch device summary")
+            return
+
+        delta["summary"] = summary
+        delta["version"] = version
+
+        self.event_sender.sendDashboard(delta)
@@ -10,7 +10,7 @@ from icefarm.control import ControlDatabase
 
 import typing
 if typing.TYPE_CHECKING:
-    from icefarm.control import ControlEventSender
+    from icefarm.control import ControlEventSender, WorkerChannels
 
 # TODO get values from config
 class HeartbeatConfig:
@@ -22,14 +22,19 @@ class HeartbeatConfig:
         self.reservation_expiring_poll_seconds: str = 300
         self.reservation_expiring_notify_at_seconds: str = 20 * 60
         self.heartbeat_request_timeout_seconds: str = 30
+        self.lease_renew_poll_seconds: str = 15
+        self.lease_disconnect_grace_seconds: str = 120
+        self.idle_poll_seconds: str = 30
+        self.idle_warning_seconds: str = 5 * 60
 
 class HeartbeatLogger(LoggerAdapter):
     def process(self, msg, kwargs):
         return f"[Heartbeat] {msg}", kwargs
 
 class Heartbeat:
-    def __init__(self, event_sender: ControlEventSender, database_url: str, config: HeartbeatConfig, logger: Logger):
+    def __init__(self, event_sender: ControlEventSender, channels: WorkerChannels, database_url: str, config: HeartbeatConfig, logger: Logger):
         self.event_sender = event_sender
+        self.channels = channels
         self.logger = HeartbeatLogger(logger)
         self.database = ControlDatabase(database_url)
         self.config = config
@@ -40,6 +45,8 @@ class Heartbeat:
         self.__startWorkerTimeouts()
         self.__startReservationTimeouts()
         self.__startReservationEndingSoon()
+        self.__startLeaseRenewal()
+        self.__startIdleReservations()
 
         def run():
             while True:
@@ -57,6 +64,9 @@ class Heartbeat:
                 if not workers:
                     return
 
+                # an open control channel means the worker is alive, no need to poll it
+                connected = self.channels.getConnectedWorkers()
+
                 for row in workers:
                     name = row["name"]
                     ip = row["ip"]
@@ -64,10 +74,11 @@ class Heartbeat:
 
                     url = f"http://{ip}:{port}/heartbeat"
                     try:
-                        req = requests.get(url, timeout=self.config.heartbeat_request_timeout_seconds)
+                        if name not in connected:
+                            req = requests.get(url, timeout=self.config.heartbeat_request_timeout_seconds)
 
-                        if req.status_code != 200:
-                            raise Exception
+                            if req.status_code != 200:
+                                raise Exception
                     except Exception:
                         self.logger.error(f"{name} failed heartbeat check")
                     else:
@@ -111,7 +122,10 @@ class Heartbeat:
     def __startReservationEndingSoon(self):
         def do():
             def run(notify_at=self.config.reservation_expiring_notify_at_seconds):
-                if not (data := self.database.getReservationEndingSoon(notify_at)):
+                # leases of connected clients are renewed automatically, they do not need to extend
+                connected = self.event_sender.getConnectedClients()
+
+                if not (data := self.database.getReservationEndingSoon(notify_at, connected)):
                     return
 
                 for serial in data:
@@ -120,3 +134,44 @@ class Heartbeat:
             threading.Thread(target=run, name="heartbeat-reservation-ending-soon", daemon=True).start()
 
         schedule.every(self.config.reservation_expiring_poll_seconds).seconds.do(do)
+
+    def __startLeaseRenewal(self):
+        def do():
+            def run():
+                if not (connected := self.event_sender.getConnectedClients()):
+                    return
+
+                if (renewed := self.database.renewLeases(connected)) is False:
+                    self.logger.error("failed to renew reservation leases")
+                elif renewed:
+                    self.logger.debug(f"renewed {renewed} reservation leases")
+
+            threading.Thread(target=run, name="heartbeat-lease-renewal", daemon=True).start()
+
+        schedule.every(self.config.lease_renew_poll_seconds).seconds.do(do)
+
+    def __startIdleReservations(self):
+        def do():
+            def run(warn_before=self.config.idle_warning_seconds):
+                if (warnings := self.database.getIdleWarnings(warn_before)):
+                    for row in warnings:
+                        self.event_sender.sendDeviceIdleWarning(row["serial"], row["client_id"], row["remaining"])
+
+                if (released := self.database.getIdleTimeouts()):
+                    for row in released:
+                        self.logger.info(f"Reservation for device {row['serial']} by client {row['client_id']} released after being idle")
+
+            threading.Thread(target=run, name="heartbeat-idle-reservations", daemon=True).start()
+
+        schedule.every(self.config.idle_poll_seconds).seconds.do(do)
+
+    def handleClientDisconnect(self, client_id: str):
+        """Starts the grace period on the leases of a client whose control socket disconnected. If the
+        client does not reconnect before the grace period ends, its reservations time out."""
+        def run():
+            if (expiring := self.database.expireLeases(client_id, self.config.lease_disconnect_grace_seconds)) is False:
+                self.logger.error(f"failed to shorten reservation leases of {client_id}")
+            elif expiring:
+                self.logger.info(f"{expiring} reservation leases of {client_id} expire in {self.config.lease_disconnect_grace_seconds} seconds")
+
+        threading.Thread(target=run, name="heartbeat-lease-expire", daemon=True).start()
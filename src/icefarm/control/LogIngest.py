@@ -0,0 +1,95 @@
+from __future__ import annotations
+from logging import Logger, LoggerAdapter
+import queue
+import threading
+import zlib
+
+from icefarm.utils.Metrics import METRICS
+
+# batches waiting to be written before new batches are refused
+MAX_PENDING_BATCHES = 64
+# limit on the decompressed size of a batch
+MAX_BATCH_BYTES = 16 * 1024 * 1024
+
+INGESTED_RECORDS = METRICS.counter("log_ingest_records", "Log records received from workers", ["name"])
+DROPPED_RECORDS = METRICS.counter("log_ingest_dropped_records", "Log records workers reported dropping before sending", ["name"])
+REFUSED_BATCHES = METRICS.counter("log_ingest_refused_batches", "Log batches refused because too many were waiting to be written")
+
+class LogIngestLogger(LoggerAdapter):
+    def process(self, msg, kwargs):
+        return f"[LogIngest] {msg}", kwargs
+
+def decompress_body(body: bytes, encoding: str | None, max_size: int=MAX_BATCH_BYTES) -> bytes | None:
+    """Returns the request body without its content encoding, or None if it is invalid or too large."""
+    if not encoding:
+        return body if len(body) <= max_size else None
+
+    if encoding != "gzip":
+        return None
+
+    try:
+        decompressor = zlib.decompressobj(wbits=31)
+        data = decompressor.decompress(body, max_size)
+    except zlib.error:
+        return None
+
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        return None
+
+    return data
+
+class LogIngest:
+    """Writes log batches sent by workers to the control server's logger from a background thread,
+    so that requests return without waiting on log handlers. Records keep the timestamp they were
+    logged with on the worker."""
+    def __init__(self, logger: Logger, max_pending: int=MAX_PENDING_BATCHES):
+        self.base_logger = logger
+        self.logger = LogIngestLogger(logger)
+        self.batches: queue.Queue[tuple[str, list, int]] = queue.Queue(maxsize=max_pending)
+
+        self.thread = threading.Thread(target=self._write, name="log-ingest", daemon=True)
+        self.thread.start()
+
+    def submit(self, name: str, records: list, dropped: int=0) -> bool:
+        """Queues a batch of records from worker name. Returns False if too many batches are waiting."""
+        try:
+            self.batches.put_nowait((name, records, dropped))
+        except queue.Full:
+            REFUSED_BATCHES.inc()
+            return False
+
+        return True
+
+    def _write(self):
+        while True:
+            name, records, dropped = self.batches.get()
+
+            INGESTED_RECORDS.labels(name).inc(len(records))
+            if dropped:
+                DROPPED_RECORDS.labels(name).inc(dropped)
+                self.logger.warning(f"{name} dropped {dropped} log records before sending")
+
+            for record in records:
+                try:
+                    self._writeRecord(name, record)
+                except Exception as e:
+                    self.logger.error(f"bad log record from {name}: {e}")
+
+    def _writeRecord(self, name: str, record):
+        if isinstance(record, dict):
+            level, msg = record.get("level"), record.get("msg")
+            created, serial = record.get("ts"), record.get("serial")
+        else:
+            # records of workers that predate structured records are (level, msg)
+            level, msg = record
+            created, serial = None, None
+
+        if not isinstance(level, int) or not self.base_logger.isEnabledFor(level):
+            return
+
+        log_record = self.base_logger.makeRecord(self.base_logger.name, level, "(remote)", 0, f"[{name}] {msg}", None, None, extra={"serial": serial})
+        if isinstance(created, (int, float)):
+            log_record.created = created
+            log_record.msecs = (created - int(created)) * 1000
+
+        self.base_logger.handle(log_record)
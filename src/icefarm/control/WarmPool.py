@@ -0,0 +1,134 @@
+from __future__ import annotations
+from logging import Logger, LoggerAdapter
+import os
+import threading
+import time
+
+from icefarm.control import ControlDatabase
+from icefarm.utils.Metrics import METRICS
+
+import typing
+if typing.TYPE_CHECKING:
+    from icefarm.control import WorkerChannels
+
+# share of each worker's idle devices that is flashed ahead of reservations
+DEFAULT_WARM_POOL_SHARE = 0.5
+# seconds after which a reservation counts half as much towards demand
+DEFAULT_DEMAND_HALF_LIFE = 15 * 60
+WARM_POOL_POLL_SECONDS = 30
+# demand below this is forgotten
+MIN_DEMAND = 0.01
+
+DEMAND = METRICS.gauge("warm_pool_demand", "Recently reserved devices per reservable kind, decayed over time", ["kind"])
+TARGET = METRICS.gauge("warm_pool_target", "Idle devices that workers are asked to keep running the firmware of a reservable", ["kind"])
+
+class WarmPoolConfig:
+    def __init__(self):
+        self.share: float = float(os.environ.get("ICEFARM_WARM_POOL_SHARE") or DEFAULT_WARM_POOL_SHARE)
+        self.half_life_seconds: float = float(os.environ.get("ICEFARM_WARM_POOL_HALF_LIFE") or DEFAULT_DEMAND_HALF_LIFE)
+        self.poll_seconds: float = WARM_POOL_POLL_SECONDS
+
+class WarmPoolLogger(LoggerAdapter):
+    def process(self, msg, kwargs):
+        return f"[WarmPool] {msg}", kwargs
+
+class DemandTracker:
+    """Amount of devices reserved per kind, where each reservation counts half as much every
+    half_life seconds."""
+    def __init__(self, half_life_seconds: float):
+        self.half_life_seconds = half_life_seconds
+        self.lock = threading.Lock()
+        self.demand: dict[str, float] = {}
+        self.updated = time.monotonic()
+
+    def _decay(self):
+        now = time.monotonic()
+        factor = 0.5 ** ((now - self.updated) / self.half_life_seconds)
+        self.updated = now
+
+        self.demand = {kind: demand * factor for kind, demand in self.demand.items() if demand * factor >= MIN_DEMAND}
+
+    def record(self, kind: str, amount: int):
+        with self.lock:
+            self._decay()
+            self.demand[kind] = self.demand.get(kind, 0) + amount
+
+    def get(self) -> dict[str, float]:
+        with self.lock:
+            self._decay()
+            return dict(self.demand)
+
+def split_targets(demand: dict[str, float], reservables: list[str], warm: int) -> dict[str, int]:
+    """Splits warm devices between reservables in proportion to their demand. Kinds without demand
+    get a target of 0 so that their devices can be reused."""
+    targets = {kind: 0 for kind in reservables}
+    total = sum(demand.get(kind, 0) for kind in reservables)
+
+    if not total:
+        return targets
+
+    # most demanded first so that rounding does not starve it
+    remaining = warm
+    for kind in sorted(reservables, key=lambda kind : demand.get(kind, 0), reverse=True):
+        target = min(round(warm * demand.get(kind, 0) / total), remaining)
+        targets[kind] = target
+        remaining -= target
+
+    return targets
+
+class WarmPool:
+    """Tracks demand per reservable kind and periodically asks workers to flash a share of their idle
+    devices with the firmware of the kinds in demand, so that reservations can skip flashing."""
+    def __init__(self, channels: WorkerChannels, database_url: str, config: WarmPoolConfig, logger: Logger):
+        self.channels = channels
+        self.database = ControlDatabase(database_url)
+        self.config = config
+        self.logger = WarmPoolLogger(logger)
+        self.demand = DemandTracker(config.half_life_seconds)
+        self.thread = None
+
+    def recordReservation(self, kind: str, amount: int):
+        self.demand.record(kind, amount)
+
+    def start(self):
+        if self.config.share <= 0:
+            self.logger.info("warm pool disabled")
+            return
+
+        def run():
+            while True:
+                time.sleep(self.config.poll_seconds)
+
+                try:
+                    self.update()
+                except Exception as e:
+                    self.logger.error(f"failed to update warm pool: {e}")
+
+        self.thread = threading.Thread(target=run, name="warm-pool", daemon=True)
+        self.thread.start()
+
+    def update(self):
+        """Sends each connected worker its targets."""
+        demand = self.demand.get()
+        for kind, value in demand.items():
+            DEMAND.labels(kind).set(value)
+
+        if (workers := self.database.getIdleDevices()) is False:
+            self.logger.error("failed to get idle devices")
+            return
+
+        totals: dict[str, int] = {}
+        for row in workers:
+            url = f"http://{row['ip']}:{row['port']}"
+            if not self.channels.isConnected(url):
+                continue
+
+            targets = split_targets(demand, row["reservables"], int(row["idle"] * self.config.share))
+            for kind, target in targets.items():
+                totals[kind] = totals.get(kind, 0) + target
+
+            if self.channels.request(url, "warm", {"targets": targets}) is False:
+                self.logger.warning(f"failed to send warm pool targets to {row['name']}")
+
+        for kind, target in totals.items():
+            TARGET.labels(kind).set(target)
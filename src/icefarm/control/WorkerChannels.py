@@ -0,0 +1,121 @@
+from __future__ import annotations
+from logging import Logger, LoggerAdapter
+import threading
+import uuid
+
+class WorkerChannelsLogger(LoggerAdapter):
+    def process(self, msg, kwargs):
+        return f"[WorkerChannels] {msg}", kwargs
+
+class PendingCommand:
+    def __init__(self, sock_id):
+        self.sock_id = sock_id
+        self.event = threading.Event()
+        self.result = False
+
+    def resolve(self, result):
+        self.result = result
+        self.event.set()
+
+class WorkerChannels:
+    """Tracks the persistent socket connections workers keep to the control server. Commands are
+    sent as 'command' events with a request id and workers respond with a 'command_ack' event
+    carrying the same id, so many commands can be in flight over one connection. A connected
+    channel also doubles as the worker's heartbeat."""
+    def __init__(self, socketio, logger: Logger):
+        self.socketio = socketio
+        self.logger = WorkerChannelsLogger(logger)
+
+        self.lock = threading.Lock()
+        # sock_id -> (name, url)
+        self.workers: dict[str, tuple[str, str]] = {}
+        # url -> sock_id
+        self.sock_ids: dict[str, str] = {}
+        self.pending: dict[str, PendingCommand] = {}
+
+    def addWorker(self, sock_id, name: str, url: str) -> bool:
+        """Registers a worker connection. Returns False if the worker already has a channel, which
+        is kept until it disconnects."""
+        with self.lock:
+            if url in self.sock_ids:
+                self.logger.warning(f"worker {name}@{url} already has a channel, refusing new connection")
+                return False
+
+            self.workers[sock_id] = (name, url)
+            self.sock_ids[url] = sock_id
+
+        self.logger.info(f"worker {name}@{url} connected")
+        return True
+
+    def removeWorker(self, sock_id) -> bool:
+        """Removes a worker connection and fails its in flight commands. Returns whether
+        the socket belonged to a worker."""
+        with self.lock:
+            if not (worker := self.workers.pop(sock_id, None)):
+                return False
+
+            name, url = worker
+            if self.sock_ids.get(url) == sock_id:
+                del self.sock_ids[url]
+
+            failed = [pending for pending in self.pending.values() if pending.sock_id == sock_id]
+
+        for pending in failed:
+            pending.resolve(False)
+
+        self.logger.warning(f"worker {name}@{url} disconnected")
+        return True
+
+    def isConnected(self, url: str) -> bool:
+        with self.lock:
+            return url in self.sock_ids
+
+    def getConnectedWorkers(self) -> set[str]:
+        """Returns the names of the workers that currently have a channel."""
+        with self.lock:
+            return set(name for name, _ in self.workers.values())
+
+    def request(self, url: str, command: str, args: dict, timeout: float=10):
+        """Sends a command to the worker at url and waits for its acknowledgement. Returns
+        the result of the command, or False if the command failed, timed out or the
+        worker is not connected."""
+        with self.lock:
+            sock_id = self.sock_ids.get(url)
+
+            if not sock_id:
+                return False
+
+            request_id = uuid.uuid4().hex
+            pending = PendingCommand(sock_id)
+            self.pending[request_id] = pending
+
+        try:
+            self.socketio.emit("command", {
+                "id": request_id,
+                "command": command,
+                "args": args
+            }, to=sock_id)
+
+            if not pending.event.wait(timeout):
+                self.logger.warning(f"command {command} to {url} timed out")
+        except Exception:
+            self.logger.warning(f"failed to send command {command} to {url}")
+        finally:
+            with self.lock:
+                self.pending.pop(request_id, None)
+
+        return pending.result
+
+    def handleAck(self, sock_id, data: dict):
+        if not isinstance(data, dict):
+            self.logger.error("bad command acknowledgement")
+            return
+
+        with self.lock:
+            pending = self.pending.get(data.get("id"))
+
+        if not pending or pending.sock_id != sock_id:
+            self.logger.warning("acknowledgement for unknown command")
+            return
+
+        pending.resolve(data.get("result", False))
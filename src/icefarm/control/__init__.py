@@ -1,4 +1,7 @@
 from icefarm.control.ControlDatabase import ControlDatabase
 from icefarm.control.ControlEventSender import ControlEventSender
+from icefarm.control.WorkerChannels import WorkerChannels
 from icefarm.control.Heartbeat import HeartbeatConfig, Heartbeat
+from icefarm.control.WarmPool import WarmPoolConfig, WarmPool
 from icefarm.control.Control import Control
+from icefarm.control.LogIngest import LogIngest
@@ -1,16 +1,21 @@
 import os
+import json
 import logging
 import sys
 import threading
 
-from flask import Flask, Response, request, send_file
+from flask import Flask, Response, request, send_file, jsonify
 from flask_socketio import SocketIO
 from socketio import ASGIApp
 from asgiref.wsgi import WsgiToAsgi
 
-from icefarm.control import Control, Heartbeat, HeartbeatConfig, ControlEventSender
+from icefarm.control import Control, Heartbeat, HeartbeatConfig, ControlEventSender, WorkerChannels, LogIngest, WarmPool, WarmPoolConfig
+from icefarm.control.LogIngest import decompress_body
+from icefarm.control.Control import DEFAULT_LEASE_SECONDS, DEFAULT_IDLE_SECONDS
+from icefarm.control.webapp import DEFAULT_PAGE_SIZE
+from icefarm.utils.Metrics import METRICS
 from icefarm.utils.web import SyncAsyncServer
-from icefarm.utils.web import flask_socketio_adapter_connect, flask_socketio_adapter_on, inject_and_return_json
+from icefarm.utils.web import flask_socketio_adapter_connect, flask_socketio_adapter_on, inject_and_return_json, get_remote_addr
 
 class ControlLogger(logging.LoggerAdapter):
     def __init__(self, logger, extra=None):
@@ -30,16 +35,44 @@ def create_app(app: Flask, socketio: SocketIO | SyncAsyncServer, base_logger: lo
     id_lock = threading.Lock()
 
     event_sender = ControlEventSender(socketio, DATABASE_URL, logger)
-    control = Control(event_sender, DATABASE_URL, logger)
+    channels = WorkerChannels(socketio, logger)
+    warm_pool = WarmPool(channels, DATABASE_URL, WarmPoolConfig(), logger)
+    warm_pool.start()
+    control = Control(event_sender, channels, DATABASE_URL, logger, warm_pool=warm_pool)
+
+    log_ingest = LogIngest(base_logger)
 
     heartbeat_config = HeartbeatConfig()
-    heartbeat = Heartbeat(event_sender, DATABASE_URL, heartbeat_config, logger)
+    heartbeat = Heartbeat(event_sender, channels, DATABASE_URL, heartbeat_config, logger)
     heartbeat.start()
 
     @app.get("/")
     def get_app():
         return control.getApp()
 
+    @app.get("/state")
+    def state():
+        version = control.getStateVersion()
+
+        if request.if_none_match.contains(version):
+            res = Response(status=304)
+            res.set_etag(version)
+            return res
+
+        try:
+            limit = int(request.args.get("limit", DEFAULT_PAGE_SIZE))
+            offset = int(request.args.get("offset", 0))
+            data = control.getState(version, limit, offset, status=request.args.get("status") or None, worker=request.args.get("worker") or None)
+        except ValueError:
+            return Response(status=400)
+
+        if data is False:
+            return Response(status=500)
+
+        res = jsonify(data)
+        res.set_etag(version)
+        return res
+
     @app.get("/style.css")
     def style():
         return send_file("./assets/style.css")
@@ -64,13 +97,13 @@ def create_app(app: Flask, socketio: SocketIO | SyncAsyncServer, base_logger: lo
 
     @app.get("/reserve")
     @inject_and_return_json
-    def make_reservations(amount: int, name: str, kind: str, args: dict):
-        return control.reserve(name, amount, kind, args)
+    def make_reservations(amount: int, name: str, kind: str, args: dict, lease: int=DEFAULT_LEASE_SECONDS, idle: int=DEFAULT_IDLE_SECONDS):
+        return control.reserve(name, amount, kind, args, lease=lease, idle=idle)
 
     @app.get("/reserveserials")
     @inject_and_return_json
-    def make_specific_reservations(name: str, kind: str, args: dict, serials: list[str]):
-        return control.reserveSerials(name, serials, kind, args)
+    def make_specific_reservations(name: str, kind: str, args: dict, serials: list[str], lease: int=DEFAULT_LEASE_SECONDS, idle: int=DEFAULT_IDLE_SECONDS):
+        return control.reserveSerials(name, serials, kind, args, lease=lease, idle=idle)
 
     @app.get("/extend")
     @inject_and_return_json
@@ -97,21 +130,57 @@ def create_app(app: Flask, socketio: SocketIO | SyncAsyncServer, base_logger: lo
         control.clearWorkers()
         return {"status": "ok"}
 
+    @app.get("/metrics")
+    def metrics():
+        return jsonify(METRICS.snapshot())
+
+    @app.post("/log")
+    def log_batch():
+        body = decompress_body(request.get_data(), request.headers.get("Content-Encoding"))
+        if body is None:
+            return Response(status=400)
+
+        try:
+            batch = json.loads(body)
+            name, records, dropped = batch["name"], batch["records"], batch.get("dropped", 0)
+        except (ValueError, KeyError, TypeError):
+            return Response(status=400)
+
+        if not isinstance(name, str) or not isinstance(records, list) or not isinstance(dropped, int):
+            return Response(status=400)
+
+        if not log_ingest.submit(f"{name}@{request.remote_addr}", records, dropped):
+            return Response(status=503)
+
+        return Response(status=200)
+
     @app.get("/log")
     @inject_and_return_json
     def log(name: str, logs: list):
-        for row in logs:
-            if len(row) != 2:
-                continue
-
-            level, msg = row[0], row[1]
-            base_logger.log(level, f"[{name}@{request.remote_addr[0]}] {msg}")
-
-        return True
+        rows = [row for row in logs if isinstance(row, list) and len(row) == 2]
+        return log_ingest.submit(f"{name}@{request.remote_addr}", rows)
 
     @socketio.on("connect")
     @flask_socketio_adapter_connect
     def connection(sid, environ, auth):
+        auth = auth or {}
+
+        if auth.get("dashboard"):
+            event_sender.addDashboard(sid)
+            return
+
+        if (worker_name := auth.get("worker")):
+            if not (url := auth.get("url")):
+                logger.warning(f"worker {worker_name} connected without url")
+                return False
+
+            remote_addr = get_remote_addr(environ)
+            if not control.verifyWorker(worker_name, url, remote_addr):
+                logger.warning(f"refused channel for worker {worker_name}@{url} from {remote_addr}")
+                return False
+
+            return channels.addWorker(sid, worker_name, url)
+
         client_id = auth.get("client_id")
         if not client_id:
             logger.warning("socket connection without client id")
@@ -122,11 +191,17 @@ def create_app(app: Flask, socketio: SocketIO | SyncAsyncServer, base_logger: lo
         with id_lock:
             sock_id_to_client_id[sid] = client_id
 
-        event_sender.addSocket(sid, client_id)
+        event_sender.addSocket(sid, client_id, frames=bool(auth.get("frames")), resume=auth.get("resume"), encoding=auth.get("encoding"))
 
     @socketio.on("disconnect")
     @flask_socketio_adapter_on
     def disconnect(sid, reason):
+        if event_sender.removeDashboard(sid):
+            return
+
+        if channels.removeWorker(sid):
+            return
+
         with id_lock:
             client_id = sock_id_to_client_id.pop(sid, None)
 
@@ -137,6 +212,24 @@ def create_app(app: Flask, socketio: SocketIO | SyncAsyncServer, base_logger: lo
         logger.info(f"client {client_id} disconnected")
 
         event_sender.removeSocket(client_id)
+        heartbeat.handleClientDisconnect(client_id)
+
+    @socketio.on("command_ack")
+    @flask_socketio_adapter_on
+    def command_ack(sid, data):
+        channels.handleAck(sid, data)
+
+    @socketio.on("ack")
+    @flask_socketio_adapter_on
+    def ack(sid, data):
+        with id_lock:
+            client_id = sock_id_to_client_id.get(sid)
+
+        if not client_id or not isinstance(data, dict):
+            logger.warning("bad ack from socket")
+            return
+
+        event_sender.ack(client_id, data.get("session"), data.get("seq"))
 
 def run_debug():
     SERVER_PORT = int(os.environ.get("ICEFARM_CONTROL_PORT", "8080"))
@@ -168,7 +261,8 @@ def run_uvicorn():
     # loop can be too busy with serial I/O, DB writes, and socket emits to
     # service the ping/pong heartbeat in time. The default 20s timeout caused
     # spurious "packet queue is empty, aborting" disconnects on the client.
-    socketio = SyncAsyncServer(async_mode="asgi", ping_timeout=60, ping_interval=25)
+    # Blocking calls on the loop are logged with their stack by the loop monitor.
+    socketio = SyncAsyncServer(async_mode="asgi", ping_timeout=60, ping_interval=25, loop_logger=logger)
     create_app(app, socketio, logger)
     app = WsgiToAsgi(app)
 
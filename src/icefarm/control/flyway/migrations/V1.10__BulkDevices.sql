@@ -0,0 +1,23 @@
+-- Registers the devices a worker finds when it starts in a single call. Devices that are
+-- already registered to the worker are skipped.
+CREATE PROCEDURE add_devices(dids varchar(255)[], wid varchar(255))
+LANGUAGE plpgsql AS $$ BEGIN
+    IF wid NOT IN (
+        SELECT id
+        FROM worker
+    ) THEN RAISE EXCEPTION 'Worker id does not exist';
+    END IF;
+
+    IF EXISTS (
+        SELECT 1
+        FROM device
+        WHERE device.id = ANY(dids)
+            AND device.worker_id != wid
+    ) THEN RAISE EXCEPTION 'Device serial already exists';
+    END IF;
+
+    INSERT INTO device(id, worker_id, device_status)
+    SELECT DISTINCT did, wid, 'await_flash_default'::devicestatus
+    FROM unnest(dids) AS did
+    ON CONFLICT (id) DO NOTHING;
+END $$;
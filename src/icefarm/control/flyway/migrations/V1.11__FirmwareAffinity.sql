@@ -0,0 +1,73 @@
+-- Devices keep the firmware of their last reservation after it ends. firmware is the
+-- reservable whose firmware the device is running, or NULL for the default firmware.
+-- make_reservations prefers devices already running the requested firmware so that
+-- the worker can skip flashing them.
+ALTER TABLE device
+ADD COLUMN firmware varchar(255);
+
+CREATE PROCEDURE update_device_firmware(did varchar(255), fw varchar(255))
+LANGUAGE plpgsql AS $$ BEGIN
+    IF did NOT IN (
+        SELECT id
+        FROM device
+    ) THEN RAISE EXCEPTION 'Device serial does not exist';
+    END IF;
+
+    UPDATE device
+    SET firmware = fw
+    WHERE id = did;
+END $$;
+
+CREATE OR REPLACE FUNCTION make_reservations (
+    amount int,
+    client_name varchar(255),
+    reservation_type varchar(255),
+    lease int DEFAULT 3600
+) RETURNS TABLE (
+    device_id varchar(255),
+    worker_host varchar(255),
+    worker_port int
+) LANGUAGE plpgsql AS $$
+DECLARE amount_found int8;
+BEGIN
+    CREATE TEMPORARY TABLE res (
+        device_id varchar(255),
+        worker_host varchar(255),
+        worker_port int
+    ) ON COMMIT DROP;
+
+    INSERT INTO res(device_id, worker_host, worker_port)
+    SELECT device.id,
+        worker.host,
+        worker.port
+    FROM device
+        INNER JOIN worker ON worker.id = device.worker_id
+    WHERE device_status = 'available'
+        AND reservation_type = ANY(worker.reservables)
+        AND NOT worker.shutting_down
+    ORDER BY device.firmware IS NOT DISTINCT FROM reservation_type DESC
+    LIMIT amount;
+
+    SELECT COUNT(*) INTO amount_found FROM res;
+    IF amount_found != amount THEN
+        RAISE EXCEPTION 'Not enough devices';
+    END iF;
+
+    UPDATE device
+    SET device_status = 'reserved'
+    WHERE device.id IN (
+            SELECT res.device_id
+            FROM res
+        );
+
+    INSERT INTO reservations(device_id, client_id, until, lease_seconds)
+    SELECT res.device_id,
+        client_name,
+        CURRENT_TIMESTAMP + lease * interval '1 second',
+        lease
+    FROM res;
+
+    RETURN QUERY
+    SELECT *
+    FROM res;
+END $$;
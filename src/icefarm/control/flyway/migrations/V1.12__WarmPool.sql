@@ -0,0 +1,39 @@
+-- Idle devices are flashed ahead of time with the firmware of the reservables in demand.
+-- A device being flashed this way is 'warming' and returns to 'available' afterwards.
+ALTER TYPE devicestatus ADD VALUE 'warming';
+
+-- Marks an available device as warming. Returns false if the device is no longer available,
+-- e.g. because it was reserved in the meantime.
+CREATE FUNCTION start_device_warming(did varchar(255))
+RETURNS bool
+LANGUAGE plpgsql AS $$ BEGIN
+    UPDATE device
+    SET device_status = 'warming'
+    WHERE id = did
+        AND device_status = 'available';
+
+    RETURN FOUND;
+END $$;
+
+-- Returns the amount of idle devices of each worker that is not shutting down.
+CREATE FUNCTION get_idle_devices()
+RETURNS TABLE (
+    worker_id varchar(255),
+    host varchar(255),
+    port int,
+    reservables varchar(255)[],
+    idle int
+)
+LANGUAGE plpgsql AS $$ BEGIN
+    RETURN QUERY
+    SELECT worker.id,
+        worker.host,
+        worker.port,
+        worker.reservables,
+        COUNT(device.id)::int
+    FROM worker
+        LEFT JOIN device ON device.worker_id = worker.id
+            AND device.device_status IN ('available', 'warming')
+    WHERE NOT worker.shutting_down
+    GROUP BY worker.id;
+END $$;
@@ -0,0 +1,118 @@
+-- The idle period of reservations is set along with the reservations, so that a reservation
+-- never exists without its idle period.
+DROP FUNCTION make_reservations(int, varchar(255), varchar(255), int);
+DROP FUNCTION make_specific_reservations(varchar(255), varchar(255)[], varchar(255), int);
+
+CREATE FUNCTION make_reservations (
+    amount int,
+    client_name varchar(255),
+    reservation_type varchar(255),
+    lease int DEFAULT 3600,
+    idle int DEFAULT 0
+) RETURNS TABLE (
+    device_id varchar(255),
+    worker_host varchar(255),
+    worker_port int
+) LANGUAGE plpgsql AS $$
+DECLARE amount_found int8;
+BEGIN
+    CREATE TEMPORARY TABLE res (
+        device_id varchar(255),
+        worker_host varchar(255),
+        worker_port int
+    ) ON COMMIT DROP;
+
+    INSERT INTO res(device_id, worker_host, worker_port)
+    SELECT device.id,
+        worker.host,
+        worker.port
+    FROM device
+        INNER JOIN worker ON worker.id = device.worker_id
+    WHERE device_status = 'available'
+        AND reservation_type = ANY(worker.reservables)
+        AND NOT worker.shutting_down
+    ORDER BY device.firmware IS NOT DISTINCT FROM reservation_type DESC
+    LIMIT amount;
+
+    SELECT COUNT(*) INTO amount_found FROM res;
+    IF amount_found != amount THEN
+        RAISE EXCEPTION 'Not enough devices';
+    END iF;
+
+    UPDATE device
+    SET device_status = 'reserved'
+    WHERE device.id IN (
+            SELECT res.device_id
+            FROM res
+        );
+
+    INSERT INTO reservations(device_id, client_id, until, lease_seconds, idle_seconds)
+    SELECT res.device_id,
+        client_name,
+        CURRENT_TIMESTAMP + lease * interval '1 second',
+        lease,
+        idle
+    FROM res;
+
+    RETURN QUERY
+    SELECT *
+    FROM res;
+END $$;
+
+CREATE FUNCTION make_specific_reservations(
+    client_name varchar(255),
+    serial_ids varchar(255)[],
+    reservation_type varchar(255),
+    lease int DEFAULT 3600,
+    idle int DEFAULT 0
+)
+RETURNS TABLE (
+    device_id varchar(255),
+    worker_host varchar(255),
+    worker_port int
+) LANGUAGE plpgsql AS $$
+DECLARE amount_found int8;
+DECLARE expected int8;
+BEGIN
+    CREATE TEMPORARY TABLE res (
+        device_id varchar(255),
+        worker_host varchar(255),
+        worker_port int
+    ) ON COMMIT DROP;
+
+    INSERT INTO res(device_id, worker_host, worker_port)
+    SELECT device.id,
+        worker.host,
+        worker.port
+    FROM device
+        INNER JOIN worker ON worker.id = device.worker_id
+    WHERE device_status = 'available'
+        AND device.id = ANY(serial_ids)
+        AND reservation_type = ANY(worker.reservables)
+        AND NOT worker.shutting_down;
+
+    SELECT COUNT(*) INTO amount_found FROM res;
+    SELECT CARDINALITY(serial_ids) INTO expected;
+    IF amount_found != expected THEN
+        RAISE EXCEPTION 'Some serials not available';
+    END iF;
+
+    UPDATE device
+    SET device_status = 'reserved'
+    WHERE device.id IN (
+            SELECT res.device_id
+            FROM res
+        );
+
+    INSERT INTO reservations(device_id, client_id, until, lease_seconds, idle_seconds)
+    SELECT res.device_id,
+        client_name,
+        CURRENT_TIMESTAMP + lease * interval '1 second',
+        lease,
+        idle
+    FROM res;
+
+    RETURN QUERY
+    SELECT *
+    FROM res;
+END $$;
@@ -0,0 +1,99 @@
+CREATE INDEX device_status_idx ON device(device_status);
+CREATE INDEX device_worker_idx ON device(worker_id);
+
+CREATE FUNCTION get_device_summary()
+RETURNS TABLE (
+    total int8,
+    available int8,
+    reserved int8,
+    broken int8
+)
+LANGUAGE plpgsql AS $$ BEGIN
+    RETURN QUERY
+    SELECT COUNT(*),
+        COUNT(*) FILTER (WHERE device.device_status = 'available'),
+        COUNT(*) FILTER (WHERE device.device_status = 'reserved'),
+        COUNT(*) FILTER (WHERE device.device_status = 'broken')
+    FROM device;
+END $$;
+
+CREATE FUNCTION get_devices_page(
+    lim int,
+    offs int,
+    status_filter devicestatus,
+    worker_filter varchar(255)
+)
+RETURNS TABLE (
+    serial_id varchar(255),
+    worker_id varchar(255),
+    device_status devicestatus,
+    client_id varchar(255),
+    matching int8
+)
+LANGUAGE plpgsql AS $$ BEGIN
+    RETURN QUERY
+    SELECT dr.id,
+        dr.worker_id,
+        dr.device_status,
+        dr.client_id,
+        COUNT(*) OVER ()
+    FROM device_reservations AS dr
+    WHERE (status_filter IS NULL OR dr.device_status = status_filter)
+        AND (worker_filter IS NULL OR dr.worker_id = worker_filter)
+    ORDER BY dr.id
+    LIMIT lim
+    OFFSET offs;
+END $$;
+
+CREATE FUNCTION get_devices_by_id(serial_ids varchar(255) [])
+RETURNS TABLE (
+    serial_id varchar(255),
+    worker_id varchar(255),
+    device_status devicestatus,
+    client_id varchar(255)
+)
+LANGUAGE plpgsql AS $$ BEGIN
+    RETURN QUERY
+    SELECT dr.id,
+        dr.worker_id,
+        dr.device_status,
+        dr.client_id
+    FROM device_reservations AS dr
+    WHERE dr.id = ANY(serial_ids);
+END $$;
+
+-- Dashboard deltas only carry ids, the control server coalesces them
+-- and fetches the changed rows in bulk.
+CREATE OR REPLACE FUNCTION dashboard_device_update()
+RETURNS trigger
+AS $$ BEGIN
+    IF TG_TABLE_NAME = 'reservations' THEN
+        PERFORM pg_notify('dashboard_updates', json_build_object('kind', 'device', 'id', COALESCE(NEW.device_id, OLD.device_id))::text);
+    ELSE
+        PERFORM pg_notify('dashboard_updates', json_build_object('kind', 'device', 'id', COALESCE(NEW.id, OLD.id))::text);
+    END IF;
+    RETURN NULL;
+END; $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION dashboard_worker_update()
+RETURNS trigger
+AS $$ BEGIN
+    PERFORM pg_notify('dashboard_updates', json_build_object('kind', 'worker', 'id', COALESCE(NEW.id, OLD.id))::text);
+    RETURN NULL;
+END; $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER dashboard_device_trigger
+AFTER INSERT OR DELETE OR UPDATE OF device_status ON device
+FOR ROW
+EXECUTE FUNCTION dashboard_device_update();
+
+CREATE OR REPLACE TRIGGER dashboard_reservation_trigger
+AFTER INSERT OR DELETE OR UPDATE OF client_id ON reservations
+FOR ROW
+EXECUTE FUNCTION dashboard_device_update();
+
+-- heartbeat updates are excluded, they are not shown on the dashboard
+CREATE OR REPLACE TRIGGER dashboard_worker_trigger
+AFTER INSERT OR DELETE OR UPDATE OF host, port, farm_version, reservables, shutting_down ON worker
+FOR ROW
+EXECUTE FUNCTION dashboard_worker_update();
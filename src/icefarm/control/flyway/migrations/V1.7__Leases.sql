@@ -0,0 +1,192 @@
+-- Reservations are leases. A lease lasts lease_seconds unless renewed. Leases of clients
+-- with a connected control socket are renewed periodically by the control server and
+-- are shortened to a grace period once the socket disconnects.
+ALTER TABLE reservations
+ADD COLUMN lease_seconds int NOT NULL DEFAULT 3600;
+
+CREATE INDEX reservations_client_id_idx ON reservations(client_id);
+
+DROP FUNCTION make_reservations(int, varchar(255), varchar(255));
+DROP FUNCTION make_specific_reservations(varchar(255), varchar(255)[], varchar(255));
+DROP FUNCTION get_reservations_ending_soon(int);
+
+CREATE FUNCTION make_reservations (
+    amount int,
+    client_name varchar(255),
+    reservation_type varchar(255),
+    lease int DEFAULT 3600
+) RETURNS TABLE (
+    device_id varchar(255),
+    worker_host varchar(255),
+    worker_port int
+) LANGUAGE plpgsql AS $$
+DECLARE amount_found int8;
+BEGIN
+    CREATE TEMPORARY TABLE res (
+        device_id varchar(255),
+        worker_host varchar(255),
+        worker_port int
+    ) ON COMMIT DROP;
+
+    INSERT INTO res(device_id, worker_host, worker_port)
+    SELECT device.id,
+        worker.host,
+        worker.port
+    FROM device
+        INNER JOIN worker ON worker.id = device.worker_id
+    WHERE device_status = 'available'
+        AND reservation_type = ANY(worker.reservables)
+        AND NOT worker.shutting_down
+    LIMIT amount;
+
+    SELECT COUNT(*) INTO amount_found FROM res;
+    IF amount_found != amount THEN
+        RAISE EXCEPTION 'Not enough devices';
+    END iF;
+
+    UPDATE device
+    SET device_status = 'reserved'
+    WHERE device.id IN (
+            SELECT res.device_id
+            FROM res
+        );
+
+    INSERT INTO reservations(device_id, client_id, until, lease_seconds)
+    SELECT res.device_id,
+        client_name,
+        CURRENT_TIMESTAMP + lease * interval '1 second',
+        lease
+    FROM res;
+
+    RETURN QUERY
+    SELECT *
+    FROM res;
+END $$;
+
+CREATE FUNCTION make_specific_reservations(
+    client_name varchar(255),
+    serial_ids varchar(255)[],
+    reservation_type varchar(255),
+    lease int DEFAULT 3600
+)
+RETURNS TABLE (
+    device_id varchar(255),
+    worker_host varchar(255),
+    worker_port int
+) LANGUAGE plpgsql AS $$
+DECLARE amount_found int8;
+DECLARE expected int8;
+BEGIN
+    CREATE TEMPORARY TABLE res (
+        device_id varchar(255),
+        worker_host varchar(255),
+        worker_port int
+    ) ON COMMIT DROP;
+
+    INSERT INTO res(device_id, worker_host, worker_port)
+    SELECT device.id,
+        worker.host,
+        worker.port
+    FROM device
+        INNER JOIN worker ON worker.id = device.worker_id
+    WHERE device_status = 'available'
+        AND device.id = ANY(serial_ids)
+        AND reservation_type = ANY(worker.reservables)
+        AND NOT worker.shutting_down;
+
+    SELECT COUNT(*) INTO amount_found FROM res;
+    SELECT CARDINALITY(serial_ids) INTO expected;
+    IF amount_found != expected THEN
+        RAISE EXCEPTION 'Some serials not available';
+    END iF;
+
+    UPDATE device
+    SET device_status = 'reserved'
+    WHERE device.id IN (
+            SELECT res.device_id
+            FROM res
+        );
+
+    INSERT INTO reservations(device_id, client_id, until, lease_seconds)
+    SELECT res.device_id,
+        client_name,
+        CURRENT_TIMESTAMP + lease * interval '1 second',
+        lease
+    FROM res;
+
+    RETURN QUERY
+    SELECT *
+    FROM res;
+END $$;
+
+CREATE OR REPLACE FUNCTION extend_reservations(
+    client_name varchar(255),
+    serial_ids varchar(255) []
+)
+RETURNS TABLE (
+    device_id varchar(255)
+)
+LANGUAGE plpgsql AS $$ BEGIN
+    RETURN QUERY
+    UPDATE reservations
+    SET until = CURRENT_TIMESTAMP + reservations.lease_seconds * interval '1 second'
+    WHERE reservations.device_id = ANY(serial_ids)
+        AND client_id = client_name
+    RETURNING reservations.device_id;
+END $$;
+
+CREATE OR REPLACE FUNCTION extend_all_reservations(client_name varchar(255))
+RETURNS TABLE (
+    device_id varchar(255)
+    )
+LANGUAGE plpgsql AS $$ BEGIN
+    RETURN QUERY
+    UPDATE reservations
+    SET until = CURRENT_TIMESTAMP + reservations.lease_seconds * interval '1 second'
+    WHERE reservations.client_id = client_name
+    RETURNING reservations.device_id;
+END $$;
+
+-- Renews the leases of the clients. Leases are only written once less than half of the
+-- lease remains so that frequent renewals do not rewrite every reservation.
+CREATE FUNCTION renew_leases(client_ids varchar(255)[])
+RETURNS int
+LANGUAGE plpgsql AS $$
+DECLARE renewed int;
+BEGIN
+    UPDATE reservations
+    SET until = CURRENT_TIMESTAMP + reservations.lease_seconds * interval '1 second'
+    WHERE reservations.client_id = ANY(client_ids)
+        AND reservations.until < CURRENT_TIMESTAMP + reservations.lease_seconds * interval '1 second' / 2;
+
+    GET DIAGNOSTICS renewed = ROW_COUNT;
+    RETURN renewed;
+END $$;
+
+-- Shortens the leases of a client so that they expire after grace seconds unless renewed.
+CREATE FUNCTION expire_leases(client_name varchar(255), grace int)
+RETURNS int
+LANGUAGE plpgsql AS $$
+DECLARE expiring int;
+BEGIN
+    UPDATE reservations
+    SET until = CURRENT_TIMESTAMP + grace * interval '1 second'
+    WHERE reservations.client_id = client_name
+        AND reservations.until > CURRENT_TIMESTAMP + grace * interval '1 second';
+
+    GET DIAGNOSTICS expiring = ROW_COUNT;
+    RETURN expiring;
+END $$;
+
+-- Clients in excluded_clients have their leases renewed automatically and are not notified.
+CREATE FUNCTION get_reservations_ending_soon(mins int, excluded_clients varchar(255)[] DEFAULT '{}')
+RETURNS TABLE (
+    device_id varchar(255)
+)
+LANGUAGE plpgsql AS $$ BEGIN
+    RETURN QUERY
+    SELECT reservations.device_id
+    FROM reservations
+    WHERE reservations.until < CURRENT_TIMESTAMP + interval '1 second' * mins
+        AND reservations.client_id <> ALL(excluded_clients);
+END $$;
@@ -0,0 +1,86 @@
+-- Reservations with idle_seconds > 0 are released once their devices have had no activity
+-- for idle_seconds. Activity is reported in batches by the workers.
+ALTER TABLE reservations
+ADD COLUMN last_activity timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+ADD COLUMN idle_seconds int NOT NULL DEFAULT 0,
+ADD COLUMN idle_warned bool NOT NULL DEFAULT false;
+
+CREATE FUNCTION set_reservation_idle(
+    client_name varchar(255),
+    serial_ids varchar(255)[],
+    idle int
+)
+RETURNS TABLE (
+    device_id varchar(255)
+)
+LANGUAGE plpgsql AS $$ BEGIN
+    RETURN QUERY
+    UPDATE reservations
+    SET idle_seconds = idle,
+        last_activity = CURRENT_TIMESTAMP
+    WHERE reservations.device_id = ANY(serial_ids)
+        AND reservations.client_id = client_name
+    RETURNING reservations.device_id;
+END $$;
+
+CREATE PROCEDURE report_device_activity(serial_ids varchar(255)[])
+LANGUAGE plpgsql AS $$ BEGIN
+    UPDATE reservations
+    SET last_activity = CURRENT_TIMESTAMP,
+        idle_warned = false
+    WHERE reservations.device_id = ANY(serial_ids);
+END $$;
+
+-- Marks reservations that will be released in warn_before seconds as warned and returns them
+-- along with the seconds left until they are released.
+CREATE FUNCTION get_idle_warnings(warn_before int)
+RETURNS TABLE (
+    device_id varchar(255),
+    client_id varchar(255),
+    remaining int
+)
+LANGUAGE plpgsql AS $$ BEGIN
+    RETURN QUERY
+    UPDATE reservations
+    SET idle_warned = true
+    WHERE reservations.idle_seconds > 0
+        AND NOT reservations.idle_warned
+        AND reservations.last_activity < CURRENT_TIMESTAMP - GREATEST(reservations.idle_seconds - warn_before, 0) * interval '1 second'
+    RETURNING reservations.device_id,
+        reservations.client_id,
+        GREATEST(CEIL(EXTRACT(EPOCH FROM reservations.last_activity + reservations.idle_seconds * interval '1 second' - CURRENT_TIMESTAMP)), 0)::int;
+END $$;
+
+CREATE FUNCTION handle_idle_reservations()
+RETURNS TABLE (
+    device_id varchar(255),
+    client_id varchar(255)
+) LANGUAGE plpgsql AS $$ BEGIN
+    CREATE TEMPORARY TABLE res (
+       device_id varchar(255),
+       client_id varchar(255)
+    ) ON COMMIT DROP;
+
+    INSERT INTO res(device_id, client_id)
+    SELECT reservations.device_id, reservations.client_id
+    FROM reservations
+    WHERE reservations.idle_seconds > 0
+        AND reservations.last_activity < CURRENT_TIMESTAMP - reservations.idle_seconds * interval '1 second';
+
+    RETURN QUERY
+    SELECT res.device_id, res.client_id
+    FROM res;
+
+    DELETE FROM reservations
+    WHERE reservations.device_id IN (
+            SELECT res.device_id
+            FROM res
+        );
+
+    UPDATE device
+    SET device_status = 'await_flash_default'
+    WHERE device.id IN (
+            SELECT res.device_id
+            FROM res
+        );
+END $$;
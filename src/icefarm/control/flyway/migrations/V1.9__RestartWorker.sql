@@ -0,0 +1,48 @@
+-- Re-registers a worker after a restart. Devices in kept_devices that are still reserved keep
+-- their reservations so that the worker can resume them, every other device of the worker is
+-- removed. Returns the devices that were kept.
+CREATE FUNCTION restart_worker(
+    worker_name varchar(255),
+    host varchar(255),
+    port int,
+    farm_version varchar(255),
+    reservables varchar(255) [],
+    kept_devices varchar(255) []
+)
+RETURNS TABLE (
+    device_id varchar(255)
+)
+LANGUAGE plpgsql AS $$ BEGIN
+    IF NOT EXISTS (
+        SELECT 1
+        FROM worker
+        WHERE worker.id = worker_name
+    ) THEN
+        CALL add_worker(worker_name, host, port, farm_version, reservables);
+        RETURN;
+    END IF;
+
+    UPDATE worker
+    SET host = restart_worker.host,
+        port = restart_worker.port,
+        heartbeat = CURRENT_TIMESTAMP,
+        farm_version = restart_worker.farm_version,
+        reservables = restart_worker.reservables,
+        shutting_down = false
+    WHERE worker.id = worker_name;
+
+    DELETE FROM device
+    WHERE device.worker_id = worker_name
+        AND NOT (
+            device.id = ANY(kept_devices)
+            AND device.id IN (
+                SELECT reservations.device_id
+                FROM reservations
+            )
+        );
+
+    RETURN QUERY
+    SELECT device.id
+    FROM device
+    WHERE device.worker_id = worker_name;
+END $$;
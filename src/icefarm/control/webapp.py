@@ -1,14 +1,17 @@
 from __future__ import annotations
-from collections.abc import Iterator
-from dataclasses import dataclass
-import json
+from dataclasses import dataclass, asdict
 
 import flask
 
+from icefarm.utils import DeviceStatus
+
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from icefarm.control import ControlDatabase
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
 @dataclass
 class WorkerRow:
     name: str
@@ -24,66 +27,53 @@ class WorkerRow:
 
         return ", ".join(self.reservables_list)
 
-class Worker:
-    def __init__(self, rows: Iterator[WorkerRow]):
-        self.rows = list(rows)
-
-    @property
-    def online(self):
-        return len(self.rows)
-
-class DeviceRow:
-    def __init__(self, serial, worker, status, client_id):
-        self.serial = serial
-        self.worker = worker
-        self.status = status
-        self.client_id = client_id
-
-        js = "?json=" + json.dumps({
-            "serials": [self.serial],
-            "name": client_id
-        })
-
-        self.end_reservation = "./end" + js
-        self.reboot = "./reboot" + js
-        self.delete = "./delete" + js
-
-class Device:
-    def __init__(self, rows: Iterator[DeviceRow]):
-        self.rows = list(rows)
-
-    def filterStatus(self, status):
-        return len(list(filter(lambda d : d.status == status, self.rows)))
-
-    @property
-    def total(self):
-        return len(self.rows)
-
-    @property
-    def available(self):
-        return self.filterStatus("available")
-
-    @property
-    def reserved(self):
-        return self.filterStatus("reserved")
-
-    @property
-    def broken(self):
-        return self.filterStatus("broken")
-
-def build_page(database: ControlDatabase) -> str:
-    try:
-        if (worker_data := database.getWorkers()) is False:
-            raise Exception
-
-        worker = Worker(map(lambda r : WorkerRow(r["name"], f"http://{r["ip"]}:{r["port"]}", r["version"], r["shutting_down"], r["reservables"]), worker_data))
-
-        if (device_data := database.getDevices()) is False:
-            raise Exception
-
-        device = Device(map(lambda r : DeviceRow(r["serial"], r["worker"], r["status"], r["client_id"]), device_data))
-
-        return flask.render_template("home.html", workers=worker, devices=device)
-
-    except Exception:
-        return "Failed to fetch data"
+    def toJson(self) -> dict:
+        js = asdict(self)
+        js["reservables"] = self.reservables
+        del js["reservables_list"]
+        return js
+
+def build_workers(database: ControlDatabase) -> list[dict]:
+    """Returns the workers as shown on the dashboard, or False on error."""
+    if (worker_data := database.getWorkers()) is False:
+        return False
+
+    rows = map(lambda r : WorkerRow(r["name"], f"http://{r['ip']}:{r['port']}", r["version"], str(r["shutting_down"]), r["reservables"]), worker_data)
+    return [row.toJson() for row in rows]
+
+def build_state(database: ControlDatabase, version: str, limit: int=DEFAULT_PAGE_SIZE, offset: int=0, status: str=None, worker: str=None) -> dict:
+    """Builds the json state of the dashboard. Aggregates are computed by the database and only the
+    requested page of devices is fetched. Returns False on error. Raises ValueError on a bad filter or page."""
+    if status is not None and status not in DeviceStatus.__members__:
+        raise ValueError(f"unknown status {status}")
+
+    if limit < 1 or limit > MAX_PAGE_SIZE or offset < 0:
+        raise ValueError("bad page")
+
+    if (workers := build_workers(database)) is False:
+        return False
+
+    if (summary := database.getDeviceSummary()) is False:
+        return False
+
+    if (page := database.getDevicesPage(limit, offset, status=status, worker=worker)) is False:
+        return False
+
+    return {
+        "version": version,
+        "summary": summary,
+        "workers": workers,
+        "devices": page["devices"],
+        "page": {
+            "limit": limit,
+            "offset": offset,
+            "matching": page["matching"],
+            "status": status,
+            "worker": worker
+        }
+    }
+
+def build_page() -> str:
+    """Renders the dashboard. The page fetches its contents from the state endpoint and
+    receives updates through the control socket."""
+    return flask.render_template("home.html", page_size=DEFAULT_PAGE_SIZE, statuses=list(DeviceStatus.__members__))
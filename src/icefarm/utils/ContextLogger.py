@@ -0,0 +1,89 @@
+"""
+Loggers that carry context fields, such as the serial of a device, instead of stacking LoggerAdapters
+that each re-format the message. Binding a ContextLogger to a ContextLogger merges their fields
+and prefixes, so a record passes through a single adapter however deeply the context is nested, e.g.
+>>> device_logger = ContextLogger(manager_logger, "[ABCDEF]", serial="ABCDEF")
+>>> device_logger.debug("uploading bitstream %s", name, category="bitstream")
+
+Messages are only formatted once a record is going to be emitted, so hot paths should pass arguments
+rather than f-strings. Records with a category are additionally sampled, see set_sampling.
+"""
+from __future__ import annotations
+import itertools
+import logging
+from logging import LoggerAdapter
+
+CATEGORY_BITSTREAM = "bitstream"
+CATEGORY_EVENT = "event"
+
+# category -> (every, counter), only one in every records of the category is emitted
+_sampling: dict[str, tuple[int, itertools.count]] = {}
+
+def set_sampling(category: str, every: int):
+    """Emits only one in every records logged under category. Use 1 to emit every record."""
+    if every <= 1:
+        _sampling.pop(category, None)
+    else:
+        _sampling[category] = (every, itertools.count())
+
+def parse_sampling(value: str) -> dict[str, int]:
+    """Parses sampling rates formatted as category=every pairs separated by commas, e.g. bitstream=100,event=10."""
+    rates = {}
+    for pair in filter(None, (pair.strip() for pair in value.split(","))):
+        category, _, every = pair.partition("=")
+        rates[category.strip()] = int(every)
+
+    return rates
+
+def _sampled(category: str) -> bool:
+    if (rate := _sampling.get(category)) is None:
+        return True
+
+    every, counter = rate
+    return next(counter) % every == 0
+
+class ContextLogger(LoggerAdapter):
+    """LoggerAdapter that adds its fields to the extra of each record and prefix before the message.
+    Passing a ContextLogger as logger extends its context rather than wrapping it."""
+    def __init__(self, logger: logging.Logger | ContextLogger, prefix: str=None, **fields):
+        prefixes = (prefix,) if prefix else ()
+
+        if isinstance(logger, ContextLogger):
+            fields = {**logger.extra, **fields}
+            prefixes = logger.prefixes + prefixes
+            logger = logger.logger
+
+        super().__init__(logger, fields)
+        self.prefixes = prefixes
+        self.prefix = "".join(f"{prefix} " for prefix in prefixes)
+
+    def bind(self, prefix: str=None, **fields) -> ContextLogger:
+        """Returns a logger with additional context."""
+        return ContextLogger(self, prefix, **fields)
+
+    def process(self, msg, kwargs):
+        if (extra := kwargs.get("extra")):
+            kwargs["extra"] = {**self.extra, **extra}
+        else:
+            kwargs["extra"] = self.extra
+
+        return f"{self.prefix}{msg}", kwargs
+
+    def log(self, level, msg, *args, category: str=None, **kwargs):
+        if not self.isEnabledFor(level):
+            return
+
+        if category is not None and _sampling and not _sampled(category):
+            return
+
+        msg, kwargs = self.process(msg, kwargs)
+        self.logger.log(level, msg, *args, **kwargs)
+
+    # frequent levels are checked before the call is forwarded, so disabled records cost a single lookup
+    def debug(self, msg, *args, **kwargs):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.log(logging.DEBUG, msg, *args, **kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        if self.logger.isEnabledFor(logging.INFO):
+            self.log(logging.INFO, msg, *args, **kwargs)
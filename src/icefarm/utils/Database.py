@@ -12,6 +12,7 @@ class DeviceStatus(Enum):
     flashing_default = 3
     testing = 4
     broken = 5
+    warming = 6
 
 class Database:
     """Base database class that syncs postgres enums with psycopg"""
@@ -1,12 +1,63 @@
 from __future__ import annotations
+import concurrent.futures
 import logging
 import threading
-import json
+import os
+import struct
+import tempfile
+import uuid
+from collections import deque
 
 import psycopg
 from flask_socketio import SocketIO
 
 from .Database import Database
+from .Metrics import METRICS
+from .encoding import ENCODING_JSON, ENCODING_MSGPACK, encode, transcode, msgpack_frame
+
+# size cap of a coalesced frame, a message larger than this is sent in a frame on its own
+MAX_FRAME_BYTES = 1024 * 1024
+
+# bytes of messages a session holds in memory before spilling to disk
+DEFAULT_QUEUE_BYTES = 64 * 1024 * 1024
+# bytes a session may spill to disk, further messages are dropped
+DEFAULT_SPILL_BYTES = 1024 * 1024 * 1024
+DEFAULT_SPILL_DIR = os.path.join(tempfile.gettempdir(), "icefarm-sessions")
+# bytes of sent messages a session keeps until the client acknowledges them
+DEFAULT_RETAIN_BYTES = 16 * 1024 * 1024
+# time a flush waits for the event loop to hand an emitted frame to the socket
+EMIT_TIMEOUT_SECONDS = 10
+
+QUEUED_BYTES = METRICS.gauge("session_queued_bytes", "Bytes of messages waiting to be sent to a client", ["client"])
+SESSIONS = METRICS.gauge("event_sender_sessions", "Client sessions with a queue for their events")
+SPILLED_BYTES = METRICS.gauge("session_spilled_bytes", "Bytes of queued messages spilled to disk", ["client"])
+RETAINED_BYTES = METRICS.gauge("session_retained_bytes", "Bytes of sent messages waiting to be acknowledged", ["client"])
+DROPPED_MESSAGES = METRICS.counter("session_dropped_messages", "Messages dropped because the spill limit was reached", ["client"])
+
+# spill records are a length, a kind byte and the message
+_LENGTH = struct.Struct("!Ic")
+_TEXT = b"t"
+_BINARY = b"b"
+
+def coalesce(messages: list[str | bytes], max_bytes: int=MAX_FRAME_BYTES) -> list[list[str | bytes]]:
+    """Groups encoded messages into frames of at most max_bytes, keeping their order."""
+    frames = []
+    frame = []
+    size = 0
+
+    for message in messages:
+        if frame and size + len(message) > max_bytes:
+            frames.append(frame)
+            frame = []
+            size = 0
+
+        frame.append(message)
+        size += len(message) + 1
+
+    if frame:
+        frames.append(frame)
+
+    return frames
 
 class EventSenderLogger(logging.LoggerAdapter):
     def __init__(self, logger, extra=None):
@@ -15,6 +66,155 @@ class EventSenderLogger(logging.LoggerAdapter):
     def process(self, msg, kwargs):
         return f"[EventSender] {msg}", kwargs
 
+class SessionQueue:
+    """FIFO of encoded messages for a session. Up to max_bytes are held in memory, past that
+    messages are appended to a spill file until it is drained. Once a message is spilled, later
+    messages are spilled as well so that the order is kept. Not thread safe."""
+    def __init__(self, client_id: str, max_bytes: int=DEFAULT_QUEUE_BYTES, spill_dir: str=DEFAULT_SPILL_DIR, max_spill_bytes: int=DEFAULT_SPILL_BYTES):
+        self.client_id = client_id
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes
+
+        self.memory: deque[str | bytes] = deque()
+        self.memory_bytes = 0
+
+        self.spill_path = None
+        self.spill_file = None
+        self.spill_read_offset = 0
+        self.spill_count = 0
+        self.spill_bytes = 0
+
+    def __len__(self):
+        return len(self.memory) + self.spill_count
+
+    def __bool__(self):
+        return len(self) > 0
+
+    @property
+    def nbytes(self) -> int:
+        return self.memory_bytes + self.spill_bytes
+
+    @property
+    def backpressured(self) -> bool:
+        """Whether the queue is over its memory budget."""
+        return self.spill_count > 0
+
+    def append(self, message: str | bytes) -> bool:
+        """Queues a message. Returns False if it was dropped."""
+        if not self.spill_count and self.memory_bytes + len(message) <= self.max_bytes:
+            self.memory.append(message)
+            self.memory_bytes += len(message)
+        elif not self._spill(message):
+            DROPPED_MESSAGES.labels(self.client_id).inc()
+            return False
+
+        self._updateGauges()
+        return True
+
+    def prepend(self, messages: list[str | bytes]):
+        """Puts messages back at the front of the queue, used when sending fails.
+        These are kept in memory even if it goes over budget."""
+        self.memory.extendleft(reversed(messages))
+        self.memory_bytes += sum(map(len, messages))
+        self._updateGauges()
+
+    def take(self) -> list[str | bytes]:
+        """Removes and returns up to max_bytes of messages, at least one if the queue is not empty."""
+        messages = []
+        size = 0
+
+        while self.memory and (not messages or size + len(self.memory[0]) <= self.max_bytes):
+            message = self.memory.popleft()
+            self.memory_bytes -= len(message)
+            size += len(message)
+            messages.append(message)
+
+        if not self.memory and self.spill_count:
+            messages.extend(self._unspill(self.max_bytes - size, require=not messages))
+
+        self._updateGauges()
+        return messages
+
+    def clear(self):
+        """Drops every message and removes the spill file."""
+        self.memory.clear()
+        self.memory_bytes = 0
+        self._removeSpill()
+
+        QUEUED_BYTES.remove(self.client_id)
+        SPILLED_BYTES.remove(self.client_id)
+
+    def _spill(self, message: str | bytes) -> bool:
+        if isinstance(message, bytes):
+            data, kind = message, _BINARY
+        else:
+            data, kind = message.encode(), _TEXT
+
+        if self.spill_bytes + len(data) > self.max_spill_bytes:
+            return False
+
+        try:
+            if not self.spill_file:
+                os.makedirs(self.spill_dir, exist_ok=True)
+                self.spill_path = os.path.join(self.spill_dir, f"{uuid.uuid4().hex}.spill")
+                self.spill_file = open(self.spill_path, "w+b")
+                self.spill_read_offset = 0
+
+            self.spill_file.seek(0, os.SEEK_END)
+            self.spill_file.write(_LENGTH.pack(len(data), kind) + data)
+        except OSError:
+            return False
+
+        self.spill_count += 1
+        self.spill_bytes += len(data)
+        return True
+
+    def _unspill(self, budget: int, require: bool) -> list[str | bytes]:
+        """Reads spilled messages that fit in budget bytes. If require, at least one
+        message is read regardless of its size."""
+        messages = []
+        size = 0
+
+        self.spill_file.flush()
+        self.spill_file.seek(self.spill_read_offset)
+
+        while self.spill_count:
+            length, kind = _LENGTH.unpack(self.spill_file.read(_LENGTH.size))
+
+            if size + length > budget and not (require and not messages):
+                break
+
+            data = self.spill_file.read(length)
+            messages.append(data if kind == _BINARY else data.decode())
+            self.spill_read_offset += _LENGTH.size + length
+            self.spill_count -= 1
+            self.spill_bytes -= length
+            size += length
+
+        if not self.spill_count:
+            self._removeSpill()
+
+        return messages
+
+    def _removeSpill(self):
+        if self.spill_file:
+            self.spill_file.close()
+            try:
+                os.remove(self.spill_path)
+            except OSError:
+                pass
+
+        self.spill_file = None
+        self.spill_path = None
+        self.spill_count = 0
+        self.spill_bytes = 0
+        self.spill_read_offset = 0
+
+    def _updateGauges(self):
+        QUEUED_BYTES.labels(self.client_id).set(self.nbytes)
+        SPILLED_BYTES.labels(self.client_id).set(self.spill_bytes)
+
 class SessionLogger(logging.LoggerAdapter):
     def __init__(self, logger, client_id, extra = None):
         super().__init__(logger, extra)
@@ -24,16 +224,38 @@ class SessionLogger(logging.LoggerAdapter):
         return f"[{self.client_id}] {msg}", kwargs
 
 class Session:
-    def __init__(self, socketio: SocketIO, event_sender, logger: logging.Logger, client_id: str):
+    def __init__(self, socketio: SocketIO, event_sender, logger: logging.Logger, client_id: str, queue: SessionQueue=None, max_retain_bytes: int=DEFAULT_RETAIN_BYTES):
         self.socketio = socketio
         self.event_sender = event_sender
         self.logger = SessionLogger(logger, client_id)
         self.client_id = client_id
+        # identifies the sequence numbers of this session, a client that resumes with another
+        # session id has not received anything from this one
+        self.session_id = uuid.uuid4().hex
 
         self.sock_id = None
-        self.message_queue = []
+        # whether the socket accepts multiple messages per frame
+        self.frames = False
+        # whether the socket receives sequence numbered frames and acknowledges them
+        self.sequenced = False
+        # encoding of new messages, messages queued in another encoding are converted when sent
+        self.encoding = ENCODING_JSON
+        self.message_queue = queue or SessionQueue(client_id)
+
+        # sequence number of the next message taken from the queue
+        self.next_seq = 0
+        # messages sent to a sequenced socket that have not been acknowledged yet,
+        # retained[0] has sequence number retained_seq
+        self.retained: deque[str | bytes] = deque()
+        self.retained_seq = 0
+        self.retained_bytes = 0
+        self.max_retain_bytes = max_retain_bytes
 
         self.lock = threading.Lock()
+        # serializes flushes so that messages are emitted in order
+        self.flush_lock = threading.Lock()
+        # incremented for each socket that connects, only the latest one is attached
+        self.attaching = 0
         self.timeout = None
 
         self.startTimeout()
@@ -54,18 +276,61 @@ class Session:
             if self.timeout:
                 self.timeout.cancel()
 
-    def send(self, data: str):
+    def send(self, data: str | bytes):
         with self.lock:
-            self.message_queue.append(data)
+            if not self.message_queue.append(data):
+                self.logger.error("spill limit reached, dropped message")
         self.flush()
 
-    def setSocket(self, sock_id):
+    @property
+    def backpressured(self) -> bool:
+        """Whether messages are being produced faster than the client receives them."""
+        with self.lock:
+            return self.message_queue.backpressured
+
+    def close(self):
+        with self.lock:
+            self.message_queue.clear()
+            self.retained.clear()
+            self.retained_bytes = 0
+
+        RETAINED_BYTES.remove(self.client_id)
+
+    def setSocket(self, sock_id, frames: bool=False, resume: dict=None, encoding: str=ENCODING_JSON) -> threading.Thread:
+        """Attaches a socket. If resume is not None the socket receives sequenced frames, and
+        resume is the last {"session", "seq"} the client received. Messages are sent as msgpack
+        if encoding is ENCODING_MSGPACK, otherwise as json. The socket is attached and pending
+        messages are flushed from the returned thread, as this is called from the connect handler
+        while a flush to the previous socket may be waiting on the event loop to emit."""
         with self.lock:
-            self.sock_id = sock_id
-        self.logger.info("socket connected")
+            self.attaching += 1
+            attach = self.attaching
 
         self.stopTimeout()
-        self.flush()
+
+        thread = threading.Thread(target=self._attach, args=(attach, sock_id, frames, resume, encoding), name=f"socket-session-{self.client_id}-attach", daemon=True)
+        thread.start()
+        return thread
+
+    def _attach(self, attach: int, sock_id, frames: bool, resume: dict, encoding: str):
+        # wait for any flush to the previous socket so that everything it sent is retained
+        with self.flush_lock:
+            with self.lock:
+                if attach != self.attaching:
+                    # another socket connected in the meantime
+                    return
+
+                self.sock_id = sock_id
+                self.frames = frames
+                self.sequenced = resume is not None
+                self.encoding = ENCODING_MSGPACK if encoding == ENCODING_MSGPACK else ENCODING_JSON
+
+                if self.sequenced:
+                    self._resume(resume)
+            self.logger.info("socket connected")
+
+            while self._flushBatch():
+                pass
 
     def removeSocket(self):
         with self.lock:
@@ -74,36 +339,142 @@ class Session:
 
         self.startTimeout()
 
+    def ack(self, session_id: str, seq: int):
+        """Drops retained messages up to and including seq."""
+        with self.lock:
+            if session_id == self.session_id:
+                self._ack(seq)
+
+    def _ack(self, seq: int):
+        while self.retained and self.retained_seq <= seq:
+            message = self.retained.popleft()
+            self.retained_bytes -= len(message)
+            self.retained_seq += 1
+
+        RETAINED_BYTES.labels(self.client_id).set(self.retained_bytes)
+
+    def _retain(self, seq: int, messages: list[str | bytes]):
+        """Keeps sent messages starting at sequence number seq until they are acknowledged.
+        Past max_retain_bytes the oldest messages are dropped."""
+        if not self.retained:
+            self.retained_seq = seq
+
+        self.retained.extend(messages)
+        self.retained_bytes += sum(map(len, messages))
+
+        dropped = 0
+        while self.retained_bytes > self.max_retain_bytes and len(self.retained) > 1:
+            self.retained_bytes -= len(self.retained.popleft())
+            self.retained_seq += 1
+            dropped += 1
+
+        if dropped:
+            self.logger.warning(f"retain limit reached, {dropped} unacknowledged messages can no longer be resent")
+
+        RETAINED_BYTES.labels(self.client_id).set(self.retained_bytes)
+
+    def _resume(self, resume: dict):
+        """Requeues the retained messages the client has not received."""
+        acked = -1
+        if isinstance(resume, dict) and resume.get("session") == self.session_id and isinstance(resume.get("seq"), int):
+            acked = resume["seq"]
+
+            first = self.retained_seq if self.retained else self.next_seq
+            if first > acked + 1:
+                self.logger.warning(f"client missed {first - acked - 1} messages that are no longer retained")
+
+        self._ack(acked)
+
+        if self.retained:
+            self.logger.info(f"resending {len(self.retained)} unacknowledged messages")
+            self.message_queue.prepend(list(self.retained))
+            self.next_seq = self.retained_seq
+            self.retained.clear()
+            self.retained_bytes = 0
+            RETAINED_BYTES.labels(self.client_id).set(0)
+
+    def _encodeFrame(self, messages: list[str | bytes], encoding: str, seq: int=None) -> str | bytes:
+        """Joins encoded messages into a frame without decoding them. Sequenced frames carry
+        the session id and the sequence number of the first message."""
+        if encoding == ENCODING_MSGPACK:
+            return msgpack_frame(messages, None if seq is None else {"session": self.session_id, "seq": seq})
+
+        if seq is None:
+            return f"[{','.join(messages)}]"
+
+        return f'{{"session":"{self.session_id}","seq":{seq},"events":[{",".join(messages)}]}}'
+
     def flush(self):
+        with self.flush_lock:
+            while self._flushBatch():
+                pass
+
+    def _flushBatch(self) -> bool:
+        """Sends up to the queue's memory budget of messages. Returns whether there
+        may be more messages to send."""
         with self.lock:
             if not self.message_queue:
-                return
+                return False
 
             if not self.sock_id:
                 self.logger.warning("no socket to flush to")
-                return
+                return False
 
-            messages, self.message_queue = self.message_queue, []
+            messages = self.message_queue.take()
+            seq = self.next_seq
+            self.next_seq += len(messages)
             sock_id = self.sock_id
+            frames = self.frames
+            sequenced = self.sequenced
+            encoding = self.encoding
+
+        messages = [transcode(message, encoding) for message in messages]
+
+        if sequenced:
+            packets = []
+            for frame in coalesce(messages):
+                packets.append(("events", self._encodeFrame(frame, encoding, seq), seq, frame))
+                seq += len(frame)
+        elif frames:
+            packets = [("events", self._encodeFrame(frame, encoding), None, frame) for frame in coalesce(messages)]
+        else:
+            packets = [("event", message, None, [message]) for message in messages]
+
+        # from background threads the server returns futures for emits that run on the event loop,
+        # the frames are emitted together and then waited on in order
+        emits = []
+        for event, packet, _, _ in packets:
+            emits.append(self.socketio.emit(event, packet, to=sock_id))
+            self.socketio.sleep(0)
 
-        for message in messages:
+        for i, (emit, (_, _, frame_seq, frame_messages)) in enumerate(zip(emits, packets)):
             try:
-                self.socketio.emit("event", message, to=sock_id)
-                self.socketio.sleep(0)
-                self.logger.debug(f"flushed message {message} to client {self.client_id}")
+                if isinstance(emit, concurrent.futures.Future):
+                    emit.result(timeout=EMIT_TIMEOUT_SECONDS)
+                self.logger.debug("flushed %d messages to client %s", len(frame_messages), self.client_id)
             except Exception:
                 self.logger.warning("socket disconnected during flush")
-                self.logger.debug(f"failed to flush message {message} to client {self.client_id}")
+                # requeue the unsent messages ahead of anything queued since
+                unsent = [message for _, _, _, frame_messages in packets[i:] for message in frame_messages]
+                with self.lock:
+                    self.message_queue.prepend(unsent)
+                    self.next_seq -= len(unsent)
+                return False
+
+            if sequenced:
                 with self.lock:
-                    self.message_queue.append(message)
+                    self._retain(frame_seq, frame_messages)
 
-        self.logger.debug(f"flushed {len(messages)} events")
+        self.logger.debug("flushed %d events in %d frames", len(messages), len(packets))
+        return True
 
 class EventSender(Database):
-    def __init__(self, socketio: SocketIO, dburl: str, logger: logging.Logger):
+    def __init__(self, socketio: SocketIO, dburl: str, logger: logging.Logger, max_queue_bytes: int=DEFAULT_QUEUE_BYTES, spill_dir: str=DEFAULT_SPILL_DIR):
         super().__init__(dburl)
         self.socketio = socketio
         self.logger = EventSenderLogger(logger)
+        self.max_queue_bytes = max_queue_bytes
+        self.spill_dir = spill_dir
 
         self.sessions: dict[str, Session] = {}
         self.lock = threading.Lock()
@@ -111,15 +482,33 @@ class EventSender(Database):
     def startSession(self, client_id):
         with self.lock:
             if client_id not in self.sessions:
-                self.sessions[client_id] = Session(self.socketio, self, self.logger, client_id)
+                queue = SessionQueue(client_id, max_bytes=self.max_queue_bytes, spill_dir=self.spill_dir)
+                self.sessions[client_id] = Session(self.socketio, self, self.logger, client_id, queue=queue)
+                SESSIONS.set(len(self.sessions))
 
             return self.sessions.get(client_id)
 
         self.logger.info(f"started session {client_id}")
 
-    def addSocket(self, sock_id, client_id: str):
+    def addSocket(self, sock_id, client_id: str, frames: bool=False, resume: dict=None, encoding: str=ENCODING_JSON):
+        """Attaches a socket to the session of client_id. If frames, pending messages are
+        coalesced into 'events' frames rather than sent as individual 'event' frames. If resume
+        is provided, frames are sequenced and messages the client has not acknowledged are resent.
+        If encoding is 'msgpack', events are sent as msgpack rather than json."""
         session = self.startSession(client_id)
-        session.setSocket(sock_id)
+        session.setSocket(sock_id, frames=frames, resume=resume, encoding=encoding)
+
+    def ack(self, client_id: str, session_id: str, seq: int):
+        """Handles a client acknowledging the messages up to and including seq."""
+        if not isinstance(seq, int):
+            self.logger.warning(f"bad ack from {client_id}")
+            return
+
+        with self.lock:
+            session = self.sessions.get(client_id)
+
+        if session:
+            session.ack(session_id, seq)
 
     def removeSocket(self, client_id):
         with self.lock:
@@ -132,7 +521,32 @@ class EventSender(Database):
 
     def endSession(self, client_id):
         with self.lock:
-            self.sessions.pop(client_id, None)
+            session = self.sessions.pop(client_id, None)
+            SESSIONS.set(len(self.sessions))
+
+        if session:
+            session.close()
+
+    def isClientBackpressured(self, client_id: str) -> bool:
+        """Whether events for the client are queueing up faster than they are sent."""
+        with self.lock:
+            session = self.sessions.get(client_id)
+
+        return bool(session) and session.backpressured
+
+    def isSerialBackpressured(self, serial: str) -> bool:
+        """Whether events for the client that reserved serial are queueing up faster than they are sent."""
+        if not (client_id := self.__getReservationClientId(serial)):
+            return False
+
+        return self.isClientBackpressured(client_id)
+
+    def getConnectedClients(self) -> list[str]:
+        """Returns the client ids of the sessions that currently have a socket."""
+        with self.lock:
+            sessions = list(self.sessions.values())
+
+        return [session.client_id for session in sessions if session.sock_id]
 
     # TODO should probably use a database interface instead
     def __getReservationClientId(self, serial: str):
@@ -152,11 +566,11 @@ class EventSender(Database):
 
         return data[0][0]
 
-    def sendClient(self, client_id: str, contents: str):
+    def sendClient(self, client_id: str, contents: str | bytes):
         session = self.startSession(client_id)
         session.send(contents)
 
-    def sendSerial(self, serial, contents: str):
+    def sendSerial(self, serial, contents: str | bytes):
         client_id = self.__getReservationClientId(serial)
         if not client_id:
             self.logger.warning(f"tried to send event to {serial} but no reservation")
@@ -165,35 +579,46 @@ class EventSender(Database):
         return self.sendClient(client_id, contents)
 
     def sendAllJson(self, contents: dict):
-        if not (contents := self.__packageContents("meta", contents)):
-            return False
+        with self.lock:
+            sessions = list(self.sessions.values())
 
-        sessions = list(self.sessions.values())
+        # each encoding is only packaged once
+        packaged = {}
         for session in sessions:
-            session.send(contents)
+            if session.encoding not in packaged:
+                packaged[session.encoding] = self.__packageContents("meta", contents, session.encoding)
 
-    def __packageContents(self, serial: str, contents: dict):
+            if not packaged[session.encoding]:
+                return False
+
+            session.send(packaged[session.encoding])
+
+    def __packageContents(self, serial: str, contents: dict, encoding: str=ENCODING_JSON):
         contents = {
             "serial": serial,
             "contents": contents
         }
         try:
-            return json.dumps(contents)
+            return encode(contents, encoding)
         except Exception:
             return False
 
     def sendClientJson(self, serial: str, client_id: str, contents: dict) -> bool:
-        contents = self.__packageContents(serial, contents)
+        """Sends contents to client_id in the encoding the client negotiated."""
+        session = self.startSession(client_id)
+
+        contents = self.__packageContents(serial, contents, session.encoding)
         if not contents:
             return False
 
-        self.sendClient(client_id, contents)
+        session.send(contents)
         return True
 
     def sendSerialJson(self, serial: str, contents: dict) -> bool:
-        contents = self.__packageContents(serial, contents)
-        if not contents:
-            return False
+        client_id = self.__getReservationClientId(serial)
+        if not client_id:
+            self.logger.warning(f"tried to send event to {serial} but no reservation")
+            # only failures to encode the event are reported
+            return True
 
-        self.sendSerial(serial, contents)
-        return True
+        return self.sendClientJson(serial, client_id, contents)
@@ -0,0 +1,92 @@
+from __future__ import annotations
+import asyncio
+import logging
+from logging import LoggerAdapter
+import sys
+import threading
+import time
+import traceback
+
+from .Metrics import METRICS
+
+# how often the loop is sampled
+SAMPLE_INTERVAL_SECONDS = 0.25
+# lag at which the stack of the loop thread is logged
+LAG_THRESHOLD_SECONDS = 1.0
+
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+LOOP_LAG = METRICS.histogram("event_loop_lag_seconds", "Delay between when the event loop should have woken up and when it did", buckets=LAG_BUCKETS)
+LOOP_LAG_LAST = METRICS.gauge("event_loop_lag_last_seconds", "Most recently sampled event loop lag")
+LOOP_STALLS = METRICS.counter("event_loop_stalls", "Times the event loop was blocked for longer than the lag threshold")
+
+class LoopMonitorLogger(LoggerAdapter):
+    def process(self, msg, kwargs):
+        return f"[LoopMonitor] {msg}", kwargs
+
+class LoopMonitor:
+    """Measures the lag of an asyncio event loop by sleeping on it and timing how late it wakes up.
+    A watchdog thread checks that the sampler keeps running, and when the loop has been blocked past
+    threshold logs the stack of the loop thread, so blocking calls show up while they block."""
+    def __init__(self, loop: asyncio.AbstractEventLoop, logger: logging.Logger, interval: float=SAMPLE_INTERVAL_SECONDS, threshold: float=LAG_THRESHOLD_SECONDS):
+        self.loop = loop
+        self.logger = LoopMonitorLogger(logger)
+        self.interval = interval
+        self.threshold = threshold
+
+        self.lock = threading.Lock()
+        self.last_tick = time.monotonic()
+        self.loop_thread_id = None
+        # whether the current stall has already been logged
+        self.stalled = False
+        self.exiting = False
+
+        self.watchdog = threading.Thread(target=self._watch, name="loop-monitor-watchdog", daemon=True)
+
+    def start(self):
+        """Starts sampling, must be called from the loop thread."""
+        self.loop_thread_id = threading.get_ident()
+        self.loop.create_task(self._sample())
+        self.watchdog.start()
+
+    def exit(self):
+        self.exiting = True
+
+    async def _sample(self):
+        while not self.exiting:
+            start = self.loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, self.loop.time() - start - self.interval)
+
+            LOOP_LAG.observe(lag)
+            LOOP_LAG_LAST.set(lag)
+
+            with self.lock:
+                self.last_tick = time.monotonic()
+                stalled, self.stalled = self.stalled, False
+
+            if stalled:
+                self.logger.warning(f"event loop unblocked after {lag:.2f}s")
+            elif lag > self.threshold:
+                # too short for the watchdog to catch, the blocking call is already gone
+                LOOP_STALLS.inc()
+                self.logger.warning(f"event loop lagged {lag:.2f}s")
+
+    def _watch(self):
+        while not self.exiting:
+            time.sleep(self.interval)
+
+            if self.loop.is_closed() or not self.loop.is_running():
+                return
+
+            with self.lock:
+                blocked = time.monotonic() - self.last_tick - self.interval
+                if blocked <= self.threshold or self.stalled:
+                    continue
+
+                self.stalled = True
+
+            LOOP_STALLS.inc()
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "unavailable\n"
+            self.logger.warning(f"event loop blocked for {blocked:.2f}s, loop thread stack:\n{stack}")
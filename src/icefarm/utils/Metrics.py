@@ -0,0 +1,179 @@
+"""
+In-process metrics. Metrics are registered once on the global METRICS registry and
+updated with label values, e.g.
+>>> QUEUED = METRICS.gauge("session_queued_bytes", "Bytes queued for a client", ["client"])
+>>> QUEUED.labels("client-1").set(1024)
+"""
+from __future__ import annotations
+import bisect
+import threading
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, description: str, labelnames: list[str]):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+
+        self._lock = threading.Lock()
+        self._values: dict[tuple, float] = {}
+
+    def _key(self, labelvalues) -> tuple:
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+
+        return tuple(str(value) for value in labelvalues)
+
+    def remove(self, *labelvalues):
+        """Removes the value for the label values, e.g. once a client is gone."""
+        with self._lock:
+            self._values.pop(self._key(labelvalues), None)
+
+    def samples(self) -> list[tuple[dict, float]]:
+        """Returns the current values as a list of (labels, value)."""
+        with self._lock:
+            values = list(self._values.items())
+
+        return [(dict(zip(self.labelnames, key)), value) for key, value in values]
+
+class Counter(_Metric):
+    """Value that only increases."""
+    kind = "counter"
+
+    def labels(self, *labelvalues) -> _CounterChild:
+        return _CounterChild(self, self._key(labelvalues))
+
+    def inc(self, amount: float=1):
+        self.labels().inc(amount)
+
+class _CounterChild:
+    def __init__(self, metric: Counter, key: tuple):
+        self.metric = metric
+        self.key = key
+
+    def inc(self, amount: float=1):
+        with self.metric._lock:
+            self.metric._values[self.key] = self.metric._values.get(self.key, 0) + amount
+
+class Gauge(_Metric):
+    """Value that can go up and down."""
+    kind = "gauge"
+
+    def labels(self, *labelvalues) -> _GaugeChild:
+        return _GaugeChild(self, self._key(labelvalues))
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+class _GaugeChild:
+    def __init__(self, metric: Gauge, key: tuple):
+        self.metric = metric
+        self.key = key
+
+    def set(self, value: float):
+        with self.metric._lock:
+            self.metric._values[self.key] = value
+
+    def inc(self, amount: float=1):
+        with self.metric._lock:
+            self.metric._values[self.key] = self.metric._values.get(self.key, 0) + amount
+
+    def dec(self, amount: float=1):
+        self.inc(-amount)
+
+# upper bounds in seconds, suited to latencies between a millisecond and a few seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram(_Metric):
+    """Distribution of observed values. Values are {"count", "sum", "buckets"} where buckets
+    is a list of [upper bound, cumulative count], the last bound being "+Inf"."""
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labelnames: list[str], buckets: tuple=DEFAULT_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def labels(self, *labelvalues) -> _HistogramChild:
+        return _HistogramChild(self, self._key(labelvalues))
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def samples(self) -> list[tuple[dict, dict]]:
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+
+        samples = []
+        for key, counts, total in values:
+            cumulative = 0
+            buckets = []
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                buckets.append([bound, cumulative])
+
+            samples.append((dict(zip(self.labelnames, key)), {"count": cumulative, "sum": total, "buckets": buckets}))
+
+        return samples
+
+class _HistogramChild:
+    def __init__(self, metric: Histogram, key: tuple):
+        self.metric = metric
+        self.key = key
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.metric.buckets, value)
+
+        with self.metric._lock:
+            if (entry := self.metric._values.get(self.key)) is None:
+                entry = self.metric._values[self.key] = ([0] * (len(self.metric.buckets) + 1), 0)
+
+            counts, total = entry
+            counts[index] += 1
+            self.metric._values[self.key] = (counts, total + value)
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: dict[str, _Metric] = {}
+
+    def _register(self, cls, name: str, description: str, labelnames: list[str], **kwargs):
+        with self._lock:
+            if (metric := self._metrics.get(name)):
+                if not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                    raise ValueError(f"metric {name} already registered differently")
+
+                return metric
+
+            metric = cls(name, description, labelnames, **kwargs)
+            self._metrics[name] = metric
+            return metric
+
+    def counter(self, name: str, description: str, labelnames: list[str]=()) -> Counter:
+        return self._register(Counter, name, description, labelnames)
+
+    def gauge(self, name: str, description: str, labelnames: list[str]=()) -> Gauge:
+        return self._register(Gauge, name, description, labelnames)
+
+    def histogram(self, name: str, description: str, labelnames: list[str]=(), buckets: tuple=DEFAULT_BUCKETS) -> Histogram:
+        metric = self._register(Histogram, name, description, labelnames, buckets=buckets)
+        if metric.buckets != tuple(sorted(buckets)):
+            raise ValueError(f"metric {name} already registered differently")
+
+        return metric
+
+    def snapshot(self) -> dict:
+        """Returns every metric as {name: {type, description, samples: [{labels, value}]}}."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        return {
+            metric.name: {
+                "type": metric.kind,
+                "description": metric.description,
+                "samples": [{"labels": labels, "value": value} for labels, value in metric.samples()]
+            }
+            for metric in metrics
+        }
+
+METRICS = Registry()
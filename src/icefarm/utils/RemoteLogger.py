@@ -1,3 +1,6 @@
+import collections
+import gzip
+import json
 import threading
 import time
 import logging
@@ -5,40 +8,93 @@ from logging import Logger
 
 import requests
 
+from .Metrics import METRICS
+
+# records kept while the control server is unreachable, older records are dropped first
+MAX_RECORDS = 20000
+# a batch is sent early once this many records are waiting
+BATCH_RECORDS = 1000
+# messages are truncated to this many characters
+MAX_MESSAGE_CHARS = 4096
+
+BUFFERED_RECORDS = METRICS.gauge("remote_log_buffered_records", "Log records waiting to be sent to the control server")
+DROPPED_RECORDS = METRICS.counter("remote_log_dropped_records", "Log records dropped because the buffer was full")
+
 class RemoteLogger:
-    """Drop in replacement for a logging.Logger to also post to logs control server."""
-    def __init__(self, logger: Logger, control_server: str, client_name: str, interval: int=30):
+    """Drop in replacement for a logging.Logger to also post to logs control server. Records are kept in a
+    ring buffer of max_records and sent as gzip compressed batches every interval seconds, or as soon as
+    batch_records are waiting. Records dropped because the buffer was full are counted and reported with
+    the next batch."""
+    def __init__(self, logger: Logger, control_server: str, client_name: str, interval: int=10, max_records: int=MAX_RECORDS, batch_records: int=BATCH_RECORDS):
         self.logger: Logger = logger
 
         self.control_server = control_server
         self.client_name = client_name
         self.interval = interval
+        self.max_records = max_records
+        self.batch_records = batch_records
 
-        self._backlog = []
-        self._backlog_lock = threading.Lock()
+        self._backlog = collections.deque(maxlen=max_records)
+        self._dropped = 0
+        self._backlog_cv = threading.Condition()
+        self._session = requests.Session()
 
         self._thread = threading.Thread(target=self._send, name="remote-logger", daemon=True)
         self._thread.start()
 
     def _send(self):
         while True:
+            with self._backlog_cv:
+                self._backlog_cv.wait_for(lambda : len(self._backlog) >= self.batch_records, timeout=self.interval)
+
+            # keep sending while full batches are waiting, then wait for the next interval
+            while self._sendBatch() and len(self._backlog) >= self.batch_records:
+                pass
+
+    def _sendBatch(self) -> bool:
+        """Sends up to batch_records records. Returns whether records were sent. On failure, the
+        records are returned to the front of the buffer and sending backs off for an interval."""
+        with self._backlog_cv:
+            records = [self._backlog.popleft() for _ in range(min(self.batch_records, len(self._backlog)))]
+            dropped, self._dropped = self._dropped, 0
+
+        if not records and not dropped:
+            return False
+
+        body = gzip.compress(json.dumps({
+            "name": self.client_name,
+            "records": records,
+            "dropped": dropped
+        }).encode(), compresslevel=1)
+
+        try:
+            res = self._session.post(f"{self.control_server}/log", data=body, headers={
+                "Content-Type": "application/json",
+                "Content-Encoding": "gzip"
+            }, timeout=10)
+            if res.status_code != 200:
+                raise Exception
+        except Exception:
+            self.logger.error("[RemoteLogger] failed to send log results")
+            self._requeue(records, dropped)
             time.sleep(self.interval)
-            with self._backlog_lock:
-                logs = self._backlog
-                self._backlog = []
+            return False
 
-            if not logs:
-                continue
+        with self._backlog_cv:
+            BUFFERED_RECORDS.set(len(self._backlog))
 
-            try:
-                res = requests.get(f"{self.control_server}/log", json={
-                    "logs": logs,
-                    "name": self.client_name
-                }, timeout=10)
-                if res.status_code != 200:
-                    raise Exception
-            except Exception:
-                self.logger.error("[RemoteLogger] failed to send log results")
+        return True
+
+    def _requeue(self, records: list, dropped: int):
+        with self._backlog_cv:
+            combined = records + list(self._backlog)
+            overflow = max(0, len(combined) - self.max_records)
+
+            self._backlog = collections.deque(combined[overflow:], maxlen=self.max_records)
+            self._dropped += dropped + overflow
+
+        if overflow:
+            DROPPED_RECORDS.inc(overflow)
 
     def __getattr__(self, attr):
         # can't inherit from logging.Logger since its an externally managed singleton
@@ -46,8 +102,37 @@ class RemoteLogger:
 
     def log(self, level, msg, *args, **kwargs):
         self.logger.log(level, msg, *args, **kwargs)
-        with self._backlog_lock:
-            self._backlog.append((level, msg))
+
+        if not self.logger.isEnabledFor(level):
+            return
+
+        if args:
+            try:
+                msg = msg % args
+            except Exception:
+                pass
+
+        extra = kwargs.get("extra") or {}
+        record = {
+            "ts": time.time(),
+            "level": level,
+            "serial": extra.get("serial"),
+            "msg": str(msg)[:MAX_MESSAGE_CHARS]
+        }
+
+        with self._backlog_cv:
+            full = len(self._backlog) == self.max_records
+            self._backlog.append(record)
+            if full:
+                self._dropped += 1
+
+            buffered = len(self._backlog)
+            if buffered == self.batch_records:
+                self._backlog_cv.notify()
+
+        BUFFERED_RECORDS.set(buffered)
+        if full:
+            DROPPED_RECORDS.inc()
 
     def debug(self, msg, *args, **kwargs):
         self.log(logging.DEBUG, msg, *args, **kwargs)
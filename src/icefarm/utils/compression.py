@@ -0,0 +1,82 @@
+"""Compression of bitstreams sent from clients to workers. Workers advertise the codecs they support
+when a device is initialized and clients compress bitstreams with the first of their preferred codecs
+that the worker supports. zlib is always available, lz4 is used when the lz4 package is installed."""
+from __future__ import annotations
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# payloads sent by clients that did not negotiate compression
+CODEC_NONE = "none"
+CODEC_ZLIB = "zlib"
+CODEC_LZ4 = "lz4"
+
+# bitstreams are mostly runs of zeros, the fastest zlib level already shrinks them about 50 times
+ZLIB_LEVEL = 1
+
+# upper bound on the size of a decompressed bitstream, iCE40 bitstreams are around 104KB
+MAX_DECOMPRESSED_SIZE = 4 * 1024 * 1024
+
+class DecompressionError(Exception):
+    """Raised when a compressed payload is invalid, uses an unsupported codec or is too large."""
+
+def supported_codecs() -> list[str]:
+    """Returns the codecs that can be used in this process, in order of preference."""
+    codecs = [CODEC_ZLIB]
+    if lz4:
+        codecs.insert(0, CODEC_LZ4)
+
+    return codecs
+
+def choose_codec(offered: list[str]) -> str | None:
+    """Returns the preferred codec out of those offered by a worker, or None if none are supported."""
+    if not isinstance(offered, list):
+        return None
+
+    for codec in supported_codecs():
+        if codec in offered:
+            return codec
+
+    return None
+
+def compress(data: bytes, codec: str) -> bytes:
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data, ZLIB_LEVEL)
+
+    if codec == CODEC_LZ4 and lz4:
+        return lz4.frame.compress(data)
+
+    raise ValueError(f"unsupported codec {codec}")
+
+def decompress(data: bytes, codec: str, max_size: int=MAX_DECOMPRESSED_SIZE) -> bytes:
+    """Decompresses data, refusing payloads that expand past max_size."""
+    if codec == CODEC_NONE:
+        return data
+
+    try:
+        if codec == CODEC_ZLIB:
+            decompressor = zlib.decompressobj()
+            out = decompressor.decompress(data, max_size)
+            if decompressor.unconsumed_tail:
+                raise DecompressionError(f"payload expands past {max_size} bytes")
+            if not decompressor.eof:
+                raise DecompressionError("payload is truncated")
+
+            return out
+
+        if codec == CODEC_LZ4 and lz4:
+            decompressor = lz4.frame.LZ4FrameDecompressor()
+            out = decompressor.decompress(data, max_length=max_size)
+            if not decompressor.eof:
+                if len(out) >= max_size:
+                    raise DecompressionError(f"payload expands past {max_size} bytes")
+                raise DecompressionError("payload is truncated")
+
+            return out
+    except (zlib.error, RuntimeError) as e:
+        raise DecompressionError(f"invalid {codec} payload: {e}") from e
+
+    raise DecompressionError(f"unsupported codec {codec}")
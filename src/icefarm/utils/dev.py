@@ -1,11 +1,60 @@
 """
 A collection of functions for interacting with device files.
 """
+from __future__ import annotations
+from contextlib import contextmanager
 import os
 import re
 import subprocess
+import threading
+import time
+import typing
 
 import pyudev
+import serial
+
+from icefarm.utils.fat import FatVolume, FatError
+from icefarm.utils.Metrics import METRICS
+
+FLASH_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+FLASH_STAGE_SECONDS = METRICS.histogram("worker_flash_stage_seconds", "Time spent in each stage of flashing firmware, by flash method", ["method", "stage"], buckets=FLASH_BUCKETS)
+
+# flash methods, see upload_firmware_direct and upload_firmware_path
+FLASH_DIRECT = "direct"
+FLASH_MOUNT = "mount"
+FLASH_METHODS = (FLASH_DIRECT, FLASH_MOUNT)
+
+# files on the drive of a device in RP2 bootloader mode
+BOOTLOADER_FILES = ["INDEX.HTM", "INFO_UF2.TXT"]
+UF2_BLOCK_SIZE = 512
+UF2_MAGIC_START = b"UF2\n\x57\x51\x5d\x9e"
+UF2_MAGIC_END = b"\x30\x6f\xb1\x0a"
+
+_stage_listener = threading.local()
+
+@contextmanager
+def flash_stage(method: str, stage: str):
+    """Records the duration of a stage of flashing, whether or not it succeeds."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        FLASH_STAGE_SECONDS.labels(method, stage).observe(seconds)
+
+        if (listener := getattr(_stage_listener, "fn", None)):
+            listener(stage, seconds)
+
+@contextmanager
+def flash_stage_listener(fn: typing.Callable[[str, float], None]):
+    """Calls fn with the name and duration of every flash stage that finishes in this thread
+    until the context exits, e.g. to add them to the timeline of the device being flashed."""
+    previous = getattr(_stage_listener, "fn", None)
+    _stage_listener.fn = fn
+    try:
+        yield
+    finally:
+        _stage_listener.fn = previous
 
 def get_serial(dev):
     """Obtains the serial from a dev file dict. Returns false if the dev file 
@@ -55,7 +104,8 @@ def get_busid(dev_path: str) -> str:
 def mount(drive: str, loc: str, timeout: int=10) -> bool:
     """Mounts drive at location. Returns whether successful."""
     try:
-        subprocess.run(["sudo", "mount", drive, loc], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout, check=True)
+        with flash_stage(FLASH_MOUNT, "mount"):
+            subprocess.run(["sudo", "mount", drive, loc], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout, check=True)
     except Exception:
         return False
 
@@ -64,7 +114,8 @@ def mount(drive: str, loc: str, timeout: int=10) -> bool:
 def umount(loc: str) -> bool:
     """Unmounts at location. Returns whether successful."""
     try:
-        subprocess.run(["sudo", "umount", loc], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        with flash_stage(FLASH_MOUNT, "umount"):
+            subprocess.run(["sudo", "umount", loc], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
     except Exception:
         return False
 
@@ -73,16 +124,81 @@ def umount(loc: str) -> bool:
 def send_bootloader(path: str, timeout: int=10):
     """Connects with picocom using a 1200 baud at path. Returns whether successful."""
     try:
-        subprocess.run(["sudo", "picocom", "--baud", "1200", path], timeout=timeout, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        with flash_stage(FLASH_MOUNT, "bootloader"):
+            subprocess.run(["sudo", "picocom", "--baud", "1200", path], timeout=timeout, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
     except Exception:
         return False
 
     return True
 
+def touch_bootloader(path: str, timeout: int=10) -> bool:
+    """Sends a device to bootloader mode by opening its tty at path with a 1200 baud rate and
+    dropping DTR, like send_bootloader but without starting picocom. Returns whether successful."""
+    with flash_stage(FLASH_DIRECT, "bootloader"):
+        try:
+            port = serial.Serial(path, 1200, timeout=timeout, write_timeout=timeout)
+        except (serial.SerialException, OSError):
+            return False
+
+        try:
+            port.dtr = False
+            port.close()
+        except (serial.SerialException, OSError):
+            # the device may already be resetting
+            pass
+
+    return True
+
+def is_uf2(data: bytes) -> bool:
+    """Checks for whether data is made of UF2 blocks."""
+    if not data or len(data) % UF2_BLOCK_SIZE:
+        return False
+
+    return data[:8] == UF2_MAGIC_START and data[UF2_BLOCK_SIZE - 4:UF2_BLOCK_SIZE] == UF2_MAGIC_END
+
+def upload_firmware_direct(partition_path: str, firmware_path: str) -> bool:
+    """Writes firmware_path to the FAT filesystem of the partition of a device in bootloader mode,
+    without mounting it. Works on disk images as well as block devices. Returns whether successful."""
+    try:
+        with open(firmware_path, "rb") as f:
+            firmware = f.read()
+    except OSError:
+        return False
+
+    if not is_uf2(firmware):
+        return False
+
+    with flash_stage(FLASH_DIRECT, "open"):
+        try:
+            fd = os.open(partition_path, os.O_RDWR | getattr(os, "O_SYNC", 0))
+        except OSError:
+            return False
+
+    try:
+        with flash_stage(FLASH_DIRECT, "read"):
+            volume = FatVolume(fd)
+            files = volume.listdir()
+
+        if sorted(files) != BOOTLOADER_FILES:
+            return False
+
+        with flash_stage(FLASH_DIRECT, "write"):
+            volume.writeFile("firmware.uf2", firmware)
+    except (FatError, OSError):
+        return False
+    finally:
+        try:
+            os.close(fd)
+        except OSError:
+            # the device reboots once it has the whole file
+            pass
+
+    return True
+
 def get_devs():
     """Returns a dict mapping device serials to list of dev info dicts. This operation 
     looks through all available dev files and is intended to be only used once after reserving devices.
-    If you are dealing with frequent dev file changes, you should use a pyudev MonitorObserver instead."""
+    If you are dealing with frequent dev file changes, you should use a DeviceIndex instead."""
     out = {}
 
     context = pyudev.Context().list_devices()
@@ -104,6 +220,119 @@ def get_devs():
         out[serial].append(dev)
     return out
 
+# usb vendor ids of pico2-ice devices, in firmware and in bootloader mode
+VENDOR_IDS = ("2e8a", "1209")
+# subsystems of the dev files used by the worker, and the device type to match if any
+SUBSYSTEMS = (("tty", None), ("block", "partition"))
+# usb class and subclass of the DFU interface of the pico-ice firmware used by reservables,
+# which the default firmware does not have
+DFU_INTERFACE = "fe01"
+
+class DeviceIndex:
+    """In memory index of the pico2-ice dev files currently present, keyed by serial and by
+    usb interface. Intended to be kept current by a pyudev MonitorObserver through update, so that
+    lookups do not need to enumerate every device on the system like get_devs."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        # serial -> DEVPATH -> dev info
+        self._devs: dict[str, dict[str, dict]] = {}
+        # (serial, interface) -> tty dev info
+        self._ttys: dict[tuple[str, str], dict] = {}
+        # DEVPATH -> serial, for remove events that no longer carry the serial
+        self._serials: dict[str, str] = {}
+
+    def update(self, action: str, dev: dict) -> str | None:
+        """Applies a udev event to the index. Returns the serial of the dev file, or None
+        if it is not related to pico2-ice."""
+        devpath = dev.get("DEVPATH")
+        serial = get_serial(dev)
+
+        with self._lock:
+            if action == "remove":
+                serial = serial or self._serials.get(devpath)
+                if not serial:
+                    return None
+
+                self._serials.pop(devpath, None)
+                if (devs := self._devs.get(serial)) is not None:
+                    devs.pop(devpath, None)
+                    if not devs:
+                        del self._devs[serial]
+
+                key = (serial, dev.get("ID_USB_INTERFACE_NUM"))
+                if self._ttys.get(key, {}).get("DEVPATH") == devpath:
+                    del self._ttys[key]
+
+                return serial
+
+            if not serial or not devpath:
+                return None
+
+            self._serials[devpath] = serial
+            self._devs.setdefault(serial, {})[devpath] = dev
+            if dev.get("SUBSYSTEM") == "tty":
+                self._ttys[(serial, dev.get("ID_USB_INTERFACE_NUM"))] = dev
+
+            return serial
+
+    def get(self, serial: str) -> list[dict]:
+        """Returns the dev info dicts of serial."""
+        with self._lock:
+            return list(self._devs.get(serial, {}).values())
+
+    def tty(self, serial: str, interface: str="00") -> str | None:
+        """Returns the tty dev file of the interface of serial, or None."""
+        with self._lock:
+            dev = self._ttys.get((serial, interface))
+
+        return dev.get("DEVNAME") if dev else None
+
+    def interfaces(self, serial: str) -> list[str]:
+        """Returns the usb interface classes of serial as reported by udev, e.g. ['020200', '0a0000'].
+        Empty if the device has no tty or is in bootloader mode."""
+        with self._lock:
+            devs = [dev for (tty_serial, _), dev in self._ttys.items() if tty_serial == serial]
+
+        for dev in devs:
+            if (interfaces := dev.get("ID_USB_INTERFACES")):
+                return [interface for interface in interfaces.split(":") if interface]
+
+        return []
+
+    def serials(self) -> list[str]:
+        with self._lock:
+            return list(self._devs)
+
+    def clear(self):
+        with self._lock:
+            self._devs.clear()
+            self._ttys.clear()
+            self._serials.clear()
+
+DEVICE_INDEX = DeviceIndex()
+
+def list_pico_devices(context: pyudev.Context) -> typing.Iterator[pyudev.Device]:
+    """Enumerates the pico2-ice dev files, filtered by udev rather than in python."""
+    enumerator = context.list_devices()
+    for subsystem, _ in SUBSYSTEMS:
+        enumerator = enumerator.match_subsystem(subsystem)
+
+    for vendor_id in VENDOR_IDS:
+        enumerator = enumerator.match_property("ID_VENDOR_ID", vendor_id)
+
+    # enumeration can't match on device type, unlike the monitor
+    for dev in enumerator:
+        if any(dev.subsystem == subsystem and device_type in (None, dev.device_type) for subsystem, device_type in SUBSYSTEMS):
+            yield dev
+
+def monitor_pico_devices(context: pyudev.Context) -> pyudev.Monitor:
+    """Returns a netlink monitor that only receives events for the subsystems of pico2-ice dev files."""
+    monitor = pyudev.Monitor.from_netlink(context)
+    for subsystem, device_type in SUBSYSTEMS:
+        monitor.filter_by(subsystem, device_type)
+
+    return monitor
+
 def get_dev_paths():
     """Returns a dict mapping device serials to list of dev paths. This operation 
     looks through all available dev files and is intended to be only used once after reserving devices.
@@ -150,12 +379,13 @@ def upload_firmware_path(partition_path: str, mount_location: str, firmware_path
     if not mounted:
         return False
 
-    if os.listdir(mount_location) != ["INDEX.HTM", "INFO_UF2.TXT"]:
+    if os.listdir(mount_location) != BOOTLOADER_FILES:
         umount(mount_location)
         return False
 
     try:
-        subprocess.run(["sudo", "cp", firmware_path, mount_location], timeout=15, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with flash_stage(FLASH_MOUNT, "copy"):
+            subprocess.run(["sudo", "cp", firmware_path, mount_location], timeout=15, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     except Exception:
         umount(partition_path)
         raise FirmwareUploadFail()
@@ -0,0 +1,97 @@
+"""Encodings for events sent to clients. Events are json by default. Clients that negotiate msgpack
+receive msgpack encoded events, where arrays of unsigned 16 bit values such as waveform samples are
+packed as little endian buffers rather than lists of integers."""
+from __future__ import annotations
+import array
+import json
+import sys
+
+import msgpack
+
+ENCODING_JSON = "json"
+ENCODING_MSGPACK = "msgpack"
+
+# msgpack extension type of a little endian uint16 buffer
+UINT16_ARRAY_EXT = 1
+
+def uint16_array(values: list[int]) -> array.array | list[int]:
+    """Returns values as an unsigned 16 bit array so that it can be packed for msgpack clients.
+    Values that do not fit are returned as they are."""
+    try:
+        return array.array("H", values)
+    except (OverflowError, TypeError):
+        return values
+
+def json_default(obj):
+    if isinstance(obj, array.array):
+        return obj.tolist()
+
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def msgpack_default(obj):
+    if isinstance(obj, array.array) and obj.typecode == "H":
+        if sys.byteorder == "big":
+            obj = array.array("H", obj)
+            obj.byteswap()
+
+        return msgpack.ExtType(UINT16_ARRAY_EXT, obj.tobytes())
+
+    if isinstance(obj, array.array):
+        return obj.tolist()
+
+    raise TypeError(f"Object of type {type(obj).__name__} is not msgpack serializable")
+
+def msgpack_ext_hook(code: int, data: bytes):
+    if code == UINT16_ARRAY_EXT:
+        values = array.array("H")
+        values.frombytes(data)
+        if sys.byteorder == "big":
+            values.byteswap()
+
+        return values
+
+    return msgpack.ExtType(code, data)
+
+def packb(obj) -> bytes:
+    return msgpack.packb(obj, default=msgpack_default)
+
+def unpackb(data: bytes):
+    return msgpack.unpackb(data, ext_hook=msgpack_ext_hook)
+
+def dumps(obj) -> str:
+    return json.dumps(obj, default=json_default)
+
+def encode(obj, encoding: str) -> str | bytes:
+    """Encodes obj as a json string, or msgpack bytes if encoding is ENCODING_MSGPACK."""
+    if encoding == ENCODING_MSGPACK:
+        return packb(obj)
+
+    return dumps(obj)
+
+def decode(data: str | bytes):
+    """Decodes a message produced by encode, the encoding is determined by the type of data."""
+    if isinstance(data, (bytes, bytearray)):
+        return unpackb(data)
+
+    return json.loads(data)
+
+def transcode(message: str | bytes, encoding: str) -> str | bytes:
+    """Converts an encoded message to encoding, used for messages that were queued before
+    the client's encoding was known."""
+    if encoding == ENCODING_MSGPACK:
+        return message if isinstance(message, bytes) else packb(json.loads(message))
+
+    return message if isinstance(message, str) else dumps(unpackb(message))
+
+def msgpack_frame(messages: list[bytes], fields: dict=None) -> bytes:
+    """Joins msgpack encoded messages into an array without decoding them. If fields is
+    provided, the frame is a map of fields along with the array under "events"."""
+    packer = msgpack.Packer()
+    events = packer.pack_array_header(len(messages)) + b"".join(messages)
+
+    if fields is None:
+        return events
+
+    header = packer.pack_map_header(len(fields) + 1)
+    header += b"".join(packer.pack(key) + packer.pack(value) for key, value in fields.items())
+    return header + packer.pack("events") + events
@@ -0,0 +1,198 @@
+"""
+Reads and writes files on FAT12 and FAT16 volumes without mounting them, e.g. the drive of a
+device in RP2 bootloader mode or a disk image.
+"""
+from __future__ import annotations
+from datetime import datetime
+import math
+import os
+import struct
+
+DIR_ENTRY_SIZE = 32
+ATTR_VOLUME_ID = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_LONG_NAME = 0x0F
+ENTRY_FREE = 0xE5
+ENTRY_END = 0x00
+
+class FatError(Exception):
+    def __init__(self, *args):
+        super().__init__(*args)
+
+def to_short_name(name: str) -> bytes:
+    """Converts a file name to its 11 byte 8.3 directory entry form."""
+    base, _, ext = name.upper().rpartition(".") if "." in name else (name.upper(), "", "")
+    if not base or len(base) > 8 or len(ext) > 3 or any(c in base + ext for c in ' ."*/:<>?\\|+,;=[]'):
+        raise FatError(f"{name} is not a valid 8.3 file name")
+
+    return base.ljust(8).encode("ascii") + ext.ljust(3).encode("ascii")
+
+def from_short_name(raw: bytes) -> str:
+    base = raw[:8].decode("ascii", "replace").rstrip()
+    ext = raw[8:].decode("ascii", "replace").rstrip()
+    return f"{base}.{ext}" if ext else base
+
+def dos_timestamp(time: datetime) -> tuple[int, int]:
+    """Returns the (date, time) of a directory entry."""
+    date = ((max(time.year, 1980) - 1980) << 9) | (time.month << 5) | time.day
+    return date, (time.hour << 11) | (time.minute << 5) | (time.second // 2)
+
+class FatVolume:
+    """A FAT12 or FAT16 volume at the start of a file descriptor. Only the root directory is
+    supported, which is all the RP2 bootloader drive has. Files are written with pwrite so that
+    nothing is cached between calls."""
+    def __init__(self, fd: int):
+        self.fd = fd
+
+        boot = self._read(0, 512)
+        if boot[510:512] != b"\x55\xaa":
+            raise FatError("missing boot sector signature")
+
+        (self.bytes_per_sector, self.sectors_per_cluster, self.reserved_sectors, self.fat_count,
+         self.root_entries, total_sectors16, _, self.fat_sectors) = struct.unpack_from("<HBHBHHBH", boot, 11)
+        total_sectors = total_sectors16 or struct.unpack_from("<I", boot, 32)[0]
+
+        if not self.bytes_per_sector or not self.sectors_per_cluster or not self.fat_sectors:
+            raise FatError("not a FAT12 or FAT16 volume")
+
+        self.fat_offset = self.reserved_sectors * self.bytes_per_sector
+        self.root_offset = self.fat_offset + self.fat_count * self.fat_sectors * self.bytes_per_sector
+        root_sectors = math.ceil(self.root_entries * DIR_ENTRY_SIZE / self.bytes_per_sector)
+        self.data_sector = self.reserved_sectors + self.fat_count * self.fat_sectors + root_sectors
+        self.cluster_size = self.sectors_per_cluster * self.bytes_per_sector
+        self.cluster_count = (total_sectors - self.data_sector) // self.sectors_per_cluster
+
+        if self.cluster_count < 4085:
+            self.fat_bits = 12
+        elif self.cluster_count < 65525:
+            self.fat_bits = 16
+        else:
+            raise FatError("FAT32 volumes are not supported")
+
+        self.end_of_chain = (1 << self.fat_bits) - 1
+        self.fat = bytearray(self._read(self.fat_offset, self.fat_sectors * self.bytes_per_sector))
+
+    def _read(self, offset: int, length: int) -> bytes:
+        data = os.pread(self.fd, length, offset)
+        if len(data) != length:
+            raise FatError(f"short read at {offset}")
+
+        return data
+
+    def _write(self, offset: int, data: bytes):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self.fd, view, offset)
+            view = view[written:]
+            offset += written
+
+    def _getEntry(self, cluster: int) -> int:
+        if self.fat_bits == 16:
+            return struct.unpack_from("<H", self.fat, cluster * 2)[0]
+
+        value = struct.unpack_from("<H", self.fat, cluster * 3 // 2)[0]
+        return value >> 4 if cluster & 1 else value & 0xFFF
+
+    def _setEntry(self, cluster: int, value: int) -> tuple[int, int]:
+        """Sets the FAT entry of cluster. Returns the range of FAT bytes that changed."""
+        if self.fat_bits == 16:
+            struct.pack_into("<H", self.fat, cluster * 2, value)
+            return cluster * 2, cluster * 2 + 2
+
+        offset = cluster * 3 // 2
+        current = struct.unpack_from("<H", self.fat, offset)[0]
+        if cluster & 1:
+            current = (current & 0x000F) | (value << 4)
+        else:
+            current = (current & 0xF000) | value
+        struct.pack_into("<H", self.fat, offset, current)
+        return offset, offset + 2
+
+    def _chain(self, cluster: int) -> list[int]:
+        chain = []
+        while 2 <= cluster < self.cluster_count + 2 and len(chain) <= self.cluster_count:
+            chain.append(cluster)
+            cluster = self._getEntry(cluster)
+
+        return chain
+
+    def _clusterOffset(self, cluster: int) -> int:
+        return (self.data_sector + (cluster - 2) * self.sectors_per_cluster) * self.bytes_per_sector
+
+    def _entries(self) -> list[tuple[int, bytes]]:
+        """Returns the (offset, raw entry) of each root directory slot up to the end marker."""
+        root = self._read(self.root_offset, self.root_entries * DIR_ENTRY_SIZE)
+        entries = []
+        for i in range(self.root_entries):
+            entry = root[i * DIR_ENTRY_SIZE:(i + 1) * DIR_ENTRY_SIZE]
+            entries.append((self.root_offset + i * DIR_ENTRY_SIZE, entry))
+            if entry[0] == ENTRY_END:
+                break
+
+        return entries
+
+    @staticmethod
+    def _isFile(entry: bytes) -> bool:
+        return entry[0] not in (ENTRY_END, ENTRY_FREE) and entry[11] != ATTR_LONG_NAME and not entry[11] & (ATTR_VOLUME_ID | ATTR_DIRECTORY)
+
+    def listdir(self) -> list[str]:
+        """Returns the names of the files in the root directory."""
+        return [from_short_name(entry[:11]) for _, entry in self._entries() if self._isFile(entry)]
+
+    def readFile(self, name: str) -> bytes:
+        short_name = to_short_name(name)
+        for _, entry in self._entries():
+            if self._isFile(entry) and entry[:11] == short_name:
+                cluster, size = struct.unpack_from("<HI", entry, 26)
+                data = b"".join(self._read(self._clusterOffset(c), self.cluster_size) for c in self._chain(cluster))
+                return data[:size]
+
+        raise FileNotFoundError(name)
+
+    def writeFile(self, name: str, data: bytes):
+        """Writes data to a new file in the root directory, replacing any file of the same name.
+        The FAT and directory entry are written before the data, since the RP2 bootloader reboots
+        as soon as it has received the last block of a UF2 file."""
+        short_name = to_short_name(name)
+
+        slot = None
+        replaced = set()
+        for offset, entry in self._entries():
+            if self._isFile(entry) and entry[:11] == short_name:
+                replaced = set(self._chain(struct.unpack_from("<H", entry, 26)[0]))
+                slot = offset
+                break
+
+            if slot is None and entry[0] in (ENTRY_END, ENTRY_FREE):
+                slot = offset
+
+        if slot is None:
+            raise FatError("root directory is full")
+
+        needed = math.ceil(len(data) / self.cluster_size)
+        clusters = [cluster for cluster in range(2, self.cluster_count + 2) if cluster in replaced or self._getEntry(cluster) == 0][:needed]
+        if len(clusters) < needed:
+            raise FatError("not enough free space")
+
+        changed = [self._setEntry(cluster, 0) for cluster in replaced]
+        for cluster, next_cluster in zip(clusters, clusters[1:] + [self.end_of_chain]):
+            changed.append(self._setEntry(cluster, next_cluster))
+
+        if changed:
+            start = min(start for start, _ in changed)
+            end = max(end for _, end in changed)
+            for i in range(self.fat_count):
+                self._write(self.fat_offset + i * self.fat_sectors * self.bytes_per_sector + start, self.fat[start:end])
+
+        date, time = dos_timestamp(datetime.now())
+        entry = struct.pack("<11sBBBHHHHHHHI", short_name, ATTR_ARCHIVE, 0, 0, time, date, date, 0, time, date, clusters[0] if clusters else 0, len(data))
+        self._write(slot, entry)
+
+        # contiguous clusters are written at once
+        run_start = 0
+        for i in range(1, len(clusters) + 1):
+            if i == len(clusters) or clusters[i] != clusters[i - 1] + 1:
+                chunk = data[run_start * self.cluster_size:i * self.cluster_size]
+                self._write(self._clusterOffset(clusters[run_start]), chunk)
+                run_start = i
@@ -108,8 +108,11 @@ def typecheck(fn, args) -> bool:
 
     return True
 
-def json_to_args(json, parameters):
-    values = list(map(json.get, parameters))
+def json_to_args(json, parameters, defaults: dict=None):
+    """Maps json values to a list of arguments by parameter name. Missing values are taken
+    from defaults if present. Returns False if a value is missing."""
+    defaults = defaults or {}
+    values = list(map(lambda param : json.get(param, defaults.get(param)), parameters))
     if any(map(lambda x : x is None, values)):
         return False
 
@@ -1,23 +1,35 @@
 import asyncio
+import collections
+import concurrent.futures
+import functools
 import inspect
 import json
+import logging
+import threading
+import time
 from functools import wraps
 
 from flask import Response, jsonify, request
 from socketio import AsyncServer
 
 from .utils import json_to_args, typecheck
+from .LoopMonitor import LoopMonitor, LAG_THRESHOLD_SECONDS
+from .Metrics import METRICS
 
 def inject_and_return_json(func):
-    """Injects request json values into arguments. Uses argument names as the json key. Typechecks arguments,
-    only classes are supported. Returns a status=400 if a key is missing or the typecheck fails.
-    Returns status=200 on True and status=500 on false. Otherwise, returns flask.jsonify of the result."""
+    """Injects request json values into arguments. Uses argument names as the json key. Arguments with a default
+    value are optional. Typechecks arguments, only classes are supported. Returns a status=400 if a key is missing
+    or the typecheck fails. Returns status=200 on True and status=500 on false. Otherwise, returns flask.jsonify of the result."""
     parameter_strings = [] # func args as string
+    defaults = {}
     parameters = inspect.signature(func).parameters.values()
 
     for param in parameters:
         parameter_strings.append(param.name)
 
+        if param.default is not inspect.Parameter.empty:
+            defaults[param.name] = param.default
+
     @wraps(func)
     def handler_wrapper(*args):
         if request.content_type == "application/json":
@@ -31,9 +43,9 @@ def inject_and_return_json(func):
             except Exception:
                 return Response(status=400)
 
-        args = json_to_args(js, parameter_strings)
+        args = json_to_args(js, parameter_strings, defaults)
 
-        if not typecheck(func, args):
+        if args is False or not typecheck(func, args):
             return Response(status=400)
 
         res = func(*args)
@@ -49,16 +61,24 @@ def inject_and_return_json(func):
 def flask_socketio_adapter_connect(func):
     """Adapter to allow flask_socketio.SocketIO eventhandlers to use the same interface as
     socketio.AsyncServer for @socketio.on("connect"). This is
-    achieved by injecting an empty environment argument."""
+    achieved by injecting the environment of the request."""
     @wraps(func)
     def event_handler(*args):
         if len(args) == 1:
-            return func(request.sid, {}, args[0])
+            return func(request.sid, request.environ, args[0])
 
         return func(*args)
 
     return event_handler
 
+def get_remote_addr(environ: dict) -> str:
+    """Returns the address a socket connected from. The asgi driver of engineio always sets
+    REMOTE_ADDR to 127.0.0.1, so the client of the asgi scope is preferred."""
+    if (client := environ.get("asgi.scope", {}).get("client")):
+        return client[0]
+
+    return environ.get("REMOTE_ADDR")
+
 def flask_socketio_adapter_on(func):
     """Adapter to allow flask_socketio.SocketIO eventhandlers to use the same interface as
     socketio.AsyncServer for @socketio.on events. If only one argument is passed, request.sid is
@@ -73,22 +93,143 @@ def flask_socketio_adapter_on(func):
 
     return event_handler
 
+# emits from background threads that may be waiting on the event loop before emitting blocks
+MAX_PENDING_EMITS = 1024
+
+HANDLER_SECONDS = METRICS.histogram("socket_handler_seconds", "Time spent in socket event handlers on the event loop", ["event"])
+
 class SyncAsyncServer(AsyncServer):
     """Adapter to allow flask_socketio.SocketIO to have the same interface as socketio.AsyncServer while
     running as an ASGI app. Handles both calls from background threads (no event loop) and calls
-    from within the event loop thread (e.g. socket connect/disconnect handlers)."""
+    from within the event loop thread (e.g. socket connect/disconnect handlers).
+
+    The event loop of the server is captured on the first request. Emits from background threads are
+    handed to that loop through a queue and started in order by a single task, rather than running each
+    emit in a new event loop. Once max_pending_emits are waiting, emitting threads block until the
+    loop catches up.
+
+    The lag of the loop and the time spent in event handlers are recorded in METRICS. If loop_logger
+    is provided, the stack of the loop thread is logged to it whenever the loop is blocked for longer
+    than lag_threshold seconds."""
+    def __init__(self, *args, max_pending_emits: int=MAX_PENDING_EMITS, loop_logger: logging.Logger=None, lag_threshold: float=LAG_THRESHOLD_SECONDS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._loop_logger = loop_logger or self.logger
+        self._lag_threshold = lag_threshold
+        self._loop_monitor: LoopMonitor = None
+        self._loop: asyncio.AbstractEventLoop = None
+        self._emit_ready: asyncio.Event = None
+        self._emit_queue: collections.deque = collections.deque()
+        self._pending_emits = threading.Semaphore(max_pending_emits)
+        self._loop_lock = threading.Lock()
+        # whether the drain task has already been woken for the queued emits
+        self._wakeup_scheduled = False
+
+    async def handle_request(self, *args, **kwargs):
+        if self._loop is None:
+            self._attachLoop(asyncio.get_running_loop())
+
+        return await super().handle_request(*args, **kwargs)
+
+    def _attachLoop(self, loop: asyncio.AbstractEventLoop):
+        with self._loop_lock:
+            if self._loop is not None:
+                return
+
+            self._emit_ready = asyncio.Event()
+            self._loop = loop
+            loop.create_task(self._drainEmits())
+
+            self._loop_monitor = LoopMonitor(loop, self._loop_logger, threshold=self._lag_threshold)
+            self._loop_monitor.start()
+
+    async def _trigger_event(self, event, namespace, *args):
+        # sync handlers block the loop for their whole duration, unknown events share a label
+        label = event if event in self.handlers.get(namespace, {}) else "unhandled"
+        start = time.perf_counter()
+        try:
+            return await super()._trigger_event(event, namespace, *args)
+        finally:
+            HANDLER_SECONDS.labels(label).observe(time.perf_counter() - start)
+
+    async def _drainEmits(self):
+        while True:
+            await self._emit_ready.wait()
+
+            with self._loop_lock:
+                self._emit_ready.clear()
+                self._wakeup_scheduled = False
+
+            # emits yield to the event loop, so they are started together rather than awaited
+            # one at a time. Tasks start in the order they are created which preserves the order
+            # of events sent to a socket.
+            while self._emit_queue:
+                coro, future = self._emit_queue.popleft()
+                task = asyncio.ensure_future(coro)
+                task.add_done_callback(functools.partial(self._emitDone, future))
+
+    def _emitDone(self, future: concurrent.futures.Future, task: asyncio.Task):
+        self._pending_emits.release()
+
+        if task.cancelled():
+            future.cancel()
+        elif (e := task.exception()):
+            self.logger.warning(f"failed to emit from background thread: {e}")
+            future.set_exception(e)
+        else:
+            future.set_result(task.result())
+
+    def _runThreadsafe(self, coro) -> concurrent.futures.Future:
+        self._pending_emits.acquire()
+        future = concurrent.futures.Future()
+
+        with self._loop_lock:
+            self._emit_queue.append((coro, future))
+
+            # waking the loop requires a syscall, only do so if the drain task is not already awake
+            if self._wakeup_scheduled:
+                return future
+
+            self._wakeup_scheduled = True
+
+        try:
+            self._loop.call_soon_threadsafe(self._emit_ready.set)
+        except RuntimeError as e:
+            # loop closed during shutdown, drop everything that was queued
+            with self._loop_lock:
+                dropped, self._emit_queue = self._emit_queue, collections.deque()
+
+            for dropped_coro, dropped_future in dropped:
+                self._pending_emits.release()
+                dropped_coro.close()
+                dropped_future.set_exception(e)
+
+        return future
+
     def _run_coro(self, coro):
         try:
             asyncio.get_running_loop()
         except RuntimeError:
-            # No running event loop (background thread) — safe to use asyncio.run()
-            return asyncio.run(coro)
+            pass
         else:
             # Already in the event loop — schedule without blocking
             return asyncio.ensure_future(coro)
 
+        if self._loop is None:
+            # No request has reached the server yet so there are no sockets to emit to
+            return asyncio.run(coro)
+
+        return self._runThreadsafe(coro)
+
     def emit(self, event, data=None, to=None, room=None, skip_sid=None, namespace=None, callback=None, ignore_queue=False):
+        """Emits an event. From a background thread, returns a concurrent.futures.Future that
+        completes once the event has been handed to the socket."""
         return self._run_coro(super().emit(event, data, to, room, skip_sid, namespace, callback, ignore_queue))
 
     def sleep(self, seconds=0):
-        return self._run_coro(super().sleep(seconds))
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # background threads are not running on the event loop, there is nothing to yield to
+            return time.sleep(seconds)
+
+        return asyncio.ensure_future(super().sleep(seconds))
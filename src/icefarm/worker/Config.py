@@ -4,6 +4,9 @@ import os
 
 from icefarm.utils import config_else_env
 from icefarm.utils import get_ip
+from icefarm.utils.ContextLogger import parse_sampling
+from icefarm.utils.dev import FLASH_DIRECT, FLASH_METHODS
+from icefarm.worker.device.FlashScheduler import FLASHES_PER_HUB
 
 class Config:
     # TODO do logging here
@@ -40,6 +43,22 @@ class Config:
             raise Exception("Environment variable ICEFARM_DATABASE not configured. Set this to a libpg \
             connection string to the database. If using sudo .venv/bin/worker, you may have to use the ENV= sudo arguments.")
 
+        # bytes of events held in memory per client before spilling to disk
+        self.session_queue_bytes = int(config_else_env("ICEFARM_SESSION_QUEUE_BYTES", "Events", parser, default=str(64 * 1024 * 1024)))
+        self.session_spill_dir = config_else_env("ICEFARM_SESSION_SPILL_DIR", "Events", parser, error=False)
+        # sqlite database that keeps reservations and queued work across restarts, disabled if unset
+        self.spool_path = config_else_env("ICEFARM_SPOOL_PATH", "Spool", parser, error=False)
+        # threads handling kernel events and client requests for all devices
+        self.device_workers = int(config_else_env("ICEFARM_DEVICE_WORKERS", "Devices", parser, default="8"))
+        # flashes running at once behind the same usb hub, the rest wait in order of priority
+        self.flashes_per_hub = int(config_else_env("ICEFARM_FLASHES_PER_HUB", "Devices", parser, default=str(FLASHES_PER_HUB)))
+        # category=every pairs, only one in every records of a category is logged
+        self.log_sampling = parse_sampling(config_else_env("ICEFARM_LOG_SAMPLING", "Logging", parser, error=False) or "")
+
         self.default_firmware_path = config_else_env("ICEFARM_DEFAULT", "Firmware", parser)
         self.pulse_firmware_path = config_else_env("ICEFARM_PULSE_COUNT", "Firmware", parser)
         self.variance_firmware_path = config_else_env("ICEFARM_VARIANCE", "Firmware", parser, error=False)
+        # direct writes the firmware onto the bootloader drive in process, mount uses mount, cp and picocom
+        self.flash_method = config_else_env("ICEFARM_FLASH_METHOD", "Firmware", parser, default=FLASH_DIRECT)
+        if self.flash_method not in FLASH_METHODS:
+            raise Exception(f"ICEFARM_FLASH_METHOD must be one of {', '.join(FLASH_METHODS)}")
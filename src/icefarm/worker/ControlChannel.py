@@ -0,0 +1,106 @@
+from __future__ import annotations
+from logging import Logger, LoggerAdapter
+import inspect
+import threading
+import time
+
+import socketio
+
+from icefarm.utils.utils import json_to_args, typecheck
+
+import typing
+if typing.TYPE_CHECKING:
+    from icefarm.worker import Config
+
+class ControlChannelLogger(LoggerAdapter):
+    def process(self, msg, kwargs):
+        return f"[ControlChannel] {msg}", kwargs
+
+class ControlChannel:
+    """Persistent socket connection to the control server. The control server sends 'command'
+    events over this connection instead of calling the worker http endpoints, each command is
+    acknowledged with a 'command_ack' event carrying the result. While connected, the control
+    server also treats the connection as the worker heartbeat."""
+    def __init__(self, config: Config, logger: Logger, retry_seconds: float=5):
+        self.url = config.control_server_url
+        self.auth = {
+            "worker": config.worker_name,
+            "url": f"http://{config.virtual_ip}:{config.virtual_server_port}"
+        }
+        self.logger = ControlChannelLogger(logger)
+        self.retry_seconds = retry_seconds
+
+        self.commands: dict[str, tuple[typing.Callable, list[str]]] = {}
+
+        self.client = socketio.Client(reconnection=True)
+        self.client.on("command", self._handleCommand)
+        self.client.on("connect", lambda : self.logger.info(f"connected to {self.url}"))
+        self.client.on("disconnect", lambda *args : self.logger.warning(f"disconnected from {self.url}"))
+
+        self._stopped = False
+        self.thread = None
+
+    def register(self, command: str, fn: typing.Callable):
+        """Registers a function to handle a command. Command arguments are injected by
+        parameter name and typechecked the same way as the http endpoints."""
+        parameters = [param.name for param in inspect.signature(fn).parameters.values()]
+        self.commands[command] = (fn, parameters)
+
+    def start(self):
+        """Connects to the control server in the background. The initial connection is
+        retried until it succeeds, afterwards the client reconnects on its own."""
+        def run():
+            while not self._stopped:
+                try:
+                    self.client.connect(self.url, auth=self.auth, transports=["websocket"])
+                    return
+                except Exception as e:
+                    self.logger.warning(f"failed to connect to {self.url}: {e}")
+                    time.sleep(self.retry_seconds)
+
+        self.thread = threading.Thread(target=run, name="control-channel-connect", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self._stopped = True
+
+        try:
+            self.client.disconnect()
+        except Exception:
+            pass
+
+    def _handleCommand(self, data):
+        if not isinstance(data, dict) or not data.get("id") or not data.get("command"):
+            self.logger.error("bad command packet")
+            return
+
+        # commands may block (e.g. reserving waits for the device), run them off the client thread
+        threading.Thread(target=self._run, args=(data,), name="control-channel-command", daemon=True).start()
+
+    def _run(self, data: dict):
+        request_id = data["id"]
+        command = data["command"]
+        result = False
+
+        if not (handler := self.commands.get(command)):
+            self.logger.error(f"unknown command {command}")
+        else:
+            fn, parameters = handler
+            args = json_to_args(data.get("args") or {}, parameters)
+
+            if args is False or not typecheck(fn, args):
+                self.logger.error(f"bad arguments for command {command}")
+            else:
+                try:
+                    result = fn(*args)
+                except Exception as e:
+                    self.logger.error(f"command {command} failed: {e}")
+                    result = False
+
+        if result is None:
+            result = True
+
+        try:
+            self.client.emit("command_ack", {"id": request_id, "result": result})
+        except Exception as e:
+            self.logger.error(f"failed to acknowledge command {command}: {e}")
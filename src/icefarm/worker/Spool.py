@@ -0,0 +1,198 @@
+from __future__ import annotations
+from logging import LoggerAdapter
+import json
+import os
+import sqlite3
+import threading
+
+from icefarm.utils.encoding import json_default
+
+class SpoolLogger(LoggerAdapter):
+    def process(self, msg, kwargs):
+        return f"[Spool] {msg}", kwargs
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reservations (
+    serial      TEXT    PRIMARY KEY,
+    kind        TEXT    NOT NULL,
+    args        TEXT    NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS bitstreams (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    serial      TEXT    NOT NULL,
+    location    TEXT    NOT NULL,
+    name        TEXT    NOT NULL,
+    batch_id    TEXT    NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS results (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    serial      TEXT    NOT NULL,
+    batch_id    TEXT    NOT NULL,
+    name        TEXT    NOT NULL,
+    result      TEXT    NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS firmware (
+    serial      TEXT    PRIMARY KEY,
+    kind        TEXT    NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS bitstreams_serial ON bitstreams(serial);
+CREATE INDEX IF NOT EXISTS results_serial ON results(serial);
+"""
+
+class Spool:
+    """Records the reservations of the worker's devices, the bitstreams they have accepted and
+    the results that have not been sent yet in a SQLite database. After a restart, devices that
+    are still reserved resume their reservation and replay the spooled work. The firmware of each
+    device is recorded as well so that idle devices can be adopted without flashing."""
+    def __init__(self, path: str, logger):
+        self.path = path
+        self.logger = SpoolLogger(logger)
+        self.lock = threading.Lock()
+
+        if (directory := os.path.dirname(path)):
+            os.makedirs(directory, exist_ok=True)
+
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # the write ahead log keeps commits to appends, NORMAL syncs survive a crash of the worker
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def _execute(self, sql: str | list[tuple[str, tuple]], args=()) -> list | bool:
+        """Runs a statement, or a list of (statement, args), in a transaction. Returns the rows of the
+        last statement, or False on error."""
+        with self.lock:
+            try:
+                self.conn.execute("BEGIN")
+                if isinstance(sql, list):
+                    for statement, statement_args in sql:
+                        cur = self.conn.execute(statement, statement_args)
+                else:
+                    cur = self.conn.execute(sql, args)
+                rows = cur.fetchall()
+                self.conn.execute("COMMIT")
+                return rows
+            except sqlite3.Error as e:
+                self.logger.error(f"spool query failed: {e}")
+                if self.conn.in_transaction:
+                    self.conn.execute("ROLLBACK")
+                return False
+
+    def recordReservation(self, serial: str, kind: str, args: dict) -> bool:
+        """Records a new reservation of serial, dropping anything spooled for a previous one."""
+        try:
+            args = json.dumps(args)
+        except Exception:
+            self.logger.error(f"failed to encode reservation arguments for {serial}")
+            return False
+
+        return self._execute([
+            ("DELETE FROM bitstreams WHERE serial = ?", (serial,)),
+            ("DELETE FROM results WHERE serial = ?", (serial,)),
+            ("INSERT OR REPLACE INTO reservations (serial, kind, args) VALUES (?, ?, ?)", (serial, kind, args))
+        ]) is not False
+
+    def removeDevice(self, serial: str) -> bool:
+        """Drops the reservation of serial and its spooled work."""
+        return self._execute([
+            ("DELETE FROM bitstreams WHERE serial = ?", (serial,)),
+            ("DELETE FROM results WHERE serial = ?", (serial,)),
+            ("DELETE FROM reservations WHERE serial = ?", (serial,))
+        ]) is not False
+
+    def getReservedSerials(self) -> list[str]:
+        if (rows := self._execute("SELECT serial FROM reservations")) is False:
+            return []
+
+        return [row[0] for row in rows]
+
+    def getReservation(self, serial: str) -> tuple[str, dict] | None:
+        """Returns the (kind, args) of the reservation of serial, or None if there is none."""
+        if not (rows := self._execute("SELECT kind, args FROM reservations WHERE serial = ?", (serial,))):
+            return None
+
+        kind, args = rows[0]
+        return kind, json.loads(args)
+
+    def recordFirmware(self, serial: str, kind: str | None) -> bool:
+        """Records the reservable whose firmware serial is running, or None if it is unknown or the default."""
+        if kind is None:
+            return self._execute("DELETE FROM firmware WHERE serial = ?", (serial,)) is not False
+
+        return self._execute("INSERT OR REPLACE INTO firmware (serial, kind) VALUES (?, ?)", (serial, kind)) is not False
+
+    def getFirmware(self, serial: str) -> str | None:
+        """Returns the reservable whose firmware serial was last known to run, or None."""
+        if not (rows := self._execute("SELECT kind FROM firmware WHERE serial = ?", (serial,))):
+            return None
+
+        return rows[0][0]
+
+    def addBitstreams(self, serial: str, bitstreams: list[tuple[str, str, str]]) -> list[int]:
+        """Records accepted (location, name, batch_id) bitstreams. Returns their spool ids, or
+        None for each on failure."""
+        with self.lock:
+            try:
+                self.conn.execute("BEGIN")
+                ids = [
+                    self.conn.execute(
+                        "INSERT INTO bitstreams (serial, location, name, batch_id) VALUES (?, ?, ?, ?)",
+                        (serial, location, name, batch_id)
+                    ).lastrowid
+                    for location, name, batch_id in bitstreams
+                ]
+                self.conn.execute("COMMIT")
+                return ids
+            except sqlite3.Error as e:
+                self.logger.error(f"failed to spool bitstreams: {e}")
+                if self.conn.in_transaction:
+                    self.conn.execute("ROLLBACK")
+                return [None] * len(bitstreams)
+
+    def removeBitstream(self, spool_id: int) -> bool:
+        return self._execute("DELETE FROM bitstreams WHERE id = ?", (spool_id,)) is not False
+
+    def completeBitstream(self, spool_id: int, serial: str, batch_id: str, name: str, result) -> int | None:
+        """Replaces a spooled bitstream with its result. Returns the spool id of the result,
+        or None on failure."""
+        try:
+            result = json.dumps(result, default=json_default)
+        except Exception:
+            self.logger.error(f"failed to encode result of {name}")
+            return None
+
+        rows = self._execute([
+            ("DELETE FROM bitstreams WHERE id = ?", (spool_id,)),
+            ("INSERT INTO results (serial, batch_id, name, result) VALUES (?, ?, ?, ?) RETURNING id", (serial, batch_id, name, result))
+        ])
+
+        if not rows:
+            return None
+
+        return rows[0][0]
+
+    def removeResults(self, serial: str, up_to: int) -> bool:
+        """Drops the results of serial that have been sent, up to and including spool id up_to."""
+        return self._execute("DELETE FROM results WHERE serial = ? AND id <= ?", (serial, up_to)) is not False
+
+    def getBitstreams(self, serial: str) -> list[tuple[int, str, str, str]]:
+        """Returns the spooled (id, location, name, batch_id) bitstreams of serial in the order they were accepted."""
+        if (rows := self._execute("SELECT id, location, name, batch_id FROM bitstreams WHERE serial = ? ORDER BY id", (serial,))) is False:
+            return []
+
+        return rows
+
+    def getResults(self, serial: str) -> list[tuple[int, str, str, object]]:
+        """Returns the spooled (id, batch_id, name, result) results of serial that have not been sent."""
+        if (rows := self._execute("SELECT id, batch_id, name, result FROM results WHERE serial = ? ORDER BY id", (serial,))) is False:
+            return []
+
+        return [(spool_id, batch_id, name, json.loads(result)) for spool_id, batch_id, name, result in rows]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
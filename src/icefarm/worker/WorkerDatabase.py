@@ -2,6 +2,7 @@ from __future__ import annotations
 from logging import LoggerAdapter
 from importlib.metadata import version
 import threading
+import time
 
 from icefarm.utils import Database
 from icefarm.worker.device.state.reservable import get_registered_reservables
@@ -15,30 +16,79 @@ class WorkerDataBaseLogger(LoggerAdapter):
     def process(self, msg, kwargs):
         return f"[WorkerDatabase] {msg}", kwargs
 
+# seconds between device activity reports
+ACTIVITY_REPORT_INTERVAL = 15
+
 class WorkerDatabase(Database):
     # TODO use Database.exec
     """Provides access to database operations related to the worker process."""
-    def __init__(self, config: Config, logger):
+    def __init__(self, config: Config, logger, kept_devices: list[str]=()):
+        """If kept_devices is provided, those devices keep their reservations from before the worker
+        restarted as long as they are still reserved. Otherwise the worker starts out without devices."""
         super().__init__(config.libpg_string)
         self.worker_name = config.worker_name
         self.logger = WorkerDataBaseLogger(logger)
         self.cv = threading.Condition()
 
+        self._active_serials: set[str] = set()
+        self._activity_lock = threading.Lock()
+
         farm_version = version("icefarm")
         reservables = get_registered_reservables()
 
         args = (self.worker_name, config.virtual_ip, config.virtual_server_port, farm_version, reservables)
-        if not self.execute("CALL add_worker(%s::varchar(255), %s::varchar(255), %s::int, %s::varchar(255), %s::varchar(255)[])", args):
+        # devices that are still registered from before a restart
+        self.kept_devices: set[str] = set()
+
+        if kept_devices:
+            data = self.execute("SELECT * FROM restart_worker(%s::varchar(255), %s::varchar(255), %s::int, %s::varchar(255), %s::varchar(255)[], %s::varchar(255)[])", (*args, list(kept_devices)))
+            if data is False:
+                raise Exception(f"Failed to restart worker {self.worker_name}")
+
+            self.kept_devices = {row[0] for row in data}
+        elif not self.execute("CALL add_worker(%s::varchar(255), %s::varchar(255), %s::int, %s::varchar(255), %s::varchar(255)[])", args):
             raise Exception(f"Failed to add worker {self.worker_name}")
 
+        # devices registered to the worker by this process or kept from before a restart
+        self._registered: set[str] = set(self.kept_devices)
+        self._registered_lock = threading.Lock()
+
+        threading.Thread(target=self._reportActivity, name="device-activity-reporter", daemon=True).start()
+
     def addDevice(self, deviceserial: str) -> bool:
-        """Add a device to the database."""
-        if not self.execute("CALL add_device(%s::varchar(255), %s::varchar(255))", (deviceserial, self.worker_name)):
-            self.logger.error(f"failed to add device {deviceserial}")
-            return False
+        """Add a device to the database. Devices kept from before a restart or added through
+        addDevices are already registered."""
+        with self._registered_lock:
+            if deviceserial in self._registered:
+                return True
+
+            if not self.execute("CALL add_device(%s::varchar(255), %s::varchar(255))", (deviceserial, self.worker_name)):
+                self.logger.error(f"failed to add device {deviceserial}")
+                return False
+
+            self._registered.add(deviceserial)
 
         return True
 
+    def addDevices(self, deviceserials: list[str]) -> bool:
+        """Adds devices to the database in a single call. If the call fails, the devices are
+        added one at a time so that a single bad serial does not prevent the others from registering."""
+        with self._registered_lock:
+            serials = [serial for serial in dict.fromkeys(deviceserials) if serial not in self._registered]
+            if not serials:
+                return True
+
+            if self.execute("CALL add_devices(%s::varchar(255)[], %s::varchar(255))", (serials, self.worker_name)):
+                self._registered.update(serials)
+                return True
+
+        self.logger.error(f"failed to add {len(serials)} devices at once, adding individually")
+        return all([self.addDevice(serial) for serial in serials])
+
+    def isKept(self, deviceserial: str) -> bool:
+        """Whether the device kept its reservation from before the worker restarted."""
+        return deviceserial in self.kept_devices
+
     def updateDeviceStatus(self, deviceserial: str, status: DeviceStatus) -> bool:
         """Updates the status field of a device."""
         if not self.execute("CALL update_device_status(%s::varchar(255), %s::devicestatus)", (deviceserial, status)):
@@ -47,6 +97,41 @@ class WorkerDatabase(Database):
 
         return True
 
+    def updateDeviceFirmware(self, deviceserial: str, firmware: str | None) -> bool:
+        """Records the reservable whose firmware the device is running, None for the default firmware."""
+        if not self.execute("CALL update_device_firmware(%s::varchar(255), %s::varchar(255))", (deviceserial, firmware)):
+            self.logger.error(f"failed to update firmware of device {deviceserial} to {firmware}")
+            return False
+
+        return True
+
+    def startDeviceWarming(self, deviceserial: str) -> bool:
+        """Marks an available device as warming. Returns False if the device is no longer available."""
+        if not (data := self.execute("SELECT * FROM start_device_warming(%s::varchar(255))", (deviceserial,))):
+            self.logger.error(f"failed to start warming device {deviceserial}")
+            return False
+
+        return data[0][0]
+
+    def reportActivity(self, deviceserial: str):
+        """Marks a device as in use by its client. Activity is sent to the database in batches
+        and is used by the control server to release idle reservations."""
+        with self._activity_lock:
+            self._active_serials.add(deviceserial)
+
+    def _reportActivity(self):
+        while True:
+            time.sleep(ACTIVITY_REPORT_INTERVAL)
+
+            with self._activity_lock:
+                serials, self._active_serials = self._active_serials, set()
+
+            if not serials:
+                continue
+
+            if not self.execute("CALL report_device_activity(%s::varchar(255)[])", (list(serials),)):
+                self.logger.error(f"failed to report activity of {len(serials)} devices")
+
     def enableShutDown(self):
         if not self.execute("CALL shutdown_worker(%s::varchar(255))", (self.worker_name,)):
             self.logger.error("Failed to enable shut down mode")
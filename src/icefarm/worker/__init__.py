@@ -1,3 +1,5 @@
 from icefarm.worker.WorkerDatabase import WorkerDatabase
 from icefarm.worker.Config import Config
+from icefarm.worker.ControlChannel import ControlChannel
+from icefarm.worker.Spool import Spool
 from icefarm.worker import app, test
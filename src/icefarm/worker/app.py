@@ -5,16 +5,20 @@ import sys
 import threading
 import msgpack
 
-from flask import Flask, Response
+from flask import Flask, Response, jsonify
 from flask_socketio import SocketIO
 from socketio import ASGIApp
 from asgiref.wsgi import WsgiToAsgi
 
-from icefarm.worker import Config, WorkerDatabase
+from icefarm.worker import Config, WorkerDatabase, ControlChannel, Spool
 from icefarm.worker.device import DeviceManager
+from icefarm.worker.device.Mailbox import LIVE_THREADS
 
 from icefarm.utils import EventSender
+from icefarm.utils.EventSender import DEFAULT_SPILL_DIR
 from icefarm.utils import RemoteLogger
+from icefarm.utils.ContextLogger import set_sampling
+from icefarm.utils.Metrics import METRICS
 from icefarm.utils.web import SyncAsyncServer, flask_socketio_adapter_connect, flask_socketio_adapter_on, inject_and_return_json
 
 # 100 bitstreams
@@ -22,9 +26,14 @@ MAX_REQUEST_SIZE = 104.2 * 8000 * 100
 
 def create_app(app: Flask, socketio: SocketIO | SyncAsyncServer, config: Config, logger: logging.Logger):
 
-    event_sender = EventSender(socketio, config.libpg_string, logger)
-    database = WorkerDatabase(config, logger)
-    manager = DeviceManager(event_sender, database, config, logger)
+    for category, every in config.log_sampling.items():
+        set_sampling(category, every)
+
+    spill_dir = config.session_spill_dir or DEFAULT_SPILL_DIR
+    event_sender = EventSender(socketio, config.libpg_string, logger, max_queue_bytes=config.session_queue_bytes, spill_dir=spill_dir)
+    spool = Spool(config.spool_path, logger) if config.spool_path else None
+    database = WorkerDatabase(config, logger, kept_devices=spool.getReservedSerials() if spool else ())
+    manager = DeviceManager(event_sender, database, config, logger, spool=spool)
 
     def handle_res_end(serial, client_id):
         if manager.unreserve(serial):
@@ -35,25 +44,52 @@ def create_app(app: Flask, socketio: SocketIO | SyncAsyncServer, config: Config,
     sock_id_to_client_id = {}
     id_lock = threading.Lock()
 
-    @app.get("/heartbeat")
-    def heartbeat():
-        return Response(status=200)
-
-    @app.get("/reserve")
-    @inject_and_return_json
+    # commands are reachable both through the http endpoints and the control channel
     def reserve(serial: str, kind: str, args: dict):
         return manager.reserve(serial, kind, args)
 
-    @app.get("/reboot")
-    @inject_and_return_json
+    def job(job: str):
+        return manager.job(job)
+
+    def timeline(serial: str):
+        return manager.timeline(serial)
+
     def reboot(serial: str):
         return manager.reboot(serial)
 
-    @app.get("/delete")
-    @inject_and_return_json
     def delete(serial: str):
         return manager.delete(serial)
 
+    def warm(targets: dict):
+        return manager.setWarmTargets(targets)
+
+    if config.control_server_url:
+        channel = ControlChannel(config, logger)
+        channel.register("reserve", reserve)
+        channel.register("job", job)
+        channel.register("timeline", timeline)
+        channel.register("reboot", reboot)
+        channel.register("delete", delete)
+        channel.register("warm", warm)
+        channel.start()
+
+    @app.get("/heartbeat")
+    def heartbeat():
+        return Response(status=200)
+
+    @app.get("/metrics")
+    def metrics():
+        # otherwise only updated when the device pool handles a message
+        LIVE_THREADS.set(threading.active_count())
+        return jsonify(METRICS.snapshot())
+
+    app.get("/reserve")(inject_and_return_json(reserve))
+    app.get("/job")(inject_and_return_json(job))
+    app.get("/timeline")(inject_and_return_json(timeline))
+    app.get("/reboot")(inject_and_return_json(reboot))
+    app.get("/delete")(inject_and_return_json(delete))
+    app.get("/warm")(inject_and_return_json(warm))
+
     @socketio.on("connect")
     @flask_socketio_adapter_connect
     def connection(sid, environ, auth):
@@ -65,7 +101,7 @@ def create_app(app: Flask, socketio: SocketIO | SyncAsyncServer, config: Config,
         with id_lock:
             sock_id_to_client_id[sid] = client_id
 
-        event_sender.addSocket(sid, client_id)
+        event_sender.addSocket(sid, client_id, frames=bool(auth.get("frames")), resume=auth.get("resume"), encoding=auth.get("encoding"))
 
     @socketio.on("disconnect")
     @flask_socketio_adapter_on
@@ -103,24 +139,29 @@ def create_app(app: Flask, socketio: SocketIO | SyncAsyncServer, config: Config,
             logger.error(f"bad request packet from client {client_id}")
             return
 
-        if isinstance(serial, list):
-            for s in serial:
-                thread = threading.Thread(target=lambda : manager.handleRequest(s, event, contents), name="socket-request")
-                thread.start()
+        for s in serial if isinstance(serial, list) else [serial]:
+            manager.handleRequest(s, event, contents)
+
+    @socketio.on("ack")
+    @flask_socketio_adapter_on
+    def ack(sid, data):
+        with id_lock:
+            client_id = sock_id_to_client_id.get(sid)
+
+        if not client_id or not isinstance(data, dict):
+            logger.warning("bad ack from socket")
+            return
 
-        else:
-            manager.handleRequest(serial, event, contents)
+        event_sender.ack(client_id, data.get("session"), data.get("seq"))
 
     @socketio.on("graceful_shutdown")
     @flask_socketio_adapter_on
     def shutdown(sid, data):
         database.enableShutDown()
 
-        # this seems really dumb but the SyncAsyncServer adapter uses creates a new event
-        # loop, so calling this directly results in nested event loops :/
-        # TODO we should really adapt to the flask_socketio interface instead of socketio-server
         logger.warning("Graceful shutdown initilized")
-        threading.Thread(target=lambda : socketio.emit("graceful_shutdown_initilized"), name='graceful-shutdown-notifier', daemon=True).start()
+        # handlers run on the event loop, where emit schedules the event instead of blocking
+        socketio.emit("graceful_shutdown_initilized")
 
         def monitor():
             database.waitUntilNoReservations()
@@ -181,7 +222,8 @@ def run_uvicorn():
     # loop can be too busy with serial I/O, DB writes, and socket emits to
     # service the ping/pong heartbeat in time. The default 20s timeout caused
     # spurious "packet queue is empty, aborting" disconnects on the client.
-    socketio = SyncAsyncServer(async_mode="asgi", max_http_buffer_size=MAX_REQUEST_SIZE, ping_timeout=60, ping_interval=25)
+    # Blocking calls on the loop are logged with their stack by the loop monitor.
+    socketio = SyncAsyncServer(async_mode="asgi", max_http_buffer_size=MAX_REQUEST_SIZE, ping_timeout=60, ping_interval=25, loop_logger=logger)
     create_app(app, socketio, config, logger)
     app = WsgiToAsgi(app)
 
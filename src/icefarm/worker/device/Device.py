@@ -1,27 +1,38 @@
 from __future__ import annotations
 from pathlib import Path
-from logging import Logger, LoggerAdapter
+from logging import Logger
 import threading
+from typing import Any, Callable
 
+from icefarm.utils import check_default
+from icefarm.utils.ContextLogger import ContextLogger
+from icefarm.utils.dev import DEVICE_INDEX, DFU_INTERFACE
+from icefarm.utils.Metrics import METRICS
 from icefarm.worker.device import DeviceEventSender
-from icefarm.worker.device.state.core import FlashState, TestState
-from icefarm.worker.device.state.reservable import get_reservation_state_fac
+from icefarm.worker.device.Mailbox import Mailbox
+from icefarm.worker.device.FlashScheduler import PRIORITY_DEFAULT, PRIORITY_WARM
+from icefarm.worker.device.ReserveJobs import JOB_STARTING, JOB_FAILED, JOB_CANCELLED
+from icefarm.worker.device.Timeline import Timeline
+from icefarm.worker.device.state.core import FlashState, TestState, ReadyState, UploadState
+from icefarm.worker.device.state.reservable import get_reservation_state_fac, get_reservation_firmware_path
 
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
-    from icefarm.worker import WorkerDatabase, Config, EventSender
+    from icefarm.worker import WorkerDatabase, Config, EventSender, Spool
     from icefarm.worker.device import DeviceManager
     from icefarm.worker.device.state.core import AbstractState
 
 # TODO add this to config
 WORKER_MEDIA = "worker_media"
 
-class DeviceLogger(LoggerAdapter):
-    def __init__(self, logger, serial):
-        super().__init__(logger, extra={"serial": serial})
+WARM_HITS = METRICS.counter("warm_pool_hits", "Reservations of devices already running the firmware of the reservation", ["kind"])
+WARM_MISSES = METRICS.counter("warm_pool_misses", "Reservations of devices that had to be flashed first", ["kind"])
+ADOPTED = METRICS.counter("worker_adopted_devices", "Devices taken over at startup without flashing, by the firmware they were running", ["firmware"])
 
-    def process(self, msg, kwargs):
-        return f"[{self.extra['serial']}] {msg}", kwargs
+class DeviceLogger(ContextLogger):
+    def __init__(self, logger, serial):
+        # serial is passed along so that remote log records can be filtered by device
+        super().__init__(logger, f"[{serial}]", serial=serial)
 
 class Device:
     def __init__(self, serial: str, manager: DeviceManager, event_sender: EventSender, database: WorkerDatabase, logger: Logger):
@@ -30,6 +41,11 @@ class Device:
         self.database: WorkerDatabase = database
         self.logger: Logger = DeviceLogger(logger, self.serial)
         self.device_event_sender: DeviceEventSender = DeviceEventSender(event_sender, self.serial, self.logger)
+        self.device_event_sender.on_status = self._handleStatus
+        # recent state switches and bring-up stages
+        self.timeline = Timeline()
+        # kernel events and client requests, handled in order by the manager's pool
+        self.mailbox = Mailbox(manager.pool, self.serial, self.logger)
 
         self._device: AbstractState = None
         self._device_lock = threading.RLock()
@@ -39,11 +55,103 @@ class Device:
         self.path.joinpath("mount").mkdir(parents=True, exist_ok=True)
         self.path.joinpath("media").mkdir(exist_ok=True)
 
-        self.__flashDefault()
+        # whether the device resumed its reservation after a restart and has spooled work to replay
+        self.resumed = False
+        # reservable whose firmware the device is known to be running, None if unknown or default
+        self._firmware: str | None = None
+
+    @property
+    def firmware(self) -> str | None:
+        return self._firmware
+
+    @firmware.setter
+    def firmware(self, firmware: str | None):
+        if firmware != self._firmware and self.spool:
+            # remembered across restarts so that the device can be adopted without flashing
+            self.spool.recordFirmware(self.serial, firmware)
+
+        self._firmware = firmware
+
+    def _handleStatus(self, status: str):
+        """Called when the device sends its initialized or failure event."""
+        self.timeline.mark(status)
+        self.manager.reserve_jobs.finishDevice(self.serial, status)
+
+    def start(self):
+        """Resumes the reservation the device had before the worker restarted, otherwise adopts the
+        device if it is already running known firmware, otherwise flashes the default firmware.
+        Called from the mailbox of the device once it is registered."""
+        if self.__resume():
+            self.manager.deviceSettled(self.serial)
+            return
+
+        # reading the banner of the default firmware takes a few seconds
+        self.runBlocking("adopt", self.__getAdoptable, self.__adoptOrFlash)
+
+    def __adoptOrFlash(self, adoptable: tuple[bool, str | None]):
+        with self._device_lock:
+            if self._device:
+                # reserved while the firmware was checked
+                return
+
+            adopt, kind = adoptable
+            if adopt:
+                self.__adopt(kind)
+                return
+
+            if self.spool:
+                # the firmware recorded before the restart is about to be replaced
+                self.spool.recordFirmware(self.serial, None)
+            self.__flashDefault()
 
     def __flashDefault(self):
         self.database.updateDeviceStatus(self.serial, "flashing_default")
-        self.switch(lambda : FlashState(self, self.config.default_firmware_path, lambda : TestState(self), timeout=60))
+        self.switch(lambda : FlashState(self, self.config.default_firmware_path, lambda : TestState(self), timeout=60, priority=PRIORITY_DEFAULT))
+
+    def __resume(self) -> bool:
+        """Resumes the reservation the device had before the worker restarted. Returns False if
+        there is no reservation to resume."""
+        if not self.spool:
+            return False
+
+        if not self.database.isKept(self.serial) or not (reservation := self.spool.getReservation(self.serial)):
+            self.spool.removeDevice(self.serial)
+            return False
+
+        kind, args = reservation
+        if not (fn := get_reservation_state_fac(self, kind, args)):
+            self.spool.removeDevice(self.serial)
+            return False
+
+        self.logger.info(f"resuming {kind} reservation after restart")
+        self.resumed = True
+        self.switch(fn)
+        return True
+
+    def __getAdoptable(self) -> tuple[bool, str | None]:
+        """Checks whether the device is running firmware that does not need to be replaced. The default
+        firmware is recognized by its banner. Reservable firmware is recognized by its DFU interface and
+        has to match the firmware recorded in the spool, as reservables share their usb descriptors.
+        Returns whether the device can be adopted and the reservable of its firmware, None for the default."""
+        if not (port := DEVICE_INDEX.tty(self.serial)):
+            return False, None
+
+        if any(interface.startswith(DFU_INTERFACE) for interface in DEVICE_INDEX.interfaces(self.serial)):
+            kind = self.spool.getFirmware(self.serial) if self.spool else None
+            if not kind or not get_reservation_firmware_path(kind, self.config):
+                return False, None
+
+            return True, kind
+
+        return check_default(port), None
+
+    def __adopt(self, kind: str | None):
+        """Switches straight to ReadyState, keeping the firmware the device is running."""
+        self.logger.info(f"adopting device running {kind or 'default'} firmware")
+        ADOPTED.labels(kind or "default").inc()
+
+        self.firmware = kind
+        self.switch(lambda : ReadyState(self))
 
     def handleDeviceEvent(self, action, dev):
         with self._device_lock:
@@ -69,15 +177,126 @@ class Device:
         if not fn:
             return False
 
+        if self.spool:
+            self.spool.recordReservation(self.serial, kind, args)
+
+        (WARM_HITS if self.firmware == kind else WARM_MISSES).labels(kind).inc()
+
+        self.timeline.mark(f"reserve {kind}")
         self.switch(fn)
         return True
 
+    def runReserveJob(self, job_id: str, kind: str, args: dict):
+        """Switches to the reservation of a job queued by the manager. Skipped if the job was
+        cancelled while waiting in the mailbox."""
+        with self._device_lock:
+            if not self.manager.reserve_jobs.update(job_id, JOB_STARTING):
+                self.logger.info(f"skipping cancelled {kind} reservation")
+                return
+
+            try:
+                reserved = self.handleReserve(kind, args)
+            except Exception:
+                self.manager.reserve_jobs.update(job_id, JOB_FAILED)
+                raise
+
+            if not reserved:
+                self.logger.error(f"failed to start {kind} reservation")
+                self.manager.reserve_jobs.update(job_id, JOB_FAILED)
+
     def handleUnreserve(self):
-        self.__flashDefault()
+        with self._device_lock:
+            # a reservation still waiting in the mailbox must not start after it ended
+            self.manager.reserve_jobs.finishDevice(self.serial, JOB_CANCELLED)
+
+            if self.firmware and not (isinstance(self._device, UploadState) and self._device.healthy):
+                self.logger.warning(f"reservation ended with {self.firmware} firmware in an unknown state, not keeping it")
+                self.firmware = None
+
+        self.timeline.mark("unreserve")
+
+        if self.spool:
+            self.spool.removeDevice(self.serial)
+
+        if self.firmware:
+            # the next reservation of the same kind can use the device without flashing
+            self.logger.info(f"keeping {self.firmware} firmware after reservation")
+            self.switch(lambda : ReadyState(self))
+        else:
+            self.__flashDefault()
+
         return True
 
+    def isIdle(self) -> bool:
+        """Whether the device is available and not being reserved or flashed."""
+        with self._device_lock:
+            return isinstance(self._device, ReadyState)
+
+    def warm(self, kind: str) -> bool:
+        """Flashes the firmware of kind while the device is idle, so that a later reservation of kind
+        can start without flashing. Returns False if the device is no longer idle."""
+        if not (firmware_path := get_reservation_firmware_path(kind, self.config)):
+            return False
+
+        with self._device_lock:
+            if not self.isIdle() or self.firmware == kind:
+                return False
+
+            # fails if the device was reserved in the meantime
+            if not self.database.startDeviceWarming(self.serial):
+                return False
+
+            def warmed():
+                self.firmware = kind
+                return ReadyState(self)
+
+            self.logger.info(f"warming with {kind} firmware")
+            self.switch(lambda : FlashState(self, firmware_path, warmed, timeout=60, firmware=kind, priority=PRIORITY_WARM))
+
+        return True
+
+    @property
+    def warming(self) -> str | None:
+        """Reservable whose firmware the device is being flashed with by warm, None otherwise."""
+        with self._device_lock:
+            if isinstance(self._device, FlashState) and self._device.priority == PRIORITY_WARM:
+                return self._device.firmware
+
+        return None
+
+    def runBlocking(self, name: str, work: Callable[[], Any], done: Callable[[Any], None]) -> threading.Thread:
+        """Calls work on its own thread, so that blocking io such as flashing or opening serial ports does
+        not hold up the pool threads serving the mailboxes of all devices, then posts done with the result
+        of work to the mailbox of the device. done is not called if work raises."""
+        def run():
+            try:
+                result = work()
+            except Exception as e:
+                self.logger.exception(f"{name} failed: {e}")
+                return
+
+            if not self.mailbox.post(lambda : done(result)):
+                self.logger.error(f"mailbox full, dropped result of {name}")
+
+        thread = threading.Thread(target=run, name=f"{self.serial}-{name}", daemon=True)
+        thread.start()
+        return thread
+
+    def runInState(self, state: AbstractState, fn):
+        """Calls fn under the same locks as device events, unless the device has left state."""
+        with self._device_lock:
+            if self._device is not state:
+                return
+
+            with state.switching_lock:
+                fn()
+
     def handleRequest(self, event, json):
         with self._device_lock:
+            if not self._device:
+                self.logger.warning(f"dropped {event} request, device is still starting")
+                return
+
             self._device.handleRequest(event, json)
 
     def handleExit(self):
@@ -93,16 +312,29 @@ class Device:
 
     def switch(self, state_factory):
         with self._device_lock:
+            previous = self.state
             if self._device:
                 self._device.handleExit()
             device = state_factory()
             self._device = device
+            self.timeline.enter(self.state)
+            self.manager.stateChanged(previous, self.state)
             self._device.start()
 
+    @property
+    def state(self) -> str | None:
+        """Name of the current state, None before the device is started."""
+        with self._device_lock:
+            return type(self._device).__name__ if self._device else None
+
     @property
     def config(self) -> Config:
         return self.manager.config
 
+    @property
+    def spool(self) -> Spool | None:
+        return self.manager.spool
+
     @property
     def mount_path(self) -> str:
         return self.path.joinpath("mount")
@@ -1,5 +1,6 @@
 from __future__ import annotations
 from logging import Logger
+from typing import Callable
 
 from icefarm.utils import EventSender
 
@@ -10,6 +11,8 @@ class DeviceEventSender:
         self.event_sender = event_sender
         self.serial = serial
         self.logger = logger
+        # called with "initialized" or "failed" when the device sends either event
+        self.on_status: Callable[[str], None] | None = None
 
     def sendDeviceEvent(self, event: str, contents: dict) -> bool:
         """Sends a event with contents. Note that during serialization, the *event* key of
@@ -34,8 +37,16 @@ class DeviceEventSender:
 
         return True
 
-    def sendDeviceInitialized(self):
-        return self.sendDeviceEvent("initialized", {})
+    def isBackpressured(self) -> bool:
+        """Whether the client is receiving events slower than they are produced. Producers
+        should hold off on sending non-essential events while this is the case."""
+        return self.event_sender.isSerialBackpressured(self.serial)
+
+    def sendDeviceInitialized(self, contents: dict=None):
+        """Sends an initialized event for serial, contents describe what the state accepts."""
+        if self.on_status:
+            self.on_status("initialized")
+        return self.sendDeviceEvent("initialized", contents or {})
 
     def sendDeviceReservationEnd(self) -> bool:
         """Sends a reservation end event for serial."""
@@ -43,4 +54,6 @@ class DeviceEventSender:
 
     def sendDeviceFailure(self) -> bool:
         """Sends a failure event for serial."""
+        if self.on_status:
+            self.on_status("failed")
         return self.sendDeviceEvent("failure", {})
@@ -1,98 +1,212 @@
 from __future__ import annotations
-from logging import Logger, LoggerAdapter
+from logging import Logger
 import threading
 import atexit
+import time
 
 import pyudev
 
 from icefarm.utils.dev import *
+from icefarm.utils.ContextLogger import ContextLogger
+from icefarm.utils.Metrics import METRICS
 from icefarm.worker.device import Device
+from icefarm.worker.device.Mailbox import MailboxPool
+from icefarm.worker.device.FlashScheduler import FlashScheduler
+from icefarm.worker.device.ReserveJobs import ReserveJobs, JOB_FAILED
+from icefarm.worker.device.state.reservable import get_reservation_state_fac
 
 import typing
 if typing.TYPE_CHECKING:
-    from icefarm.worker import Config, EventSender, WorkerDatabase
+    from icefarm.worker import Config, EventSender, WorkerDatabase, Spool
 
-class ManagerLogger(LoggerAdapter):
-    def __init__(self, logger, extra=None):
-        super().__init__(logger, extra)
+STARTUP_DEVICES = METRICS.gauge("worker_startup_devices", "Devices found when the worker started")
+STARTUP_PENDING = METRICS.gauge("worker_startup_pending_devices", "Devices found at startup that are not yet available or broken")
+WARM_TARGET = METRICS.gauge("worker_warm_pool_target", "Idle devices the control server wants running the firmware of a reservable", ["kind"])
+WARM_DEVICES = METRICS.gauge("worker_warm_pool_devices", "Idle devices running the firmware of a reservable", ["kind"])
+DEVICE_STATES = METRICS.gauge("worker_devices", "Devices by the state they are in", ["state"])
+STARTUP_SECONDS = METRICS.gauge("worker_startup_seconds", "Seconds from worker start until every device found at startup was available or broken")
 
-    def process(self, msg, kwargs):
-        return f"[DeviceManager] {msg}", kwargs
+class ManagerLogger(ContextLogger):
+    def __init__(self, logger, extra=None):
+        super().__init__(logger, "[DeviceManager]")
 
 class DeviceManager:
     """Tracks device events and routes them to their corresponding Device object. Also listens to kernel
-    device events to identify usbip disconnects."""
-    def __init__(self, event_sender: EventSender, database: WorkerDatabase, config: Config, logger: Logger):
+    device events to identify usbip disconnects. Kernel events and client requests are posted to the
+    mailbox of the device and handled in order by a shared pool of threads."""
+    def __init__(self, event_sender: EventSender, database: WorkerDatabase, config: Config, logger: Logger, spool: Spool=None):
         self.config: Config = config
         self.logger: Logger = ManagerLogger(logger)
         self.event_sender: EventSender = event_sender
         self.database = database
+        self.spool = spool
 
         atexit.register(self.onExit)
 
         self._devs: dict[str, Device] = {}
         self._dev_lock = threading.Lock()
+        self.pool = MailboxPool(config.device_workers)
+        self.flash_scheduler = FlashScheduler(self.logger, config.flashes_per_hub)
+        self.reserve_jobs = ReserveJobs()
 
         self.exiting: bool = False
 
-        context = pyudev.Context()
-        monitor = pyudev.Monitor.from_netlink(context)
-        monitor.filter_by("tty")
-        monitor.filter_by("block")
+        self._started_at = time.monotonic()
+        # devices found at startup that have not become available or broken yet
+        self._starting: set[str] = set()
 
+        monitor = monitor_pico_devices(pyudev.Context())
         observer = pyudev.MonitorObserver(monitor, self.handleDevEvent, name="manager-userevents")
         observer.start()
 
         self.scan()
 
     def scan(self):
-        """Trigger add events for devices that are already connected."""
+        """Registers the devices that are already connected with a single database call, then
+        triggers add events for them. Devices are brought up concurrently by the mailbox pool."""
         self.logger.info("Scanning for devices")
-        context = pyudev.Context().list_devices()
 
-        for dev in context:
-            self.handleDevEvent("add", dev)
+        events = []
+        for dev in list_pico_devices(pyudev.Context()):
+            dev = dict(dev)
+            if (serial := DEVICE_INDEX.update("add", dev)):
+                events.append((serial, dev))
+
+        serials = list(dict.fromkeys(serial for serial, _ in events))
+        with self._dev_lock:
+            self._starting.update(serials)
+
+        STARTUP_DEVICES.set(len(serials))
+        STARTUP_PENDING.set(len(serials))
+
+        self.database.addDevices(serials)
+
+        for serial, dev in events:
+            self._routeDevEvent(serial, "add", dev)
+
+        self.logger.info(f"Finished scan, found {len(serials)} devices")
+
+        if not serials:
+            self._startupFinished()
+
+    def deviceSettled(self, serial: str):
+        """Called when a device becomes available, broken or resumes its reservation. Records the
+        startup time once every device found at startup has settled."""
+        with self._dev_lock:
+            if serial not in self._starting:
+                return
+
+            self._starting.discard(serial)
+            pending = len(self._starting)
 
-        self.logger.info("Finished scan")
+        STARTUP_PENDING.set(pending)
+        if not pending:
+            self._startupFinished()
+
+    def _startupFinished(self):
+        elapsed = time.monotonic() - self._started_at
+        STARTUP_SECONDS.set(elapsed)
+        self.logger.info(f"all devices found at startup settled after {elapsed:.1f}s")
 
     def handleDevEvent(self, action: str, dev: pyudev.Device):
-        """Ensures that a device is related to pico2ice and reroutes the event to handleAddDevice or
-        handleRemoveDevice."""
+        """Ensures that a device is related to pico2ice, records it in the device index and routes
+        the event to the corresponding Device."""
         if self.exiting:
             return
 
-        if dev.properties.get("ID_VENDOR_ID") not in ["2e8a", "1209"]:
+        if dev.properties.get("ID_VENDOR_ID") not in VENDOR_IDS:
             return
 
         dev = dict(dev)
 
-        serial = get_serial(dev)
+        serial = DEVICE_INDEX.update(action, dev)
 
         if not serial:
             return
 
+        self._routeDevEvent(serial, action, dev)
+
+    def _routeDevEvent(self, serial: str, action: str, dev: dict):
         with self._dev_lock:
             device = self._devs.get(serial)
 
             if not device:
-                self.database.addDevice(serial)
                 device = Device(serial, self, self.event_sender, self.database, self.logger)
                 self._devs[serial] = device
-
-        thread = threading.Thread(target=lambda : device.handleDeviceEvent(action, dev), name="dev-event-handler")
-        thread.start()
-
-    def handleRequest(self, serial: str, event: str, contents: dict):
+                # registering and flashing run on the pool rather than the observer thread
+                device.mailbox.post(lambda : self._startDevice(device))
+
+        if not device.mailbox.post(lambda : device.handleDeviceEvent(action, dev)):
+            self.logger.warning(f"mailbox of {serial} is full, dropped {action} event")
+
+    def _startDevice(self, device: Device):
+        self.database.addDevice(device.serial)
+        device.start()
+
+    def stateChanged(self, previous: str | None, state: str | None):
+        """Called when a device switches from the state named previous to state. None stands for
+        no state, i.e. a device that was just added or was deleted."""
+        if previous:
+            DEVICE_STATES.labels(previous).dec()
+        if state:
+            DEVICE_STATES.labels(state).inc()
+
+    def handleRequest(self, serial: str, event: str, contents: dict) -> bool:
+        """Queues a client request for the device. Returns False if the device does not exist
+        or its mailbox is full."""
         with self._dev_lock:
             dev = self._devs.get(serial)
 
         if not dev:
             self.logger.warning(f"request for {event} on {serial} but device not found")
-            return
+            return False
 
-        return dev.handleRequest(event, contents)
+        self.database.reportActivity(serial)
 
-    def reserve(self, serial: str, kind: str, args: dict):
+        if not dev.mailbox.post(lambda : dev.handleRequest(event, contents)):
+            self.logger.error(f"mailbox of {serial} is full, dropped {event} request")
+            return False
+
+        return True
+
+    def setWarmTargets(self, targets: dict[str, int]) -> bool:
+        """Flashes idle devices so that targets[kind] of them run the firmware of kind. Devices with the
+        default firmware are used first, then devices running firmware beyond the target of its kind."""
+        with self._dev_lock:
+            devices = list(self._devs.values())
+
+        idle: dict[str | None, list[Device]] = {}
+        # devices still being flashed by an earlier call, which may wait behind other flashes for a while
+        warming: dict[str, int] = {}
+        for device in devices:
+            if device.isIdle():
+                idle.setdefault(device.firmware, []).append(device)
+            elif (kind := device.warming):
+                warming[kind] = warming.get(kind, 0) + 1
+
+        spare = list(idle.get(None, []))
+        for firmware, warm in idle.items():
+            if firmware is not None:
+                spare.extend(warm[max(targets.get(firmware, 0), 0):])
+
+        for kind, target in targets.items():
+            WARM_TARGET.labels(kind).set(target)
+            WARM_DEVICES.labels(kind).set(len(idle.get(kind, [])))
+
+            for _ in range(target - len(idle.get(kind, [])) - warming.get(kind, 0)):
+                if not spare:
+                    break
+
+                device = spare.pop(0)
+                device.mailbox.post(lambda device=device, kind=kind : device.warm(kind))
+
+        return True
+
+    def reserve(self, serial: str, kind: str, args: dict) -> dict | bool:
+        """Queues the reservation of a device and returns its job without waiting for the device to
+        switch over, as this can include flashing. The job finishes when the device sends its initialized
+        or failure event and can be followed with job. Returns False if the device does not exist,
+        the arguments are invalid or the mailbox of the device is full."""
         with self._dev_lock:
             device = self._devs.get(serial)
 
@@ -100,7 +214,34 @@ class DeviceManager:
             self.logger.error(f"device {serial} reserved but does not exist")
             return False
 
-        return device.handleReserve(kind, args)
+        # only builds the factory, the state is created once the job runs
+        if not get_reservation_state_fac(device, kind, args):
+            self.logger.error(f"invalid {kind} reservation for {serial}")
+            return False
+
+        job = self.reserve_jobs.create(serial, kind)
+
+        if not device.mailbox.post(lambda : device.runReserveJob(job["job"], kind, args)):
+            self.logger.error(f"mailbox of {serial} is full, dropped {kind} reservation")
+            self.reserve_jobs.update(job["job"], JOB_FAILED)
+            return False
+
+        return job
+
+    def job(self, job: str) -> dict | bool:
+        """Returns the reserve job with id job, or False if it does not exist or expired."""
+        return self.reserve_jobs.get(job) or False
+
+    def timeline(self, serial: str) -> list[dict] | bool:
+        """Returns the recent state switches and bring-up stages of a device, oldest first. Returns
+        False if the device does not exist."""
+        with self._dev_lock:
+            dev = self._devs.get(serial)
+
+        if not dev:
+            return False
+
+        return dev.timeline.get()
 
     def unreserve(self, serial: str):
         with self._dev_lock:
@@ -127,16 +268,15 @@ class DeviceManager:
         if not dev:
             return False
 
+        dev.mailbox.close()
         dev.handleExit()
+        self.stateChanged(dev.state, None)
         with self._dev_lock:
             if serial in self._devs:
                 del self._devs[serial]
 
-        context = pyudev.Context().list_devices()
-
-        for dev in context:
-            if get_serial(dict(dev)) == serial:
-                self.handleDevEvent("add", dev)
+        for dev in DEVICE_INDEX.get(serial):
+            self._routeDevEvent(serial, "add", dev)
 
         return True
 
@@ -0,0 +1,112 @@
+from __future__ import annotations
+from logging import Logger
+import heapq
+import itertools
+import re
+import threading
+import time
+from typing import Callable
+
+from icefarm.utils.dev import FLASH_STAGE_SECONDS
+from icefarm.utils.Metrics import METRICS
+
+# flashes running at once behind the same usb hub
+FLASHES_PER_HUB = 2
+
+# lower goes first
+PRIORITY_RESERVED = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_WARM = 2
+PRIORITY_NAMES = {PRIORITY_RESERVED: "reserved", PRIORITY_DEFAULT: "default", PRIORITY_WARM: "warm"}
+
+QUEUE_DEPTH = METRICS.gauge("worker_flash_queue_depth", "Flashes waiting for a slot on their usb hub, by priority", ["priority"])
+RUNNING = METRICS.gauge("worker_flashes_running", "Flashes in progress, by usb hub", ["hub"])
+
+def get_hub(dev_path: str) -> str | None:
+    """Returns the usb hub a device is plugged into from its DEVPATH, e.g. 1-7 for a device on
+    port 1-7.3, or usb1 for a device plugged directly into bus 1. Returns None if unknown. Unlike
+    get_busid, this uses the deepest port so that devices behind chained hubs are told apart."""
+    if not (ports := re.findall(r"/([0-9]+-[0-9.]+)(?=[/:])", dev_path)):
+        return None
+
+    busid = ports[-1]
+
+    if "." in busid:
+        return busid.rsplit(".", 1)[0]
+
+    return f"usb{busid.split('-')[0]}"
+
+class FlashJob:
+    def __init__(self, serial: str, hub: str, priority: int, start: Callable[[], None], method: str):
+        self.serial = serial
+        self.hub = hub
+        self.priority = priority
+        self.start = start
+        self.method = method
+        self.queued_at = time.perf_counter()
+        self.running = False
+        self.done = False
+
+class FlashScheduler:
+    """Queues flashes and limits how many run at once behind each usb hub, so that re-enumeration
+    and writes to the bootloader drives of many devices do not compete on the same hub. Within a hub,
+    flashes for reservations go before default reflashes, which go before warm pool flashes."""
+    def __init__(self, logger: Logger, per_hub: int=FLASHES_PER_HUB):
+        self.logger = logger
+        self.per_hub = max(per_hub, 1)
+        self.lock = threading.Lock()
+        # hub -> heap of (priority, order, job)
+        self.queues: dict[str, list[tuple[int, int, FlashJob]]] = {}
+        self.running: dict[str, int] = {}
+        self.order = itertools.count()
+
+    def submit(self, serial: str, hub: str | None, priority: int, start: Callable[[], None], method: str) -> FlashJob:
+        """Queues a flash. start is called once the hub has a free slot, and should return quickly.
+        Each job has to be released once the flash is over or no longer wanted."""
+        job = FlashJob(serial, hub or "unknown", priority, start, method)
+
+        with self.lock:
+            heapq.heappush(self.queues.setdefault(job.hub, []), (priority, next(self.order), job))
+            QUEUE_DEPTH.labels(PRIORITY_NAMES.get(priority, str(priority))).inc()
+
+        self._dispatch()
+        return job
+
+    def release(self, job: FlashJob):
+        """Frees the slot of a running job, or drops a job that is still queued."""
+        with self.lock:
+            if job.done:
+                return
+
+            job.done = True
+            if job.running:
+                self.running[job.hub] -= 1
+                RUNNING.labels(job.hub).set(self.running[job.hub])
+            else:
+                # skipped when it reaches the front of the queue
+                QUEUE_DEPTH.labels(PRIORITY_NAMES.get(job.priority, str(job.priority))).dec()
+
+        self._dispatch()
+
+    def _dispatch(self):
+        started = []
+        with self.lock:
+            for hub, queue in self.queues.items():
+                while queue and self.running.get(hub, 0) < self.per_hub:
+                    _, _, job = heapq.heappop(queue)
+                    if job.done:
+                        continue
+
+                    QUEUE_DEPTH.labels(PRIORITY_NAMES.get(job.priority, str(job.priority))).dec()
+                    job.running = True
+                    self.running[hub] = self.running.get(hub, 0) + 1
+                    RUNNING.labels(hub).set(self.running[hub])
+                    started.append(job)
+
+        for job in started:
+            FLASH_STAGE_SECONDS.labels(job.method, "queued").observe(time.perf_counter() - job.queued_at)
+            try:
+                job.start()
+            except Exception as e:
+                self.logger.error(f"[{job.serial}] failed to start flash: {e}")
+                self.release(job)
@@ -0,0 +1,121 @@
+from __future__ import annotations
+from logging import Logger
+import collections
+import queue
+import threading
+from typing import Callable
+
+from icefarm.utils.Metrics import METRICS
+
+# messages waiting per device before new messages are refused
+MAILBOX_SIZE = 256
+# threads serving the mailboxes of all devices
+POOL_WORKERS = 8
+
+MAILBOX_DEPTH = METRICS.gauge("device_mailbox_depth", "Messages waiting in the mailbox of a device", ["serial"])
+MAILBOX_DROPPED = METRICS.counter("device_mailbox_dropped", "Messages refused because the mailbox of a device was full", ["serial"])
+POOL_BUSY = METRICS.gauge("device_pool_busy_workers", "Pool threads currently handling a device message")
+LIVE_THREADS = METRICS.gauge("worker_threads", "Threads alive in the worker process")
+
+class MailboxPool:
+    """Fixed set of threads that serve device mailboxes. A mailbox with messages waiting is scheduled
+    at most once, so the messages of a device are handled one at a time and in the order they were
+    posted, while different devices are handled concurrently."""
+    def __init__(self, workers: int=POOL_WORKERS):
+        self.ready: queue.SimpleQueue[Mailbox] = queue.SimpleQueue()
+        self.busy = 0
+        self.busy_lock = threading.Lock()
+
+        self.threads = [threading.Thread(target=self._serve, name=f"device-pool-{i}", daemon=True) for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def _serve(self):
+        while True:
+            mailbox = self.ready.get()
+
+            with self.busy_lock:
+                self.busy += 1
+                POOL_BUSY.set(self.busy)
+
+            try:
+                mailbox._handleNext()
+            finally:
+                with self.busy_lock:
+                    self.busy -= 1
+                    POOL_BUSY.set(self.busy)
+
+                LIVE_THREADS.set(threading.active_count())
+
+class Mailbox:
+    """Bounded queue of messages for a single device, served by a MailboxPool."""
+    def __init__(self, pool: MailboxPool, serial: str, logger: Logger, max_size: int=MAILBOX_SIZE):
+        self.pool = pool
+        self.serial = serial
+        self.logger = logger
+        self.max_size = max_size
+
+        self.messages: collections.deque[Callable[[], None]] = collections.deque()
+        self.lock = threading.Lock()
+        # whether the mailbox is waiting in the pool's ready queue or being served
+        self.scheduled = False
+        self.closed = False
+
+    def post(self, message: Callable[[], None]) -> bool:
+        """Queues message to be called by the pool. Returns False if the mailbox is full."""
+        with self.lock:
+            if self.closed:
+                return False
+
+            if len(self.messages) >= self.max_size:
+                MAILBOX_DROPPED.labels(self.serial).inc()
+                return False
+
+            self.messages.append(message)
+            MAILBOX_DEPTH.labels(self.serial).set(len(self.messages))
+
+            if self.scheduled:
+                return True
+
+            self.scheduled = True
+
+        self.pool.ready.put(self)
+        return True
+
+    def _handleNext(self):
+        """Handles one message, then reschedules the mailbox behind other devices if more are waiting."""
+        with self.lock:
+            if not self.messages:
+                # closed while waiting to be served
+                self.scheduled = False
+                return
+
+            message = self.messages.popleft()
+
+        try:
+            message()
+        except Exception as e:
+            self.logger.exception(f"failed to handle device message: {e}")
+
+        with self.lock:
+            if not self.closed:
+                MAILBOX_DEPTH.labels(self.serial).set(len(self.messages))
+
+            if not self.messages:
+                self.scheduled = False
+                return
+
+        self.pool.ready.put(self)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.messages)
+
+    def close(self):
+        """Drops waiting messages and the metrics of the device."""
+        with self.lock:
+            self.closed = True
+            self.messages.clear()
+
+        MAILBOX_DEPTH.remove(self.serial)
+        MAILBOX_DROPPED.remove(self.serial)
@@ -0,0 +1,88 @@
+from __future__ import annotations
+import threading
+import time
+import uuid
+
+from icefarm.utils.Metrics import METRICS
+
+# finished jobs are kept this long for status queries
+JOB_RETENTION_SECONDS = 10 * 60
+
+# the reservation is waiting in the mailbox of the device
+JOB_QUEUED = "queued"
+# the device switched to the reserved state and is getting ready, e.g. flashing
+JOB_STARTING = "starting"
+# the device sent its initialized event
+JOB_INITIALIZED = "initialized"
+JOB_FAILED = "failed"
+# the reservation ended or was replaced before the device was ready
+JOB_CANCELLED = "cancelled"
+FINISHED = (JOB_INITIALIZED, JOB_FAILED, JOB_CANCELLED)
+
+JOB_SECONDS = METRICS.histogram("worker_reserve_job_seconds", "Time from a reservation reaching the worker until the device was ready or failed", ["status"], buckets=(0.1, 0.5, 1, 2.5, 5, 10, 15, 30, 60, 120))
+
+class ReserveJobs:
+    """Tracks reservations that are being set up on devices in the background, so that the worker can
+    answer reserve commands right away. A device has at most one unfinished job."""
+    def __init__(self, retention_seconds: float=JOB_RETENTION_SECONDS):
+        self.retention_seconds = retention_seconds
+        self.lock = threading.Lock()
+        self.jobs: dict[str, dict] = {}
+        # serial -> id of the last job of the device
+        self.current: dict[str, str] = {}
+
+    def create(self, serial: str, kind: str) -> dict:
+        """Adds a queued job for serial, cancelling the unfinished job the device may still have."""
+        now = time.time()
+        job = {"job": uuid.uuid4().hex, "serial": serial, "kind": kind, "status": JOB_QUEUED, "created": now, "updated": now}
+
+        with self.lock:
+            self._prune(now)
+
+            if (previous := self.current.get(serial)):
+                self._finish(previous, JOB_CANCELLED, now)
+
+            self.jobs[job["job"]] = job
+            self.current[serial] = job["job"]
+            return dict(job)
+
+    def update(self, job_id: str, status: str) -> bool:
+        """Sets the status of a job. Returns False if the job does not exist or already finished."""
+        with self.lock:
+            if not (job := self.jobs.get(job_id)) or job["status"] in FINISHED:
+                return False
+
+            if status in FINISHED:
+                self._finish(job_id, status, time.time())
+            else:
+                job["status"] = status
+                job["updated"] = time.time()
+
+            return True
+
+    def finishDevice(self, serial: str, status: str):
+        """Finishes the unfinished job of serial, if any."""
+        with self.lock:
+            if (job_id := self.current.get(serial)):
+                self._finish(job_id, status, time.time())
+
+    def get(self, job_id: str) -> dict | None:
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def _finish(self, job_id: str, status: str, now: float):
+        job = self.jobs.get(job_id)
+        if not job or job["status"] in FINISHED:
+            return
+
+        job["status"] = status
+        job["updated"] = now
+        JOB_SECONDS.labels(status).observe(now - job["created"])
+
+    def _prune(self, now: float):
+        expired = [job_id for job_id, job in self.jobs.items() if job["status"] in FINISHED and now - job["updated"] > self.retention_seconds]
+        for job_id in expired:
+            job = self.jobs.pop(job_id)
+            if self.current.get(job["serial"]) == job_id:
+                del self.current[job["serial"]]
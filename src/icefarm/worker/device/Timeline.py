@@ -0,0 +1,52 @@
+from __future__ import annotations
+import collections
+import threading
+import time
+
+from icefarm.utils.Metrics import METRICS
+
+# entries kept per device
+TIMELINE_SIZE = 128
+
+TIMELINE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+STATE_SECONDS = METRICS.histogram("worker_device_state_seconds", "Time devices spent in a state before switching to the next one", ["state"], buckets=TIMELINE_BUCKETS)
+STAGE_SECONDS = METRICS.histogram("worker_device_stage_seconds", "Time spent in stages of bringing up a device outside of flash_stage, e.g. waiting for the bootloader drive or connecting to serial", ["stage"], buckets=TIMELINE_BUCKETS)
+
+class Timeline:
+    """Ring buffer of the recent state switches and bring-up stages of a device. Each entry has the
+    wall clock time it was recorded at, the state of the device at that time, the event and, for
+    switches and stages, how long the previous state or the stage took in seconds."""
+    def __init__(self, size: int=TIMELINE_SIZE):
+        self.lock = threading.Lock()
+        self.entries: collections.deque[dict] = collections.deque(maxlen=size)
+        self.state: str | None = None
+        self.state_started: float | None = None
+
+    def enter(self, state: str):
+        """Records a switch to state and how long the device spent in the previous one."""
+        now = time.perf_counter()
+
+        with self.lock:
+            seconds = None
+            if self.state is not None:
+                seconds = now - self.state_started
+                STATE_SECONDS.labels(self.state).observe(seconds)
+
+            self.state = state
+            self.state_started = now
+            self.entries.append({"time": time.time(), "state": state, "event": "switch", "seconds": seconds})
+
+    def mark(self, event: str, seconds: float=None):
+        """Records event in the current state, optionally with how long it took."""
+        with self.lock:
+            self.entries.append({"time": time.time(), "state": self.state, "event": event, "seconds": seconds})
+
+    def stage(self, stage: str, seconds: float):
+        """Records a bring-up stage that is not timed by flash_stage and adds it to the histograms."""
+        STAGE_SECONDS.labels(stage).observe(seconds)
+        self.mark(stage, seconds)
+
+    def get(self) -> list[dict]:
+        """Returns the entries, oldest first."""
+        with self.lock:
+            return [dict(entry) for entry in self.entries]
@@ -1,24 +1,26 @@
 from __future__ import annotations
 import threading
-from logging import Logger, LoggerAdapter
+from logging import Logger
 
-from icefarm.utils import typecheck
+from icefarm.utils import typecheck, json_to_args
+from icefarm.utils.ContextLogger import ContextLogger
 from icefarm.utils.dev import *
 from icefarm.worker.device import Device
 
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
-    from icefarm.worker import WorkerDatabase, Config, DeviceEventSender
+    from icefarm.worker import WorkerDatabase, Config, DeviceEventSender, Spool
 
 class EventMethod:
-    def __init__(self, method, parms):
+    def __init__(self, method, parms, defaults=None):
         self.method = method
         self.parms = parms
+        self.defaults = defaults
 
     def __call__(self, device, data):
-        args = list(map(data.get, self.parms))
+        args = json_to_args(data, self.parms, self.defaults)
 
-        if None in args:
+        if args is False:
             return
 
         if not typecheck(self.method, (device, *args)):
@@ -26,13 +28,10 @@ class EventMethod:
 
         return self.method(device, *args)
 
-class StateLogger(LoggerAdapter):
+class StateLogger(ContextLogger):
     def __init__(self, logger: Logger, state: str, extra = None):
+        super().__init__(logger, f"[{state}]", state=state)
         self.state = state
-        super().__init__(logger, extra={})
-
-    def process(self, msg, kwargs):
-        return f"[{self.state}] {msg}", kwargs
 
 class AbstractState:
     methods = {}
@@ -84,6 +83,11 @@ class AbstractState:
     def handleExit(self):
         """Cleanup"""
 
+    def runBlocking(self, name: str, work, done):
+        """Calls work on its own thread and posts done with its result to the mailbox of the device,
+        see Device.runBlocking. done is skipped if the device left this state in the meantime."""
+        return self.device.runBlocking(name, work, lambda result : self.device.runInState(self, lambda : done(result)))
+
     def switch(self, state_factory):
         """Switches the Device's state to a new one. This happens by first calling
         exit on the existing state. After the existing state has exited, the
@@ -98,7 +102,7 @@ class AbstractState:
         return self.device.switch(state_factory)
 
     @classmethod
-    def register(cls, event, *args):
+    def register(cls, event, *args, defaults: dict=None):
         # TODO
         # update this for sockets
         # test typechecking with sockets
@@ -108,6 +112,7 @@ class AbstractState:
         The values passed in from the client are typechecked. Currently, only type and list[type]
         are supported. Files should be sent as cp437 encoded bytes. If the file is needed later, it
         should be saved under self.getDevice().getMediaPath(). Parameters without types are treated as Any.
+        Keys missing from the request are taken from defaults if present, otherwise the event is ignored.
 
         Ex.
         >>> class ExampleDevice:
@@ -131,7 +136,7 @@ class AbstractState:
                 if name in cls.methods[owner]:
                     raise Exception(f"{event} already registered")
 
-                cls.methods[owner][event] = EventMethod(self.fn, args)
+                cls.methods[owner][event] = EventMethod(self.fn, args, defaults)
                 setattr(owner, name, self.fn)
 
         return Reg
@@ -152,6 +157,10 @@ class AbstractState:
     def config(self) -> Config:
         return self.device.config
 
+    @property
+    def spool(self) -> Spool | None:
+        return self.device.spool
+
     @property
     def switching(self):
         """Whether the Device is currently switching states"""
@@ -1,41 +1,133 @@
 import threading
+import time
 
 from icefarm.worker.device.state.core import AbstractState, BrokenState
+from icefarm.worker.device.FlashScheduler import get_hub, PRIORITY_RESERVED
 
-from icefarm.utils.dev import send_bootloader, upload_firmware_path, get_devs
+from icefarm.utils.dev import send_bootloader, touch_bootloader, upload_firmware_path, upload_firmware_direct, flash_stage_listener, FLASH_DIRECT, FLASH_STAGE_SECONDS, DEVICE_INDEX
+from icefarm.utils.Metrics import METRICS
+
+# deadline for flashes without a timeout to finish once they have a slot, so that a device whose
+# bootloader drive never shows up does not hold a slot on its hub
+SLOT_TIMEOUT_SECONDS = 60
+# times the bootloader signal is sent before the device is considered broken
+BOOTLOADER_ATTEMPTS = 3
+
+FLASHES = METRICS.counter("worker_flashes", "Firmware flashes by result: ok, failed, timeout or skipped when the device already ran the firmware", ["result"])
 
 class FlashState(AbstractState):
-    def __init__(self, state, firmware_path, next_state_factory, timeout=None):
+    def __init__(self, state, firmware_path, next_state_factory, timeout=None, firmware=None, priority=PRIORITY_RESERVED):
+        """If firmware is the name of the reservable the firmware belongs to and the device is
+        already running it, flashing is skipped. Flashing waits for a slot on the usb hub of the
+        device, taken in order of priority. The timeout starts once flashing does, flashes without
+        one give up their slot after SLOT_TIMEOUT_SECONDS."""
         super().__init__(state)
         self.firmware_path = firmware_path
+        self.firmware = firmware
         self.next_state_factory = next_state_factory
+        self.timeout = timeout
+        self.priority = priority
         self.timer = None
+        self.job = None
         self._flash_lock = threading.Lock()
+        self._granted = False
         self._uploading = False
         self._bootloader_sent = False
-
-        # TODO dont think is is enabled for default firmware
-        if timeout:
-            def do_timeout():
-                self.logger.error("flashing timed out")
-                self.switch(lambda : BrokenState(self.device))
-
-            self.timer = threading.Timer(timeout, do_timeout)
-            self.timer.daemon = True
-            self.timer.name = f"{self.serial}-flash-timeout"
-            self.timer.start()
+        self.method = self.device.config.flash_method
+        self.started = None
+        self.bootloader_sent_at = None
+        self.attempts = 0
 
     def start(self):
-        devs = get_devs().get(self.serial)
-        if not devs:
+        if self._reuseFirmware():
             return
 
-        for file in devs:
+        self._submit()
+
+    def _submit(self):
+        hub = next((hub for dev in DEVICE_INDEX.get(self.serial) if (hub := get_hub(dev.get("DEVPATH", "")))), None)
+        self.job = self.device.manager.flash_scheduler.submit(self.serial, hub, self.priority, self._slotGranted, self.method)
+
+    def _slotGranted(self):
+        # the flash starts from the mailbox so that it is ordered with the events of the device
+        if not self.device.mailbox.post(lambda : self.device.runInState(self, self._begin)):
+            self.logger.error("mailbox full, giving up flash slot")
+            self._release()
+            self.switch(lambda : BrokenState(self.device))
+
+    def _begin(self):
+        """Starts flashing once the scheduler has given the device a slot on its hub."""
+        with self._flash_lock:
+            if self.switching or self._granted:
+                return
+
+            self._granted = True
+            self.started = time.perf_counter()
+
+        self.device.timeline.mark("flash slot granted")
+
+        def do_timeout():
+            self.logger.error("flashing timed out")
+            FLASHES.labels("timeout").inc()
+            self._release()
+            self.switch(lambda : BrokenState(self.device))
+
+        self.timer = threading.Timer(self.timeout or SLOT_TIMEOUT_SECONDS, do_timeout)
+        self.timer.daemon = True
+        self.timer.name = f"{self.serial}-flash-timeout"
+        self.timer.start()
+
+        for file in DEVICE_INDEX.get(self.serial):
             if self.switching:
                 return
 
             self.handleAdd(file)
 
+    def _release(self):
+        if self.job:
+            self.device.manager.flash_scheduler.release(self.job)
+
+    def _retry(self, reason: str):
+        """Gives up the slot and queues the flash again, or switches to BrokenState once
+        the device ran out of attempts."""
+        if self.timer:
+            self.timer.cancel()
+        self._release()
+
+        self.attempts += 1
+        if self.attempts >= BOOTLOADER_ATTEMPTS:
+            self.logger.error(f"{reason}, giving up")
+            FLASHES.labels("failed").inc()
+            self.switch(lambda : BrokenState(self.device))
+            return
+
+        self.logger.warning(f"{reason}, retrying")
+        with self._flash_lock:
+            self._granted = False
+            self._bootloader_sent = False
+
+        if not self.switching:
+            self._submit()
+
+    def handleExit(self):
+        if self.timer:
+            self.timer.cancel()
+        self._release()
+
+    def _reuseFirmware(self) -> bool:
+        """Switches straight to the next state if the device kept the firmware from its last reservation.
+        Otherwise the device is marked as no longer running a known firmware."""
+        if self.firmware is None or self.device.firmware != self.firmware:
+            self.device.firmware = None
+            return False
+
+        self.logger.info(f"already running {self.firmware} firmware, skipping flash")
+        FLASHES.labels("skipped").inc()
+        if self.timer:
+            self.timer.cancel()
+        self.switch(self.next_state_factory)
+        return True
+
     def handleAdd(self, dev):
         devname = dev.get("DEVNAME")
 
@@ -45,6 +137,8 @@ class FlashState(AbstractState):
 
         if dev.get("SUBSYSTEM") == "tty":
             with self._flash_lock:
+                if not self._granted:
+                    return
                 if self._uploading:
                     self.logger.debug(f"ignoring tty event for {devname}, upload in progress")
                     return
@@ -53,27 +147,69 @@ class FlashState(AbstractState):
                     return
                 self._bootloader_sent = True
             self.logger.debug(f"sending bootloader signal to {devname}")
-            send_bootloader(devname)
+            self.runBlocking("bootloader", lambda : self._sendBootloader(devname), lambda sent : self._bootloaderSent(devname, sent))
             return
 
         if dev.get("DEVTYPE") == "partition":
             with self._flash_lock:
+                if not self._granted:
+                    return
                 if self._uploading:
                     self.logger.debug(f"ignoring duplicate partition event for {devname}")
                     return
                 self._uploading = True
 
             self.logger.debug(f"found bootloader candidate {devname}")
+            if self.bootloader_sent_at is not None:
+                # the device rebooting into the bootloader and its drive showing up
+                self.device.timeline.stage("partition seen", time.perf_counter() - self.bootloader_sent_at)
+            else:
+                self.device.timeline.mark("partition seen")
+
+            self.runBlocking("upload", lambda : self._upload(devname), lambda uploaded : self._uploaded(devname, uploaded))
+
+    def _sendBootloader(self, devname: str) -> bool:
+        with flash_stage_listener(self.device.timeline.mark):
+            if self.method == FLASH_DIRECT:
+                sent = touch_bootloader(devname)
+            else:
+                # picocom exits with an error once the device resets and its tty disappears, so
+                # its result says nothing about the signal, a lost signal runs into the slot deadline
+                send_bootloader(devname)
+                sent = True
+
+        self.bootloader_sent_at = time.perf_counter()
+        return sent
+
+    def _bootloaderSent(self, devname: str, sent: bool):
+        if not sent:
+            self._retry(f"failed to send bootloader signal to {devname}")
+
+    def _upload(self, devname: str) -> bool:
+        with flash_stage_listener(self.device.timeline.mark):
+            if self.method == FLASH_DIRECT:
+                uploaded = upload_firmware_direct(devname, self.firmware_path)
+            else:
+                uploaded = upload_firmware_path(devname, self.device.mount_path, self.firmware_path)
+
+        # the device reboots into the new firmware on its own, the hub is free for the next flash
+        self._release()
+
+        FLASHES.labels("ok" if uploaded else "failed").inc()
+
+        if uploaded:
+            # from getting a slot until the firmware is on the drive, including the bootloader reboot
+            FLASH_STAGE_SECONDS.labels(self.method, "total").observe(time.perf_counter() - self.started)
+
+        return uploaded
+
+    def _uploaded(self, devname: str, uploaded: bool):
+        if self.timer:
+            self.timer.cancel()
+
+        if not uploaded:
+            self.logger.error(f"failed to upload firmware to {devname}")
+            self.switch(lambda : BrokenState(self.device))
+            return
 
-            uploaded = upload_firmware_path(devname, self.device.mount_path, self.firmware_path)
-
-            if not uploaded:
-                self.logger.error(f"failed to upload firmware to {devname}")
-                if self.timer:
-                    self.timer.cancel()
-                self.switch(lambda : BrokenState(self.device))
-                return
-
-            if self.timer:
-                self.timer.cancel()
-            self.switch(self.next_state_factory)
+        self.switch(self.next_state_factory)
@@ -3,4 +3,7 @@ from icefarm.worker.device.state.core import AbstractState
 class ReadyState(AbstractState):
     def __init__(self, state):
         super().__init__(state)
+        # lets the control server prefer this device for reservations of the same kind
+        self.database.updateDeviceFirmware(self.serial, self.device.firmware)
         self.database.updateDeviceStatus(self.serial, "available")
+        self.device.manager.deviceSettled(self.serial)
@@ -1,5 +1,5 @@
 import time
-from logging import Logger, LoggerAdapter
+from logging import Logger
 import threading
 import uuid
 import re
@@ -12,7 +12,10 @@ import serial
 
 from icefarm.worker.device.state.core import AbstractState, FlashState, BrokenState
 from icefarm.utils import Queue, QueueShutDown, MappedQueues
-from icefarm.utils.dev import get_devs
+from icefarm.utils.dev import DEVICE_INDEX
+from icefarm.utils.ContextLogger import ContextLogger, CATEGORY_BITSTREAM
+from icefarm.utils.compression import CODEC_NONE, DecompressionError, decompress, supported_codecs
+from icefarm.utils.Metrics import METRICS
 
 if TYPE_CHECKING:
     from icefarm.worker.device import Device
@@ -21,21 +24,30 @@ BAUD = 115200            # ignored by TinyUSB but needed by pyserial
 CHUNK_SIZE = 512         # bytes per write
 INTER_CHUNK_DELAY = 0.00001  # seconds
 BITSTREAM_SIZE = 0 #TODO
+# time firmware kept from the last reservation has to print its prompt after the port is opened
+PROBE_TIMEOUT_SECONDS = 5
+
+BITSTREAMS_QUEUED = METRICS.gauge("worker_bitstreams_queued", "Bitstreams waiting to be evaluated, by device", ["serial"])
+BITSTREAMS_IN_FLIGHT = METRICS.gauge("worker_bitstreams_in_flight", "Bitstreams being written to or evaluated on a device", ["serial"])
+EVALUATIONS = METRICS.counter("worker_evaluations", "Bitstreams evaluated, by device. The evaluation rate is the rate of this counter", ["serial"])
+# ready: waiting for the device to accept a bitstream, write: sending it over serial,
+# evaluate: waiting for the result, parse: parsing a line of output
+EVALUATION_SECONDS = METRICS.histogram("worker_evaluation_seconds", "Time spent in each step of evaluating a bitstream", ["step"], buckets=(0.0001, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+REBOOTS = METRICS.counter("worker_reboots", "Reboots of reserved devices, on request or after a failed evaluation, by device", ["serial"])
 
 @dataclass
 class Bitstream:
     location: str
     name: str
     batch_id: str
+    # id of the bitstream in the worker's spool, None if it is not spooled
+    spool_id: int = None
 
-class UploadLogger(LoggerAdapter):
+class UploadLogger(ContextLogger):
     def __init__(self, logger: Logger, postfix: str, extra = None):
-        super().__init__(logger, extra={})
+        super().__init__(logger, postfix)
         self.postfix = postfix
 
-    def process(self, msg, kwargs):
-        return f"{self.postfix} {msg}", kwargs
-
 class UploadState(AbstractState):
     """
     State for evaluations that follow a common pattern:
@@ -43,7 +55,7 @@ class UploadState(AbstractState):
     - Upload bitstream, perform some calculations, print json formatted result
     - Send results to client
     """
-    def __init__(self, state, parser: Callable[[str], Any], reboot_firmware_path, logger_postfix=None, flush_interval_seconds=None, flush_at_bitstreams_remaining=25):
+    def __init__(self, state, parser: Callable[[str], Any], reboot_firmware_path, logger_postfix=None, flush_interval_seconds=None, flush_at_bitstreams_remaining=25, firmware=None):
         """
         Parameters:
         - parser: Function that parses output from device and returns parsed value, or None if no value was found
@@ -51,6 +63,7 @@ class UploadState(AbstractState):
         - logger_postfix: Optional string added before logger output. Intended to contain reservable name, as it would otherwise only show UploadState
         - flush_interval_seconds: Time between automatic result flushes, use 0 or None to disable
         - flush_at_bitstreams_remaining: Optionally flush once a low amount of bitstreams is received so that the client knows to send more. Note that flushes happen at 0 remaining regardless of this parameter.
+        - firmware: Name of the reservable the firmware belongs to. Once connected, the device remembers it so that later reservations of the same kind can skip flashing
         """
         super().__init__(state)
         if logger_postfix:
@@ -62,6 +75,8 @@ class UploadState(AbstractState):
         self.current_bitstream = None
         # name -> pulses
         self.results = MappedQueues()
+        # spool id of the last result in self.results
+        self.spooled_result_id = None
         # TODO configurable by client
         self.flush_interval_seconds = flush_interval_seconds
         self.last_flush_time = time.time()
@@ -71,42 +86,124 @@ class UploadState(AbstractState):
         self.reader = None
         self.sender = None
         self.thread = None
+        self.firmware = firmware
+        # whether flashing was skipped because the device kept its firmware from the last reservation
+        self.reused = False
+        # guards handing the port over from the connect thread against the state exiting
+        self._connect_lock = threading.Lock()
+        self._exited = False
 
     def start(self):
-        # ensure new ports show correctly
-        # TODO this better
-        time.sleep(2)
+        self.reused = self.firmware is not None and self.device.firmware == self.firmware
+        # includes waiting for the port of freshly flashed firmware
+        connect_started = time.perf_counter()
+        self.runBlocking("serial-connect", self._connect, lambda connected : self._connected(connected, connect_started))
+
+    def _connect(self) -> bool | None:
+        """Opens the serial port and, for kept firmware, waits for its prompt. Returns None if the port
+        could not be opened and False if the kept firmware did not respond."""
+        if not self.reused:
+            # ensure new ports show correctly
+            # TODO this better
+            time.sleep(2)
+
+        ser = self.connectSerial()
+        if ser is None:
+            return None
+
+        # opening the port reconnects the kept firmware, which then prints its prompt again
+        reader = Reader(ser, self.parser, self.logger, ready=not self.reused)
+
+        with self._connect_lock:
+            if self._exited:
+                reader.exit()
+                ser.close()
+                return None
+
+            self.ser = ser
+            self.reader = reader
+
+        return not self.reused or reader.waitForPrompt(PROBE_TIMEOUT_SECONDS)
+
+    def _connected(self, connected: bool | None, connect_started: float):
+        if connected is None:
+            self.logger.error("serial port not available after retries")
+            if self.reused:
+                # the kept firmware is not healthy, flash it again instead of giving up on the device
+                self.reboot()
+            else:
+                self.switch(lambda: BrokenState(self.device))
+            return
 
-        self.ser = self.connectSerial()
-        if self.ser is None:
+        if not connected:
+            self.logger.error("kept firmware did not respond, flashing it again")
+            self.reboot()
             return
-        self.reader = Reader(self.ser, self.parser, self.logger)
+
+        self.device.timeline.stage("serial connect", time.perf_counter() - connect_started)
+
+        self.device.firmware = self.firmware
         self.sender = UploadEventSender(self.device_event_sender)
 
+        if self.device.resumed:
+            self.device.resumed = False
+            self._replaySpool()
+
         self.thread = threading.Thread(target=self.run)
         self.thread.start()
 
-        self.device_event_sender.sendDeviceInitialized()
+        self.device_event_sender.sendDeviceInitialized({"compression": supported_codecs()})
 
-    def connectSerial(self, max_retries=5, retry_delay=2):
+    def connectSerial(self, max_retries=5, retry_delay=2) -> serial.Serial | None:
         for attempt in range(max_retries):
-            paths = get_devs().get(self.serial)
+            port = DEVICE_INDEX.tty(self.serial)
 
-            if paths:
-                port = list(filter(lambda x: x.get("ID_USB_INTERFACE_NUM") == "00", paths))
-                if port:
-                    port = port[0].get("DEVNAME")
+            if port:
+                try:
                     return serial.Serial(port, BAUD, timeout=0.1)
+                except (serial.SerialException, OSError) as e:
+                    # the port may be left over from before the device reset
+                    self.logger.debug(f"failed to open serial port {port}: {e}, retrying ({attempt + 1}/{max_retries})")
+            else:
+                self.logger.debug(f"serial port not found, retrying ({attempt + 1}/{max_retries})")
 
-            self.logger.debug(f"serial port not found, retrying ({attempt + 1}/{max_retries})")
             time.sleep(retry_delay)
 
-        self.logger.error("serial port not found after retries")
-        self.switch(lambda: BrokenState(self.device))
         return None
 
-    @AbstractState.register("evaluate", "files", "batch_id")
-    def queue(self, files, batch_id):
+    def _replaySpool(self):
+        """Queues the bitstreams and sends the results that were spooled before the worker restarted."""
+        bitstreams = []
+        for spool_id, location, name, batch_id in self.spool.getBitstreams(self.serial):
+            if not os.path.exists(location):
+                self.logger.warning(f"spooled bitstream {name} is missing")
+                self.spool.removeBitstream(spool_id)
+                continue
+
+            bitstreams.append(Bitstream(location, name, batch_id, spool_id))
+
+        spooled_results = self.spool.getResults(self.serial)
+        results = MappedQueues()
+        for _, batch_id, name, result in spooled_results:
+            results.append(batch_id, (name, result))
+
+        self.logger.info(f"replaying {len(bitstreams)} spooled bitstreams and {len(spooled_results)} results")
+
+        if spooled_results and self.sender.finished(results):
+            self.spool.removeResults(self.serial, spooled_results[-1][0])
+
+        if bitstreams:
+            self.bitstream_queue.put(bitstreams)
+            self._updateQueued()
+
+    @AbstractState.register("evaluate", "files", "batch_id", "compression", defaults={"compression": CODEC_NONE})
+    def queue(self, files, batch_id, compression):
+        try:
+            files = {name: decompress(data, compression) for name, data in files.items()}
+        except DecompressionError as e:
+            self.logger.error(f"failed to decompress bitstreams {list(files.keys())}: {e}")
+            return False
+
         media_path = self.device.media_path
         paths = [str(media_path.joinpath(str(uuid.uuid4()))) for _ in range(len(files))]
 
@@ -115,10 +212,16 @@ class UploadState(AbstractState):
                 f.write(data)
                 f.flush()
 
-        self.logger.debug(f"queued bitstreams: {list(files.keys())}")
+        self.logger.debug("queued bitstreams: %s", list(files), category=CATEGORY_BITSTREAM)
+
+        if self.spool:
+            spool_ids = self.spool.addBitstreams(self.serial, [(path, name, batch_id) for path, name in zip(paths, files.keys())])
+        else:
+            spool_ids = [None] * len(paths)
 
         try:
-            self.bitstream_queue.put(Bitstream(path, name, batch_id) for path, name in zip(paths, files.keys()))
+            self.bitstream_queue.put(Bitstream(path, name, batch_id, spool_id) for path, name, spool_id in zip(paths, files.keys(), spool_ids))
+            self._updateQueued()
         except QueueShutDown:
             # TODO inform client that this has happened, requires communication refactor first
             # as long as the client stops sending bitstreams before calling reboot this wont happen,
@@ -134,7 +237,10 @@ class UploadState(AbstractState):
 
         data_len = len(data)
 
+        started = time.perf_counter()
         self.reader.waitUntilReady()
+        ready = time.perf_counter()
+        EVALUATION_SECONDS.labels("ready").observe(ready - started)
 
         for i in range(0, data_len, CHUNK_SIZE):
             chunk = data[i:i+CHUNK_SIZE]
@@ -142,6 +248,14 @@ class UploadState(AbstractState):
             self.ser.flush()
             time.sleep(INTER_CHUNK_DELAY)
 
+        EVALUATION_SECONDS.labels("write").observe(time.perf_counter() - ready)
+
+    def _updateQueued(self):
+        try:
+            BITSTREAMS_QUEUED.labels(self.serial).set(len(self.bitstream_queue))
+        except QueueShutDown:
+            pass
+
     def _flush(self):
         """"""
         try:
@@ -153,6 +267,15 @@ class UploadState(AbstractState):
         if not flush_amount_ready and not flush_interval_ready:
             return False
 
+        # interval flushes are optional, wait for the client to catch up. Results are still
+        # sent once the bitstreams run out so the client knows to send more.
+        if not flush_amount_ready and self.device_event_sender.isBackpressured():
+            self.logger.debug("client is backpressured, deferring flush")
+            # checking looks up the client in the database, wait another interval rather than
+            # checking again after every result
+            self.last_flush_time = time.time()
+            return False
+
         if not self.sender.finished(self.results):
             self.logger.error("failed to send results")
             return False
@@ -160,6 +283,10 @@ class UploadState(AbstractState):
         self.results = MappedQueues()
         self.last_flush_time = time.time()
 
+        if self.spool and self.spooled_result_id is not None:
+            self.spool.removeResults(self.serial, self.spooled_result_id)
+            self.spooled_result_id = None
+
         return True
 
     def run(self):
@@ -171,7 +298,10 @@ class UploadState(AbstractState):
             except QueueShutDown:
                 return
 
-            self.logger.debug(f"uploading bitstream {self.current_bitstream.name}")
+            self._updateQueued()
+            BITSTREAMS_IN_FLIGHT.labels(self.serial).set(1)
+
+            self.logger.debug("uploading bitstream %s", self.current_bitstream.name, category=CATEGORY_BITSTREAM)
 
             try:
                 self._writeBitstream(self.current_bitstream)
@@ -179,23 +309,40 @@ class UploadState(AbstractState):
                 self.reboot()
                 return
 
-            self.logger.debug("waiting for result")
+            self.logger.debug("waiting for result", category=CATEGORY_BITSTREAM)
 
+            evaluating = time.perf_counter()
             try:
                 result = self.reader.waitUntilPulse()
+                EVALUATION_SECONDS.labels("evaluate").observe(time.perf_counter() - evaluating)
             except Exception:
                 self.reboot()
                 return
 
-            self.logger.debug(f"got result: {result}")
+            self.logger.debug("got result: %s", result, category=CATEGORY_BITSTREAM)
 
             self.results.append(self.current_bitstream.batch_id, (self.current_bitstream.name, result))
+            if self.spool:
+                spool_id = self.spool.completeBitstream(self.current_bitstream.spool_id, self.serial, self.current_bitstream.batch_id, self.current_bitstream.name, result)
+                self.spooled_result_id = spool_id if spool_id is not None else self.spooled_result_id
+            self.database.reportActivity(self.serial)
             os.remove(self.current_bitstream.location)
             self.current_bitstream = None
+            EVALUATIONS.labels(self.serial).inc()
+            BITSTREAMS_IN_FLIGHT.labels(self.serial).set(0)
 
             self._flush()
 
+    @property
+    def healthy(self) -> bool:
+        """Whether the firmware is waiting for a bitstream, rather than in the middle of one or
+        in an unknown state after a read failure or watchdog timeout."""
+        return self.reader is not None and not self.reader.failed and self.current_bitstream is None
+
     def handleExit(self):
+        with self._connect_lock:
+            self._exited = True
+
         self.bitstream_queue.shutdown()
 
         if self.thread and self.thread.is_alive() and self.thread is not threading.current_thread():
@@ -205,17 +352,22 @@ class UploadState(AbstractState):
         if self.ser and self.ser.is_open:
             self.ser.close()
 
+        BITSTREAMS_QUEUED.remove(self.serial)
+        BITSTREAMS_IN_FLIGHT.remove(self.serial)
+
     def reboot(self):
         # TODO kinda hacky
         # i don't like having to chain state switches but its better than
         # needing separate flash stuff
+        REBOOTS.labels(self.serial).inc()
         bitstreams = self.bitstream_queue.shutdown()
         if self.current_bitstream:
             bitstreams.append(self.current_bitstream)
 
         def transfer_bitstreams():
-            state = UploadState(self.device, self.parser, self.reboot_firmware_path, logger_postfix=self.logger_postfix, flush_at_bitstreams_remaining=self.flush_at_bitstreams_remaining, flush_interval_seconds=self.flush_interval_seconds)
+            state = UploadState(self.device, self.parser, self.reboot_firmware_path, logger_postfix=self.logger_postfix, flush_at_bitstreams_remaining=self.flush_at_bitstreams_remaining, flush_interval_seconds=self.flush_interval_seconds, firmware=self.firmware)
             state.results = self.results
+            state.spooled_result_id = self.spooled_result_id
             state.bitstream_queue = Queue(bitstreams)
             return state
 
@@ -223,11 +375,14 @@ class UploadState(AbstractState):
         flasher = lambda : FlashState(self.device, self.reboot_firmware_path, transfer_bitstreams)
         self.switch(flasher)
 class Reader:
-    def __init__(self, port: serial.Serial, parser: Callable[[str], Any], logger):
+    def __init__(self, port: serial.Serial, parser: Callable[[str], Any], logger, ready=True):
+        """If ready is False, the first bitstream waits for the firmware to print its prompt."""
         self.port = port
         self.parser = parser
         self.cv = threading.Condition()
-        self.ready = True
+        self.ready = ready
+        # set after a read failure or watchdog timeout
+        self.failed = False
         self.last_result = None
         self.exiting = False
         self.logger = logger
@@ -249,7 +404,9 @@ class Reader:
                 line = last_read[:last_read.index("\\r\\n")]
                 last_read = last_read[last_read.index("\\r\\n") + 4:]
 
+                started = time.perf_counter()
                 results = self.parser(line)
+                EVALUATION_SECONDS.labels("parse").observe(time.perf_counter() - started)
                 if results:
                     with self.cv:
                         self.last_result = results
@@ -258,6 +415,7 @@ class Reader:
                 timeout = re.search("Watchdog timeout", line)
                 if timeout:
                     with self.cv:
+                        self.failed = True
                         self.last_result = False
                         self.cv.notify_all()
 
@@ -273,11 +431,19 @@ class Reader:
             except Exception as e:
                 # TODO handle this better
                 self.logger.error(f"Exception during read: {e}")
-                self.last_result = False
                 with self.cv:
+                    self.failed = True
+                    self.last_result = False
                     self.cv.notify_all()
                 return
 
+    def waitForPrompt(self, timeout: float) -> bool:
+        """Waits up to timeout seconds for the firmware to print its prompt, without taking it
+        from the next bitstream. Returns whether it did."""
+        with self.cv:
+            self.cv.wait_for(lambda : self.ready or self.failed or self.exiting, timeout)
+            return self.ready and not self.failed
+
     def waitUntilReady(self):
         with self.cv:
             if not self.ready:
@@ -4,7 +4,7 @@ import re
 from icefarm.worker.device.state.core import AbstractState, FlashState, UploadState
 from icefarm.worker.device.state.reservable import reservable
 
-@reservable("pulsecount", "flush_interval_seconds", "flush_at_bitstreams_remaining")
+@reservable("pulsecount", "flush_interval_seconds", "flush_at_bitstreams_remaining", firmware=lambda config : config.pulse_firmware_path)
 class PulseCountStateFlasher(AbstractState):
     def __init__(self, device, flush_interval_seconds, flush_at_bitstreams_remaining):
         super().__init__(device)
@@ -18,6 +18,6 @@ class PulseCountStateFlasher(AbstractState):
             except:
                 return None
 
-        pulse_fac = lambda : UploadState(self.device, parser, self.config.pulse_firmware_path, logger_postfix="(PulseCount)", flush_at_bitstreams_remaining=self.flush_at_bitstreams_remaining, flush_interval_seconds=self.flush_interval_seconds)
-        self.switch(lambda : FlashState(self.device, self.config.pulse_firmware_path, pulse_fac))
+        pulse_fac = lambda : UploadState(self.device, parser, self.config.pulse_firmware_path, logger_postfix="(PulseCount)", flush_at_bitstreams_remaining=self.flush_at_bitstreams_remaining, flush_interval_seconds=self.flush_interval_seconds, firmware="pulsecount")
+        self.switch(lambda : FlashState(self.device, self.config.pulse_firmware_path, pulse_fac, firmware="pulsecount"))
 
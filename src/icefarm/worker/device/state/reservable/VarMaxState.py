@@ -2,6 +2,7 @@ from __future__ import annotations
 import re
 from icefarm.worker.device.state.core import AbstractState, FlashState, UploadState
 from icefarm.worker.device.state.reservable import reservable
+from icefarm.utils.encoding import uint16_array
 
 BAUD = 115200            # ignored by TinyUSB but needed by pyserial
 CHUNK_SIZE = 512         # bytes per write
@@ -19,7 +20,7 @@ def calculate_variance(samples: list[int]) -> float:
         variance_sum += abs(samples[i + 1] - samples[i])
     return variance_sum / len(samples)
 
-@reservable("variance", "send_waveform", "flush_interval_seconds", "flush_at_bitstreams_remaining")
+@reservable("variance", "send_waveform", "flush_interval_seconds", "flush_at_bitstreams_remaining", firmware=lambda config : config.variance_firmware_path)
 class VarMaxStateFlasher(AbstractState):
     def __init__(self, device, send_waveform, flush_interval_seconds, flush_at_bitstreams_remaining):
         super().__init__(device)
@@ -35,11 +36,12 @@ class VarMaxStateFlasher(AbstractState):
                 samples = [int(s.strip()) for s in sample_str.split(",") if s.strip()]
 
                 if self.send_waveform:
-                    return calculate_variance(samples), samples
+                    # packed as a uint16 buffer for clients that receive msgpack
+                    return calculate_variance(samples), uint16_array(samples)
                 else:
                     return calculate_variance(samples)
             except:
                 return None
 
-        var_fac = lambda : UploadState(self.device, parser, self.config.variance_firmware_path, logger_postfix="(VarMax)", flush_interval_seconds=self.flush_interval_seconds, flush_at_bitstreams_remaining=self.flush_at_bitstreams_remaining)
-        self.switch(lambda : FlashState(self.device, self.config.variance_firmware_path, var_fac))
+        var_fac = lambda : UploadState(self.device, parser, self.config.variance_firmware_path, logger_postfix="(VarMax)", flush_interval_seconds=self.flush_interval_seconds, flush_at_bitstreams_remaining=self.flush_at_bitstreams_remaining, firmware="variance")
+        self.switch(lambda : FlashState(self.device, self.config.variance_firmware_path, var_fac, firmware="variance"))
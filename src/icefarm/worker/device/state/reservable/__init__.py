@@ -1,3 +1,3 @@
-from icefarm.worker.device.state.reservable.utils import get_reservation_state_fac, reservable, get_registered_reservables
+from icefarm.worker.device.state.reservable.utils import get_reservation_state_fac, reservable, get_registered_reservables, get_reservation_firmware_path
 from icefarm.worker.device.state.reservable.PulseCountState import PulseCountStateFlasher
 from icefarm.worker.device.state.reservable.VarMaxState import VarMaxStateFlasher
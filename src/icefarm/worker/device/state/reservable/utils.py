@@ -1,8 +1,10 @@
 """Makes it possible for a specific device state to be requested from the client."""
-from typing import List
+from typing import Any, Callable, List, Optional
 
 state_value_checkers = {}
 state_reservation_constructors = {}
+# name -> function returning the firmware path of the reservable from the worker config
+state_firmware_paths = {}
 
 def get_registered_reservables() -> List[str]:
     return list(state_reservation_constructors.keys())
@@ -18,11 +20,22 @@ def get_reservation_state_fac(state, kind, args):
 
     return fn(state, args)
 
-def reservable(name, *args: List[str]):
+def get_reservation_firmware_path(kind, config) -> Optional[str]:
+    """Returns the path of the firmware used by reservations of kind, or None if the reservable did not
+    provide one."""
+    fn = state_firmware_paths.get(kind)
+
+    if not fn:
+        return None
+
+    return fn(config)
+
+def reservable(name, *args: List[str], firmware: Callable[[Any], str]=None):
     """Makes an AbstractState available by reservation request under name. When reserve is called with
     this name, the device switches state to Cls(device: device.Device, *json_args), where json_args
     are obtained from using args as keys into the request dictionary. The class should be included in
-    __init__.py to ensure the decorator is run.
+    __init__.py to ensure the decorator is run. firmware optionally maps the worker config to the
+    firmware path of the reservable, which allows idle devices to be flashed ahead of reservations.
 
     Ex.
     >>> @reservable("print device", "message")
@@ -60,6 +73,9 @@ def reservable(name, *args: List[str]):
 
         state_reservation_constructors[name] = make_state_fac
 
+        if firmware:
+            state_firmware_paths[name] = firmware
+
         return cls
 
     return res
@@ -39,7 +39,8 @@ class FakeSerial:
         self.in_waiting = 0
         self.is_open = True
 
-        self.queue = ""
+        # the firmware prints its prompt once the port is opened
+        self.queue = "'BWaiting for bitstream transfer\\r\\n'"
 
     def flush(self):
         pass
@@ -97,6 +98,9 @@ class FakeEventSender(DeviceEventSender):
 
 def flash_state_start(self):
     """Replaces start during testing."""
+    if self._reuseFirmware():
+        return
+
     time.sleep(5)
 
     if self.timer:
@@ -1,5 +1,7 @@
 import logging
+import os
 import pytest
+import psycopg
 import sys
 
 from utils import get_client_partial
@@ -24,3 +26,18 @@ def get_varmax(request):
 
     url = request.config.getoption("--url")
     return get_client_partial(url, "pytest", logger, "varmax")
+
+@pytest.fixture
+def db_url():
+    # defaults to db rather than localhost since thats the postgres test container hostname
+    return os.environ.get("USBIPICE_DATABASE", "postgresql://postgres:postgres@db:5432")
+
+@pytest.fixture
+def db(db_url):
+    """Provides a database connection and cleans up test data afterward."""
+    conn = psycopg.connect(db_url)
+    conn.autocommit = True
+    yield conn
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM worker WHERE id LIKE 'test-worker-%'")
+    conn.close()
@@ -0,0 +1,57 @@
+"""Tests for registering the devices of a worker in bulk.
+
+Requires the Docker PostgreSQL database to be running on port 5433.
+Run with: pytest tests/test_bulk_devices.py -v
+"""
+import psycopg
+import pytest
+
+from test_clear_workers import call_add_worker, add_device
+
+
+def add_devices(cur, serials, worker_id):
+    cur.execute("CALL add_devices(%s::varchar(255)[], %s::varchar(255))", (serials, worker_id))
+
+
+def devices(cur, worker_id):
+    cur.execute("SELECT id, device_status FROM device WHERE worker_id = %s ORDER BY id", (worker_id,))
+    return cur.fetchall()
+
+
+class TestAddDevices:
+    def test_adds_all_devices(self, db):
+        with db.cursor() as cur:
+            call_add_worker(cur, "test-worker-bulk")
+            add_devices(cur, ["test-device-bulk-1", "test-device-bulk-2", "test-device-bulk-1"], "test-worker-bulk")
+
+            assert devices(cur, "test-worker-bulk") == [
+                ("test-device-bulk-1", "await_flash_default"),
+                ("test-device-bulk-2", "await_flash_default")
+            ]
+
+    def test_skips_devices_of_worker(self, db):
+        with db.cursor() as cur:
+            call_add_worker(cur, "test-worker-bulk")
+            add_device(cur, "test-device-bulk-1", "test-worker-bulk", status="reserved")
+            add_devices(cur, ["test-device-bulk-1", "test-device-bulk-2"], "test-worker-bulk")
+
+            assert devices(cur, "test-worker-bulk") == [
+                ("test-device-bulk-1", "reserved"),
+                ("test-device-bulk-2", "await_flash_default")
+            ]
+
+    def test_rejects_devices_of_other_worker(self, db):
+        with db.cursor() as cur:
+            call_add_worker(cur, "test-worker-bulk")
+            call_add_worker(cur, "test-worker-bulk-other")
+            add_device(cur, "test-device-bulk-1", "test-worker-bulk-other")
+
+            with pytest.raises(psycopg.errors.RaiseException):
+                add_devices(cur, ["test-device-bulk-1", "test-device-bulk-2"], "test-worker-bulk")
+
+            assert devices(cur, "test-worker-bulk") == []
+
+    def test_unknown_worker(self, db):
+        with db.cursor() as cur:
+            with pytest.raises(psycopg.errors.RaiseException):
+                add_devices(cur, ["test-device-bulk-1"], "test-worker-bulk-missing")
@@ -3,24 +3,7 @@
 Requires the Docker PostgreSQL database to be running on port 5433.
 Run with: pytest tests/test_clear_workers.py -v
 """
-import os
 import pytest
-import psycopg
-
-# defaults to db rather than localhost since thats the postgres test container hostname
-DB_URL = os.environ.get("USBIPICE_DATABASE", "postgresql://postgres:postgres@db:5432")
-
-
-@pytest.fixture
-def db():
-    """Provides a database connection and cleans up test data afterward."""
-    conn = psycopg.connect(DB_URL)
-    conn.autocommit = True
-    yield conn
-    # Clean up any test data
-    with conn.cursor() as cur:
-        cur.execute("DELETE FROM worker WHERE id LIKE 'test-worker-%'")
-    conn.close()
 
 
 def call_add_worker(cur, worker_id="test-worker-1", host="127.0.0.1", port=9999):
@@ -0,0 +1,75 @@
+"""Tests for bitstream compression.
+
+Run with: pytest tests/test_compression.py -v
+"""
+import zlib
+
+import pytest
+
+from icefarm.worker.device.state.core.AbstractState import EventMethod
+from icefarm.utils.compression import (CODEC_LZ4, CODEC_NONE, CODEC_ZLIB, DecompressionError,
+                                       choose_codec, compress, decompress, supported_codecs)
+
+# iCE40 bitstreams are mostly zeros with short runs of configuration data
+BITSTREAM = (b"\x00" * 1000 + bytes(range(256))) * 80
+
+
+class TestCompression:
+    @pytest.mark.parametrize("codec", supported_codecs())
+    def test_round_trip(self, codec):
+        compressed = compress(BITSTREAM, codec)
+
+        assert len(compressed) < len(BITSTREAM) / 10
+        assert decompress(compressed, codec) == BITSTREAM
+
+    def test_uncompressed_passes_through(self):
+        assert decompress(BITSTREAM, CODEC_NONE) == BITSTREAM
+
+    def test_zlib_is_always_supported(self):
+        assert CODEC_ZLIB in supported_codecs()
+
+    def test_choose_codec(self):
+        assert choose_codec([CODEC_ZLIB]) == CODEC_ZLIB
+        assert choose_codec(supported_codecs()) == supported_codecs()[0]
+        assert choose_codec(["brotli"]) is None
+        assert choose_codec(None) is None
+
+    @pytest.mark.parametrize("codec", supported_codecs())
+    def test_rejects_oversized_payloads(self, codec):
+        with pytest.raises(DecompressionError):
+            decompress(compress(BITSTREAM, codec), codec, max_size=len(BITSTREAM) - 1)
+
+    @pytest.mark.parametrize("codec", supported_codecs())
+    def test_rejects_truncated_payloads(self, codec):
+        with pytest.raises(DecompressionError):
+            decompress(compress(BITSTREAM, codec)[:-8], codec)
+
+    def test_rejects_invalid_payloads(self):
+        with pytest.raises(DecompressionError):
+            decompress(b"not compressed", CODEC_ZLIB)
+
+    def test_rejects_unknown_codecs(self):
+        with pytest.raises(DecompressionError):
+            decompress(zlib.compress(BITSTREAM), "brotli")
+
+    def test_unavailable_lz4_is_not_offered(self, monkeypatch):
+        monkeypatch.setattr("icefarm.utils.compression.lz4", None)
+
+        assert CODEC_LZ4 not in supported_codecs()
+        assert choose_codec([CODEC_LZ4]) is None
+
+
+class TestEvaluateDefaults:
+    def queue(self, files, batch_id, compression):
+        return {name: decompress(data, compression) for name, data in files.items()}
+
+    def test_missing_compression_is_uncompressed(self):
+        method = EventMethod(TestEvaluateDefaults.queue, ("files", "batch_id", "compression"), {"compression": CODEC_NONE})
+
+        assert method(self, {"files": {"a": BITSTREAM}, "batch_id": "b"}) == {"a": BITSTREAM}
+        assert method(self, {"files": {"a": compress(BITSTREAM, CODEC_ZLIB)}, "batch_id": "b", "compression": CODEC_ZLIB}) == {"a": BITSTREAM}
+
+    def test_missing_required_key_is_ignored(self):
+        method = EventMethod(TestEvaluateDefaults.queue, ("files", "batch_id", "compression"), {"compression": CODEC_NONE})
+
+        assert method(self, {"files": {"a": BITSTREAM}}) is None
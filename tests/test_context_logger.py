@@ -0,0 +1,102 @@
+"""Tests for context loggers.
+
+Run with: pytest tests/test_context_logger.py -v
+"""
+import logging
+
+import pytest
+
+from icefarm.utils.ContextLogger import ContextLogger, parse_sampling, set_sampling
+from icefarm.worker.device.DeviceManager import ManagerLogger
+from icefarm.worker.device.Device import DeviceLogger
+from icefarm.worker.device.state.core.AbstractState import StateLogger
+from icefarm.worker.device.state.core.UploadState import UploadLogger
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class ExpensiveArg:
+    def __init__(self):
+        self.formatted = 0
+
+    def __str__(self):
+        self.formatted += 1
+        return "expensive"
+
+
+@pytest.fixture
+def base():
+    logger = logging.getLogger("test_context_logger")
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    handler = ListHandler()
+    logger.addHandler(handler)
+    yield logger, handler
+    logger.removeHandler(handler)
+
+
+@pytest.fixture
+def upload_logger(base):
+    logger, _ = base
+    return UploadLogger(StateLogger(DeviceLogger(ManagerLogger(logger), "ABCDEF"), "UploadState"), "(PulseCount)")
+
+
+class TestContextLogger:
+    def test_nested_loggers_are_flattened(self, base, upload_logger):
+        logger, handler = base
+        upload_logger.info("got result: %s", 12)
+
+        record, = handler.records
+
+        assert upload_logger.logger is logger
+        assert record.getMessage() == "[DeviceManager] [ABCDEF] [UploadState] (PulseCount) got result: 12"
+        assert record.serial == "ABCDEF"
+        assert record.state == "UploadState"
+
+    def test_bind_adds_fields(self, base):
+        logger, handler = base
+        ContextLogger(logger, "[Worker]").bind("[ABCDEF]", serial="ABCDEF").info("hello", extra={"batch": "b"})
+
+        record, = handler.records
+
+        assert record.getMessage() == "[Worker] [ABCDEF] hello"
+        assert record.serial == "ABCDEF"
+        assert record.batch == "b"
+
+    def test_disabled_records_are_not_formatted(self, base, upload_logger):
+        logger, handler = base
+        logger.setLevel(logging.INFO)
+        arg = ExpensiveArg()
+
+        upload_logger.debug("uploading bitstream %s", arg, category="bitstream")
+
+        assert not handler.records
+        assert arg.formatted == 0
+
+    def test_categories_are_sampled(self, base, upload_logger):
+        _, handler = base
+        set_sampling("bitstream", 10)
+        try:
+            for i in range(25):
+                upload_logger.debug("uploading bitstream %s", i, category="bitstream")
+                upload_logger.debug("state changed")
+        finally:
+            set_sampling("bitstream", 1)
+
+        messages = [record.getMessage() for record in handler.records]
+
+        assert [message for message in messages if "uploading" in message] == [
+            f"[DeviceManager] [ABCDEF] [UploadState] (PulseCount) uploading bitstream {i}" for i in (0, 10, 20)
+        ]
+        assert len([message for message in messages if "state changed" in message]) == 25
+
+    def test_parse_sampling(self):
+        assert parse_sampling("bitstream=100, event=10") == {"bitstream": 100, "event": 10}
+        assert parse_sampling("") == {}
@@ -0,0 +1,112 @@
+"""Tests for the dashboard aggregate and paging database functions.
+
+Requires the Docker PostgreSQL database to be running on port 5433.
+Run with: pytest tests/test_dashboard.py -v
+"""
+import json
+import pytest
+import psycopg
+
+from test_clear_workers import call_add_worker, add_device, add_reservation
+
+
+@pytest.fixture
+def db(db):
+    """Skips when the database contains devices of other workers, since the aggregates cover every device."""
+    with db.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM device WHERE worker_id NOT LIKE 'test-worker-%'")
+        if cur.fetchone()[0]:
+            pytest.skip("database contains devices from real workers")
+    return db
+
+
+class TestDeviceSummary:
+    def test_counts_by_status(self, db):
+        with db.cursor() as cur:
+            call_add_worker(cur, "test-worker-summary")
+            add_device(cur, "test-device-summary-1", "test-worker-summary")
+            add_device(cur, "test-device-summary-2", "test-worker-summary")
+            add_device(cur, "test-device-summary-3", "test-worker-summary", status="reserved")
+            add_device(cur, "test-device-summary-4", "test-worker-summary", status="broken")
+            add_device(cur, "test-device-summary-5", "test-worker-summary", status="testing")
+
+            cur.execute("SELECT * FROM get_device_summary()")
+            assert cur.fetchone() == (5, 2, 1, 1)
+
+
+class TestDevicesPage:
+    @pytest.fixture
+    def devices(self, db):
+        with db.cursor() as cur:
+            call_add_worker(cur, "test-worker-page-a")
+            call_add_worker(cur, "test-worker-page-b")
+
+            for i in range(5):
+                add_device(cur, f"test-device-page-a{i}", "test-worker-page-a")
+
+            add_device(cur, "test-device-page-b0", "test-worker-page-b", status="reserved")
+            add_reservation(cur, "test-device-page-b0", "test-client")
+
+        return db
+
+    def page(self, db, lim, offs, status=None, worker=None):
+        with db.cursor() as cur:
+            cur.execute(
+                "SELECT * FROM get_devices_page(%s::int, %s::int, %s::devicestatus, %s::varchar(255))",
+                (lim, offs, status, worker)
+            )
+            return cur.fetchall()
+
+    def test_pages_are_ordered_and_bounded(self, devices):
+        first = self.page(devices, 4, 0)
+        second = self.page(devices, 4, 4)
+
+        assert [row[0] for row in first] == [f"test-device-page-a{i}" for i in range(4)]
+        assert [row[0] for row in second] == ["test-device-page-a4", "test-device-page-b0"]
+
+    def test_matching_counts_whole_filter(self, devices):
+        rows = self.page(devices, 2, 0, worker="test-worker-page-a")
+        assert len(rows) == 2
+        assert all(row[4] == 5 for row in rows)
+
+    def test_status_filter_includes_client(self, devices):
+        rows = self.page(devices, 10, 0, status="reserved")
+        assert len(rows) == 1
+        assert rows[0][0] == "test-device-page-b0"
+        assert rows[0][3] == "test-client"
+
+
+class TestDashboardNotifications:
+    def listen(self, db_url):
+        conn = psycopg.connect(db_url, autocommit=True)
+        conn.execute("LISTEN dashboard_updates")
+        return conn
+
+    def notifications(self, conn):
+        return [json.loads(n.payload) for n in conn.notifies(timeout=0.5, stop_after=100)]
+
+    def test_device_status_change_notifies(self, db, db_url):
+        with db.cursor() as cur:
+            call_add_worker(cur, "test-worker-notify")
+            add_device(cur, "test-device-notify", "test-worker-notify")
+
+            listener = self.listen(db_url)
+            cur.execute("UPDATE device SET device_status = 'reserved' WHERE id = 'test-device-notify'")
+            add_reservation(cur, "test-device-notify", "test-client")
+
+        updates = self.notifications(listener)
+        listener.close()
+
+        assert {"kind": "device", "id": "test-device-notify"} in updates
+
+    def test_heartbeat_does_not_notify(self, db, db_url):
+        with db.cursor() as cur:
+            call_add_worker(cur, "test-worker-quiet")
+
+            listener = self.listen(db_url)
+            cur.execute("CALL heartbeat_worker(%s::varchar(255))", ("test-worker-quiet",))
+
+        updates = self.notifications(listener)
+        listener.close()
+
+        assert not updates
@@ -0,0 +1,90 @@
+"""Tests for the udev device index.
+
+Run with: pytest tests/test_device_index.py -v
+"""
+from icefarm.utils.dev import DeviceIndex
+
+
+def tty(serial, interface="00", name="/dev/ttyACM0", interfaces=":020200:0a0000:"):
+    return {
+        "DEVNAME": name,
+        "DEVPATH": f"/devices/usb1/1-7/1-7:1.{interface}/tty/{name[5:]}",
+        "ID_MODEL": "Pico",
+        "ID_SERIAL_SHORT": serial,
+        "ID_USB_INTERFACES": interfaces,
+        "ID_USB_INTERFACE_NUM": interface,
+        "SUBSYSTEM": "tty",
+    }
+
+
+def partition(serial, name="/dev/sda1"):
+    return {
+        "DEVNAME": name,
+        "DEVPATH": f"/devices/usb1/1-7/1-7:1.0/host0/block/sda/{name[5:]}",
+        "DEVTYPE": "partition",
+        "ID_MODEL": "RP2350",
+        "ID_SERIAL_SHORT": serial,
+        "ID_USB_INTERFACE_NUM": "00",
+        "SUBSYSTEM": "block",
+    }
+
+
+def test_add_and_lookup():
+    index = DeviceIndex()
+
+    assert index.update("add", tty("AAAA")) == "AAAA"
+    assert index.update("add", partition("BBBB")) == "BBBB"
+
+    assert index.tty("AAAA") == "/dev/ttyACM0"
+    assert index.tty("BBBB") is None
+    assert [dev["DEVNAME"] for dev in index.get("BBBB")] == ["/dev/sda1"]
+    assert sorted(index.serials()) == ["AAAA", "BBBB"]
+
+
+def test_ignores_unrelated_devices():
+    index = DeviceIndex()
+    dev = tty("AAAA")
+    dev["ID_MODEL"] = "Keyboard"
+
+    assert index.update("add", dev) is None
+    assert index.get("AAAA") == []
+
+
+def test_tty_by_interface():
+    index = DeviceIndex()
+    index.update("add", tty("AAAA", "00", "/dev/ttyACM0"))
+    index.update("add", tty("AAAA", "02", "/dev/ttyACM1"))
+
+    assert index.tty("AAAA") == "/dev/ttyACM0"
+    assert index.tty("AAAA", "02") == "/dev/ttyACM1"
+    assert len(index.get("AAAA")) == 2
+
+
+def test_remove_without_serial():
+    """Remove events are matched by DEVPATH when they no longer carry the serial."""
+    index = DeviceIndex()
+    dev = tty("AAAA")
+    index.update("add", dev)
+
+    assert index.update("remove", {"DEVPATH": dev["DEVPATH"], "ID_USB_INTERFACE_NUM": "00"}) == "AAAA"
+    assert index.tty("AAAA") is None
+    assert index.serials() == []
+
+
+def test_reconnect_as_bootloader():
+    index = DeviceIndex()
+    index.update("add", tty("AAAA"))
+    index.update("remove", tty("AAAA"))
+    index.update("add", partition("AAAA"))
+
+    assert index.tty("AAAA") is None
+    assert [dev["SUBSYSTEM"] for dev in index.get("AAAA")] == ["block"]
+
+
+def test_interfaces():
+    index = DeviceIndex()
+    index.update("add", tty("AAAA", interfaces=":020200:0a0000:020200:0a0000:fe0101:"))
+    index.update("add", partition("BBBB"))
+
+    assert index.interfaces("AAAA") == ["020200", "0a0000", "020200", "0a0000", "fe0101"]
+    assert index.interfaces("BBBB") == []
@@ -0,0 +1,50 @@
+"""Tests for event encodings.
+
+Run with: pytest tests/test_encoding.py -v
+"""
+import array
+import json
+
+import msgpack
+
+from icefarm.utils.encoding import (
+    ENCODING_JSON, ENCODING_MSGPACK, UINT16_ARRAY_EXT, uint16_array, encode, decode, transcode, msgpack_frame
+)
+
+
+SAMPLES = [0, 1, 4095, 65535]
+
+
+class TestEncoding:
+    def test_samples_are_packed_little_endian(self):
+        packed = msgpack.unpackb(encode({"samples": uint16_array(SAMPLES)}, ENCODING_MSGPACK), raw=False)["samples"]
+
+        assert packed.code == UINT16_ARRAY_EXT
+        assert packed.data == b"\x00\x00\x01\x00\xff\x0f\xff\xff"
+
+    def test_samples_decode_into_arrays(self):
+        samples = decode(encode({"samples": uint16_array(SAMPLES)}, ENCODING_MSGPACK))["samples"]
+
+        assert samples == array.array("H", SAMPLES)
+
+    def test_json_keeps_lists(self):
+        message = encode({"samples": uint16_array(SAMPLES)}, ENCODING_JSON)
+
+        assert json.loads(message) == {"samples": SAMPLES}
+
+    def test_out_of_range_values_are_not_packed(self):
+        assert uint16_array([1, 70000]) == [1, 70000]
+
+    def test_transcode(self):
+        message = {"serial": "a", "contents": [{"event": "results", "samples": uint16_array(SAMPLES)}]}
+
+        assert decode(transcode(encode(message, ENCODING_JSON), ENCODING_MSGPACK))["contents"][0]["samples"] == SAMPLES
+        assert json.loads(transcode(encode(message, ENCODING_MSGPACK), ENCODING_JSON))["contents"][0]["samples"] == SAMPLES
+
+    def test_frame_joins_encoded_messages(self):
+        messages = [encode({"i": i}, ENCODING_MSGPACK) for i in range(3)]
+
+        assert decode(msgpack_frame(messages)) == [{"i": 0}, {"i": 1}, {"i": 2}]
+        assert decode(msgpack_frame(messages, {"session": "s", "seq": 4})) == {
+            "session": "s", "seq": 4, "events": [{"i": 0}, {"i": 1}, {"i": 2}]
+        }
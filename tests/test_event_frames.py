@@ -0,0 +1,177 @@
+"""Tests for coalescing session messages into frames.
+
+Run with: pytest tests/test_event_frames.py -v
+"""
+import array
+import concurrent.futures
+import json
+import logging
+
+from icefarm.utils.EventSender import Session, coalesce
+from icefarm.utils.encoding import ENCODING_MSGPACK, encode, decode, uint16_array
+
+
+class FakeSocketIO:
+    def __init__(self):
+        self.emitted = []
+
+    def emit(self, event, data, to=None):
+        self.emitted.append((event, data, to))
+
+    def sleep(self, seconds=0):
+        pass
+
+
+class FakeEventSender:
+    def endSession(self, client_id):
+        pass
+
+
+def make_session(frames):
+    socketio = FakeSocketIO()
+    session = Session(socketio, FakeEventSender(), logging.getLogger(__name__), "test-client")
+    for i in range(5):
+        session.message_queue.append(json.dumps({"serial": "a", "contents": [{"event": str(i)}]}))
+    session.setSocket("sock", frames=frames).join()
+    session.stopTimeout()
+    return socketio
+
+
+class TestCoalesce:
+    def test_keeps_order_within_cap(self):
+        messages = ["a" * 40, "b" * 40, "c" * 40]
+        assert coalesce(messages, max_bytes=100) == [["a" * 40, "b" * 40], ["c" * 40]]
+
+    def test_oversized_message_sent_alone(self):
+        messages = ["a", "b" * 200, "c"]
+        assert coalesce(messages, max_bytes=100) == [["a"], ["b" * 200], ["c"]]
+
+
+class TestSessionFlush:
+    def test_frames_coalesce_pending_messages(self):
+        socketio = make_session(frames=True)
+
+        assert len(socketio.emitted) == 1
+        event, data, to = socketio.emitted[0]
+        assert event == "events"
+        assert to == "sock"
+        assert [msg["contents"][0]["event"] for msg in json.loads(data)] == ["0", "1", "2", "3", "4"]
+
+    def test_legacy_sockets_receive_single_events(self):
+        socketio = make_session(frames=False)
+
+        assert [event for event, _, _ in socketio.emitted] == ["event"] * 5
+        assert json.loads(socketio.emitted[0][1])["contents"][0]["event"] == "0"
+
+
+class FailingSocketIO(FakeSocketIO):
+    """Emits fail on the event loop after being handed over, like emits from background
+    threads through SyncAsyncServer."""
+    def emit(self, event, data, to=None):
+        future = concurrent.futures.Future()
+        future.set_exception(Exception("disconnected"))
+        return future
+
+
+def make_sequenced_session():
+    socketio = FakeSocketIO()
+    session = Session(socketio, FakeEventSender(), logging.getLogger(__name__), "test-client")
+    session.stopTimeout()
+    session.setSocket("sock", frames=True, resume={"session": None, "seq": -1}).join()
+    return session, socketio
+
+
+def send(session, *names):
+    for name in names:
+        session.send(json.dumps({"serial": "a", "contents": [{"event": name}]}))
+
+
+def received(socketio):
+    frames = [json.loads(data) for _, data, _ in socketio.emitted]
+    return [(frame["seq"], [msg["contents"][0]["event"] for msg in frame["events"]]) for frame in frames]
+
+
+class TestSequencedSession:
+    def test_frames_are_numbered(self):
+        session, socketio = make_sequenced_session()
+        send(session, "a", "b")
+
+        assert received(socketio) == [(0, ["a"]), (1, ["b"])]
+        assert json.loads(socketio.emitted[0][1])["session"] == session.session_id
+
+    def test_resume_resends_unacknowledged(self):
+        session, socketio = make_sequenced_session()
+        send(session, "a", "b", "c")
+        session.ack(session.session_id, 0)
+        session.removeSocket()
+        session.stopTimeout()
+
+        session.socketio = socketio = FakeSocketIO()
+        session.setSocket("sock2", frames=True, resume={"session": session.session_id, "seq": 1}).join()
+
+        assert received(socketio) == [(2, ["c"])]
+
+    def test_resume_from_other_session_resends_everything(self):
+        session, socketio = make_sequenced_session()
+        send(session, "a", "b")
+
+        session.socketio = socketio = FakeSocketIO()
+        session.setSocket("sock2", frames=True, resume={"session": "other", "seq": 5}).join()
+
+        assert received(socketio) == [(0, ["a", "b"])]
+
+    def test_failed_emit_keeps_sequence(self):
+        session, socketio = make_sequenced_session()
+        session.socketio = FailingSocketIO()
+        send(session, "a", "b")
+
+        session.socketio = socketio = FakeSocketIO()
+        session.flush()
+        send(session, "c")
+
+        assert received(socketio) == [(0, ["a", "b"]), (2, ["c"])]
+
+    def test_attach_does_not_wait_for_flush(self):
+        session, _ = make_sequenced_session()
+        send(session, "a")
+
+        # a flush to the previous socket is still running
+        with session.flush_lock:
+            session.socketio = socketio = FakeSocketIO()
+            attach = session.setSocket("sock2", frames=True, resume={"session": session.session_id, "seq": -1})
+            second = session.setSocket("sock3", frames=True, resume={"session": session.session_id, "seq": -1})
+            assert attach.is_alive()
+
+        attach.join()
+        second.join()
+
+        # only the latest socket is attached, and it receives what was not acknowledged
+        assert session.sock_id == "sock3"
+        assert [to for _, _, to in socketio.emitted] == ["sock3"]
+        assert received(socketio) == [(0, ["a"])]
+
+    def test_ack_releases_retained(self):
+        session, _ = make_sequenced_session()
+        send(session, "a", "b", "c")
+
+        session.ack("other", 2)
+        assert len(session.retained) == 3
+
+        session.ack(session.session_id, 1)
+        assert list(session.retained) == [json.dumps({"serial": "a", "contents": [{"event": "c"}]})]
+        assert session.retained_seq == 2
+
+
+class TestMsgpackSession:
+    def test_pending_json_messages_are_converted(self):
+        socketio = FakeSocketIO()
+        session = Session(socketio, FakeEventSender(), logging.getLogger(__name__), "test-client")
+        session.stopTimeout()
+        send(session, "a")
+        session.setSocket("sock", frames=True, resume={"session": None, "seq": -1}, encoding=ENCODING_MSGPACK).join()
+        session.send(encode({"serial": "a", "contents": [{"event": "b", "samples": uint16_array([1, 2])}]}, ENCODING_MSGPACK))
+
+        frames = [decode(data) for _, data, _ in socketio.emitted]
+        assert all(isinstance(data, bytes) for _, data, _ in socketio.emitted)
+        assert [(frame["seq"], [msg["contents"][0]["event"] for msg in frame["events"]]) for frame in frames] == [(0, ["a"]), (1, ["b"])]
+        assert frames[1]["events"][0]["contents"][0]["samples"] == array.array("H", [1, 2])
@@ -0,0 +1,173 @@
+"""Tests for writing firmware onto FAT disk images without mounting them.
+
+Run with: pytest tests/test_fat.py -v
+"""
+import os
+import struct
+
+import pytest
+
+from icefarm.utils.dev import upload_firmware_direct, is_uf2, UF2_MAGIC_START, UF2_MAGIC_END, UF2_BLOCK_SIZE
+from icefarm.utils.fat import FatVolume, FatError, to_short_name, DIR_ENTRY_SIZE
+
+
+def make_image(path, total_sectors, sectors_per_cluster, fat_sectors, root_entries=512, files=()):
+    """Writes an empty FAT12/16 volume, the layout used by the RP2 bootloader drive. files are
+    (name, contents) placed in the root directory with one cluster each."""
+    boot = bytearray(512)
+    boot[0:3] = b"\xeb\x3c\x90"
+    boot[3:11] = b"MSWIN4.1"
+    struct.pack_into("<HBHBHHBHHHII", boot, 11, 512, sectors_per_cluster, 1, 2, root_entries, total_sectors if total_sectors < 0x10000 else 0, 0xF8, fat_sectors, 1, 1, 0, total_sectors if total_sectors >= 0x10000 else 0)
+    boot[510:512] = b"\x55\xaa"
+
+    root_offset = (1 + 2 * fat_sectors) * 512
+    data_offset = root_offset + root_entries * DIR_ENTRY_SIZE
+
+    with open(path, "wb") as f:
+        f.truncate(total_sectors * 512)
+        f.write(boot)
+
+    with open(path, "r+b") as f:
+        fd = f.fileno()
+        volume = FatVolume(fd)
+        # media descriptor and end of chain in the reserved entries
+        volume._setEntry(0, volume.end_of_chain & ~0xFF | 0xF8)
+        volume._setEntry(1, volume.end_of_chain)
+
+        for i, (name, contents) in enumerate(files):
+            cluster = 2 + i
+            volume._setEntry(cluster, volume.end_of_chain)
+            entry = struct.pack("<11sB14xHI", to_short_name(name), 0x01, cluster, len(contents))
+            os.pwrite(fd, entry, root_offset + i * DIR_ENTRY_SIZE)
+            os.pwrite(fd, contents, data_offset + i * volume.cluster_size)
+
+        for i in range(2):
+            os.pwrite(fd, bytes(volume.fat), (1 + i * fat_sectors) * 512)
+
+
+def make_bootloader_image(path, **kwargs):
+    """A FAT16 volume with the files of the RP2 bootloader drive."""
+    files = [("INDEX.HTM", b"<html></html>"), ("INFO_UF2.TXT", b"UF2 Bootloader v1.0\r\n")]
+    make_image(path, total_sectors=kwargs.get("total_sectors", 32768), sectors_per_cluster=kwargs.get("sectors_per_cluster", 4), fat_sectors=32, files=files)
+
+
+def make_uf2(blocks):
+    data = b""
+    for i in range(blocks):
+        block = bytearray(UF2_BLOCK_SIZE)
+        block[0:8] = UF2_MAGIC_START
+        struct.pack_into("<IIIII", block, 8, 0x2000, 0x10000000 + i * 256, 256, i, blocks)
+        block[32:288] = bytes([i % 256]) * 256
+        block[UF2_BLOCK_SIZE - 4:] = UF2_MAGIC_END
+        data += block
+    return data
+
+
+def open_volume(path):
+    fd = os.open(path, os.O_RDWR)
+    return fd, FatVolume(fd)
+
+
+class TestFatVolume:
+    @pytest.mark.parametrize("total_sectors,sectors_per_cluster,fat_sectors,fat_bits", [
+        (2048, 1, 6, 12),
+        (32768, 4, 32, 16),
+    ])
+    def test_write_and_read(self, tmp_path, total_sectors, sectors_per_cluster, fat_sectors, fat_bits):
+        path = tmp_path.joinpath("volume.img")
+        make_image(path, total_sectors, sectors_per_cluster, fat_sectors)
+        data = os.urandom(5000)
+
+        fd, volume = open_volume(path)
+        assert volume.fat_bits == fat_bits
+        volume.writeFile("firmware.uf2", data)
+        os.close(fd)
+
+        fd, volume = open_volume(path)
+        assert volume.listdir() == ["FIRMWARE.UF2"]
+        assert volume.readFile("firmware.uf2") == data
+        os.close(fd)
+
+    def test_replaces_file(self, tmp_path):
+        path = tmp_path.joinpath("volume.img")
+        make_image(path, 2048, 1, 6)
+
+        fd, volume = open_volume(path)
+        volume.writeFile("a.bin", b"x" * 2000)
+        free = sum(1 for cluster in range(2, volume.cluster_count + 2) if volume._getEntry(cluster) == 0)
+        volume.writeFile("a.bin", b"y" * 600)
+
+        assert volume.listdir() == ["A.BIN"]
+        assert volume.readFile("a.bin") == b"y" * 600
+        assert sum(1 for cluster in range(2, volume.cluster_count + 2) if volume._getEntry(cluster) == 0) == free + 2
+        os.close(fd)
+
+    def test_full_volume(self, tmp_path):
+        path = tmp_path.joinpath("volume.img")
+        make_image(path, 2048, 1, 6)
+
+        fd, volume = open_volume(path)
+        with pytest.raises(FatError):
+            volume.writeFile("big.bin", bytes(2048 * 512))
+        assert volume.listdir() == []
+        os.close(fd)
+
+    def test_not_fat(self, tmp_path):
+        path = tmp_path.joinpath("volume.img")
+        path.write_bytes(bytes(4096))
+
+        fd = os.open(path, os.O_RDONLY)
+        with pytest.raises(FatError):
+            FatVolume(fd)
+        os.close(fd)
+
+    def test_short_names(self):
+        assert to_short_name("firmware.uf2") == b"FIRMWAREUF2"
+        assert to_short_name("INDEX.HTM") == b"INDEX   HTM"
+        with pytest.raises(FatError):
+            to_short_name("firmware_image.uf2")
+
+
+class TestUploadFirmwareDirect:
+    def test_upload(self, tmp_path):
+        image = tmp_path.joinpath("drive.img")
+        make_bootloader_image(image)
+        firmware = tmp_path.joinpath("firmware.uf2")
+        firmware.write_bytes(make_uf2(64))
+
+        assert upload_firmware_direct(str(image), str(firmware))
+
+        fd, volume = open_volume(image)
+        assert sorted(volume.listdir()) == ["FIRMWARE.UF2", "INDEX.HTM", "INFO_UF2.TXT"]
+        assert volume.readFile("firmware.uf2") == firmware.read_bytes()
+        assert volume.readFile("INFO_UF2.TXT") == b"UF2 Bootloader v1.0\r\n"
+        os.close(fd)
+
+    def test_blocks_are_sector_aligned(self, tmp_path):
+        """The bootloader flashes any sector holding a UF2 block, so each block must fill one sector."""
+        image = tmp_path.joinpath("drive.img")
+        make_bootloader_image(image)
+        firmware = tmp_path.joinpath("firmware.uf2")
+        firmware.write_bytes(make_uf2(8))
+
+        assert upload_firmware_direct(str(image), str(firmware))
+
+        data = image.read_bytes()
+        sectors = [data[i:i + 512] for i in range(0, len(data), 512)]
+        assert sum(1 for sector in sectors if is_uf2(sector)) == 8
+
+    def test_rejects_other_drives(self, tmp_path):
+        image = tmp_path.joinpath("drive.img")
+        make_image(image, 2048, 1, 6, files=[("NOTES.TXT", b"hello")])
+        firmware = tmp_path.joinpath("firmware.uf2")
+        firmware.write_bytes(make_uf2(1))
+
+        assert not upload_firmware_direct(str(image), str(firmware))
+
+    def test_rejects_non_uf2(self, tmp_path):
+        image = tmp_path.joinpath("drive.img")
+        make_bootloader_image(image)
+        firmware = tmp_path.joinpath("firmware.uf2")
+        firmware.write_bytes(b"not a uf2 file")
+
+        assert not upload_firmware_direct(str(image), str(firmware))
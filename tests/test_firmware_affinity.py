@@ -0,0 +1,70 @@
+"""Tests for preferring devices that already run the firmware of a reservation.
+
+Requires the Docker PostgreSQL database to be running on port 5433.
+Run with: pytest tests/test_firmware_affinity.py -v
+"""
+import psycopg
+import pytest
+
+from test_clear_workers import add_device
+
+# reservables only offered by the test worker, so that devices of running workers are not reserved
+KIND = "test-affinity-kind"
+OTHER_KIND = "test-affinity-other"
+
+
+def set_firmware(cur, serial, firmware):
+    cur.execute("CALL update_device_firmware(%s::varchar(255), %s::varchar(255))", (serial, firmware))
+
+
+def reserve(cur, amount, kind):
+    cur.execute(
+        "SELECT * FROM make_reservations(%s::int, %s::varchar(255), %s::varchar(255), %s::int)",
+        (amount, "test-client-affinity", kind, 60)
+    )
+    return sorted(row[0] for row in cur.fetchall())
+
+
+def available(cur, worker_id):
+    cur.execute("SELECT id FROM device WHERE worker_id = %s AND device_status = 'available'", (worker_id,))
+    return [row[0] for row in cur.fetchall()]
+
+
+class TestFirmwareAffinity:
+    def setup_devices(self, cur):
+        cur.execute(
+            "CALL add_worker(%s::varchar(255), %s::varchar(255), %s::int, %s::varchar(255), %s::varchar(255)[])",
+            ("test-worker-affinity", "127.0.0.1", 9999, "0.0.0-test", [KIND, OTHER_KIND])
+        )
+        for serial in ("test-device-affinity-default", "test-device-affinity-matching", "test-device-affinity-other"):
+            add_device(cur, serial, "test-worker-affinity")
+
+        set_firmware(cur, "test-device-affinity-matching", KIND)
+        set_firmware(cur, "test-device-affinity-other", OTHER_KIND)
+
+    def test_prefers_matching_firmware(self, db):
+        with db.cursor() as cur:
+            self.setup_devices(cur)
+
+            assert reserve(cur, 1, KIND) == ["test-device-affinity-matching"]
+
+    def test_falls_back_to_other_devices(self, db):
+        with db.cursor() as cur:
+            self.setup_devices(cur)
+
+            reserved = reserve(cur, 2, KIND)
+            assert "test-device-affinity-matching" in reserved
+            assert len(available(cur, "test-worker-affinity")) == 1
+
+    def test_firmware_cleared(self, db):
+        with db.cursor() as cur:
+            self.setup_devices(cur)
+            set_firmware(cur, "test-device-affinity-matching", None)
+
+            cur.execute("SELECT firmware FROM device WHERE id = 'test-device-affinity-matching'")
+            assert cur.fetchone() == (None,)
+
+    def test_unknown_device(self, db):
+        with db.cursor() as cur:
+            with pytest.raises(psycopg.errors.RaiseException):
+                set_firmware(cur, "test-device-affinity-missing", KIND)
@@ -0,0 +1,82 @@
+"""Tests for the flash scheduler.
+
+Run with: pytest tests/test_flash_scheduler.py -v
+"""
+import logging
+
+from icefarm.worker.device.FlashScheduler import FlashScheduler, get_hub, PRIORITY_RESERVED, PRIORITY_DEFAULT, PRIORITY_WARM
+
+logger = logging.getLogger("test_flash_scheduler")
+
+
+class Recorder:
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.started = []
+        self.jobs = {}
+
+    def submit(self, serial, hub, priority=PRIORITY_DEFAULT):
+        self.jobs[serial] = self.scheduler.submit(serial, hub, priority, lambda : self.started.append(serial), "direct")
+
+    def release(self, serial):
+        self.scheduler.release(self.jobs[serial])
+
+
+def test_get_hub():
+    assert get_hub("/devices/pci0000:00/0000:00:14.0/usb1/1-7/1-7.3/1-7.3:1.0/tty/ttyACM0") == "1-7"
+    assert get_hub("/devices/pci0000:00/0000:00:14.0/usb1/1-7/1-7.3/1-7.3.2/1-7.3.2:1.0/tty/ttyACM0") == "1-7.3"
+    assert get_hub("/devices/pci0000:00/0000:00:14.0/usb2/2-1/2-1:1.0/tty/ttyACM0") == "usb2"
+    assert get_hub("/devices/virtual/tty/tty0") is None
+
+
+def test_limits_flashes_per_hub():
+    recorder = Recorder(FlashScheduler(logger, per_hub=2))
+    for serial in ("a", "b", "c"):
+        recorder.submit(serial, "1-7")
+    recorder.submit("d", "1-8")
+
+    assert recorder.started == ["a", "b", "d"]
+
+    recorder.release("a")
+    assert recorder.started == ["a", "b", "d", "c"]
+
+
+def test_priority_within_hub():
+    recorder = Recorder(FlashScheduler(logger, per_hub=1))
+    recorder.submit("running", "1-7")
+    recorder.submit("warm", "1-7", PRIORITY_WARM)
+    recorder.submit("default", "1-7", PRIORITY_DEFAULT)
+    recorder.submit("reserved", "1-7", PRIORITY_RESERVED)
+
+    for serial in ("running", "reserved", "default"):
+        recorder.release(serial)
+
+    assert recorder.started == ["running", "reserved", "default", "warm"]
+
+
+def test_released_before_start():
+    recorder = Recorder(FlashScheduler(logger, per_hub=1))
+    recorder.submit("a", "1-7")
+    recorder.submit("b", "1-7")
+    recorder.submit("c", "1-7")
+
+    recorder.release("b")
+    recorder.release("a")
+    # releasing twice does not free another slot
+    recorder.release("a")
+    recorder.submit("d", "1-7")
+
+    assert recorder.started == ["a", "c"]
+
+
+def test_failing_start_frees_slot():
+    scheduler = FlashScheduler(logger, per_hub=1)
+    started = []
+
+    def fail():
+        raise RuntimeError("mailbox closed")
+
+    scheduler.submit("a", "1-7", PRIORITY_DEFAULT, fail, "direct")
+    scheduler.submit("b", "1-7", PRIORITY_DEFAULT, lambda : started.append("b"), "direct")
+
+    assert started == ["b"]
@@ -0,0 +1,125 @@
+"""Tests for giving up flash slots of devices that do not reach the bootloader.
+
+Run with: pytest tests/test_flash_state.py -v
+"""
+import logging
+import sys
+import time
+
+import pytest
+
+from icefarm.worker.device.FlashScheduler import FlashScheduler
+from icefarm.worker.device.Timeline import Timeline
+from icefarm.worker.device.state.core.FlashState import FlashState, BOOTLOADER_ATTEMPTS
+
+# the package exports the class under the name of its module
+flash_state = sys.modules[FlashState.__module__]
+logger = logging.getLogger("test_flash_state")
+
+TTY = {
+    "DEVNAME": "/dev/ttyACM0",
+    "SUBSYSTEM": "tty",
+    "DEVPATH": "/devices/pci0000:00/0000:00:14.0/usb1/1-7/1-7.3/1-7.3:1.0/tty/ttyACM0",
+}
+
+
+class FakeIndex:
+    def get(self, serial):
+        return [TTY]
+
+
+class Namespace:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeDevice:
+    """Queues mailbox posts until run is called, runs blocking work right away and records state
+    switches instead of running them."""
+    def __init__(self):
+        self.serial = "ABCDEF"
+        self.logger = logger
+        self.config = Namespace(flash_method="direct")
+        self.manager = Namespace(flash_scheduler=FlashScheduler(logger, per_hub=1))
+        self.mailbox = Namespace(post=self.post)
+        self.timeline = Timeline()
+        self.firmware = None
+        self.mount_path = "/tmp"
+        self.state = None
+        self.switches = []
+        self.posted = []
+
+    def post(self, fn):
+        self.posted.append(fn)
+        return True
+
+    def run(self):
+        while self.posted:
+            self.posted.pop(0)()
+
+    def runInState(self, state, fn):
+        fn()
+
+    def runBlocking(self, name, work, done):
+        result = work()
+        self.post(lambda : done(result))
+
+    def switch(self, factory):
+        self.switches.append(factory)
+        self.state.handleExit()
+
+
+@pytest.fixture
+def device(monkeypatch):
+    monkeypatch.setattr(flash_state, "DEVICE_INDEX", FakeIndex())
+    return FakeDevice()
+
+
+def running(device):
+    return device.manager.flash_scheduler.running.get("1-7", 0)
+
+
+def start(device, timeout=None):
+    next_state = lambda : None
+    device.state = FlashState(device, "firmware.uf2", next_state, timeout=timeout)
+    device.state.start()
+    device.run()
+    return next_state
+
+
+def test_slot_deadline_without_timeout(device, monkeypatch):
+    monkeypatch.setattr(flash_state, "SLOT_TIMEOUT_SECONDS", 0.05)
+    monkeypatch.setattr(flash_state, "touch_bootloader", lambda path : True)
+
+    next_state = start(device)
+    assert running(device) == 1
+
+    # the bootloader drive never shows up
+    time.sleep(0.3)
+
+    assert running(device) == 0
+    assert len(device.switches) == 1
+    assert device.switches[0] is not next_state
+
+
+def test_failed_touch_is_retried(device, monkeypatch):
+    attempts = []
+    monkeypatch.setattr(flash_state, "touch_bootloader", lambda path : attempts.append(path) or len(attempts) > 1)
+
+    start(device)
+
+    assert len(attempts) == 2
+    assert running(device) == 1
+    assert not device.switches
+    device.state.handleExit()
+
+
+def test_failed_touch_gives_up(device, monkeypatch):
+    attempts = []
+    monkeypatch.setattr(flash_state, "touch_bootloader", lambda path : attempts.append(path) or False)
+
+    start(device)
+
+    assert len(attempts) == BOOTLOADER_ATTEMPTS
+    assert running(device) == 0
+    assert len(device.switches) == 1
@@ -0,0 +1,85 @@
+"""Tests for idle reservation database functions.
+
+Requires the Docker PostgreSQL database to be running on port 5433.
+Run with: pytest tests/test_idle_reservations.py -v
+"""
+import pytest
+
+from test_clear_workers import call_add_worker, add_device, add_reservation
+
+
+@pytest.fixture
+def db(db):
+    """Adds idle test reservations to the database."""
+    with db.cursor() as cur:
+        call_add_worker(cur, "test-worker-idle")
+
+        for name in ["active", "warn", "release", "disabled"]:
+            add_device(cur, f"test-device-idle-{name}", "test-worker-idle", status="reserved")
+            add_reservation(cur, f"test-device-idle-{name}", "test-client-idle")
+
+        cur.execute(
+            "SELECT * FROM set_reservation_idle(%s::varchar(255), %s::varchar(255)[], %s::int)",
+            ("test-client-idle", ["test-device-idle-active", "test-device-idle-warn", "test-device-idle-release"], 600)
+        )
+        set_idle_for(cur, "test-device-idle-warn", 500)
+        set_idle_for(cur, "test-device-idle-release", 700)
+        set_idle_for(cur, "test-device-idle-disabled", 700)
+    return db
+
+
+def set_idle_for(cur, device_id, seconds):
+    cur.execute(
+        "UPDATE reservations SET last_activity = CURRENT_TIMESTAMP - %s * interval '1 second' WHERE device_id = %s",
+        (seconds, device_id)
+    )
+
+
+def reserved(cur):
+    cur.execute("SELECT device_id FROM reservations WHERE client_id = 'test-client-idle' ORDER BY device_id")
+    return [row[0] for row in cur.fetchall()]
+
+
+class TestIdleReservations:
+    def test_warnings_are_sent_once(self, db):
+        with db.cursor() as cur:
+            cur.execute("SELECT * FROM get_idle_warnings(%s::int)", (120,))
+            rows = {row[0]: row for row in cur.fetchall()}
+
+            assert set(rows) == {"test-device-idle-warn", "test-device-idle-release"}
+            assert 90 <= rows["test-device-idle-warn"][2] <= 100
+            assert rows["test-device-idle-release"][2] == 0
+
+            cur.execute("SELECT * FROM get_idle_warnings(%s::int)", (120,))
+            assert not cur.fetchall()
+
+    def test_activity_resets_warning(self, db):
+        with db.cursor() as cur:
+            cur.execute("SELECT * FROM get_idle_warnings(%s::int)", (120,))
+            cur.execute("CALL report_device_activity(%s::varchar(255)[])", (["test-device-idle-warn"],))
+            set_idle_for(cur, "test-device-idle-warn", 500)
+
+            cur.execute("SELECT * FROM get_idle_warnings(%s::int)", (120,))
+            assert [row[0] for row in cur.fetchall()] == ["test-device-idle-warn"]
+
+    def test_only_idle_reservations_are_released(self, db):
+        with db.cursor() as cur:
+            cur.execute("SELECT * FROM handle_idle_reservations()")
+            assert cur.fetchall() == [("test-device-idle-release", "test-client-idle")]
+
+            assert reserved(cur) == ["test-device-idle-active", "test-device-idle-disabled", "test-device-idle-warn"]
+
+            cur.execute("SELECT device_status FROM device WHERE id = 'test-device-idle-release'")
+            assert cur.fetchone()[0] == "await_flash_default"
+
+    def test_make_reservations_sets_idle(self, db):
+        with db.cursor() as cur:
+            add_device(cur, "test-device-idle-make", "test-worker-idle")
+
+            cur.execute(
+                "SELECT * FROM make_specific_reservations(%s::varchar(255), %s::varchar(255)[], %s::varchar(255), %s::int, %s::int)",
+                ("test-client-idle", ["test-device-idle-make"], "pulsecount", 600, 300)
+            )
+
+            cur.execute("SELECT idle_seconds FROM reservations WHERE device_id = 'test-device-idle-make'")
+            assert cur.fetchone()[0] == 300
@@ -0,0 +1,79 @@
+"""Tests for reservation lease database functions.
+
+Requires the Docker PostgreSQL database to be running on port 5433.
+Run with: pytest tests/test_leases.py -v
+"""
+import pytest
+
+from test_clear_workers import call_add_worker, add_device
+
+
+def add_lease(cur, device_id, client_id, remaining, lease):
+    """Helper to insert a reservation with remaining seconds left on a lease of lease seconds."""
+    cur.execute(
+        "INSERT INTO reservations (device_id, client_id, until, lease_seconds) "
+        "VALUES (%s, %s, CURRENT_TIMESTAMP + %s * interval '1 second', %s)",
+        (device_id, client_id, remaining, lease)
+    )
+
+
+def remaining(cur, device_id):
+    cur.execute(
+        "SELECT EXTRACT(EPOCH FROM until - CURRENT_TIMESTAMP) FROM reservations WHERE device_id = %s",
+        (device_id,)
+    )
+    return float(cur.fetchone()[0])
+
+
+class TestLeases:
+    @pytest.fixture
+    def devices(self, db):
+        with db.cursor() as cur:
+            call_add_worker(cur, "test-worker-lease")
+            add_device(cur, "test-device-lease-fresh", "test-worker-lease", status="reserved")
+            add_device(cur, "test-device-lease-stale", "test-worker-lease", status="reserved")
+            add_device(cur, "test-device-lease-other", "test-worker-lease", status="reserved")
+
+            add_lease(cur, "test-device-lease-fresh", "test-client-lease", 550, 600)
+            add_lease(cur, "test-device-lease-stale", "test-client-lease", 100, 600)
+            add_lease(cur, "test-device-lease-other", "test-client-other", 100, 600)
+
+        return db
+
+    def test_make_reservations_uses_lease(self, db):
+        with db.cursor() as cur:
+            call_add_worker(cur, "test-worker-lease-make")
+            add_device(cur, "test-device-lease-make", "test-worker-lease-make")
+
+            cur.execute(
+                "SELECT * FROM make_specific_reservations(%s::varchar(255), %s::varchar(255)[], %s::varchar(255), %s::int)",
+                ("test-client-lease", ["test-device-lease-make"], "pulsecount", 600)
+            )
+
+            assert 590 < remaining(cur, "test-device-lease-make") <= 600
+
+    def test_renew_only_touches_half_expired_leases(self, devices):
+        with devices.cursor() as cur:
+            cur.execute("SELECT * FROM renew_leases(%s::varchar(255)[])", (["test-client-lease"],))
+            assert cur.fetchone()[0] == 1
+
+            assert remaining(cur, "test-device-lease-stale") > 590
+            assert remaining(cur, "test-device-lease-fresh") < 551
+            assert remaining(cur, "test-device-lease-other") < 101
+
+    def test_expire_shortens_client_leases(self, devices):
+        with devices.cursor() as cur:
+            cur.execute("SELECT * FROM expire_leases(%s::varchar(255), %s::int)", ("test-client-lease", 30))
+            assert cur.fetchone()[0] == 2
+
+            assert remaining(cur, "test-device-lease-fresh") <= 30
+            assert remaining(cur, "test-device-lease-stale") <= 30
+            assert remaining(cur, "test-device-lease-other") > 30
+
+    def test_ending_soon_excludes_connected_clients(self, devices):
+        with devices.cursor() as cur:
+            cur.execute(
+                "SELECT * FROM get_reservations_ending_soon(%s::int, %s::varchar(255)[])",
+                (200, ["test-client-lease"])
+            )
+            assert [row[0] for row in cur.fetchall()] == ["test-device-lease-other"]
@@ -0,0 +1,82 @@
+"""Tests for the event loop lag monitor and histogram metrics.
+
+Run with: pytest tests/test_loop_monitor.py -v
+"""
+import asyncio
+import logging
+import time
+
+from icefarm.utils.LoopMonitor import LoopMonitor, LOOP_LAG, LOOP_STALLS
+from icefarm.utils.Metrics import Registry
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def stall_count():
+    return sum(value for _, value in LOOP_STALLS.samples())
+
+
+class TestHistogram:
+    def test_buckets_are_cumulative(self):
+        histogram = Registry().histogram("latency", "", ["op"], buckets=(0.1, 1))
+        for value in [0.05, 0.1, 0.5, 5]:
+            histogram.labels("write").observe(value)
+
+        (labels, value), = histogram.samples()
+
+        assert labels == {"op": "write"}
+        assert value["count"] == 4
+        assert value["sum"] == 5.65
+        assert value["buckets"] == [[0.1, 2], [1, 3], ["+Inf", 4]]
+
+
+class TestLoopMonitor:
+    def run(self, blocking_call, seconds):
+        logger = logging.getLogger("test_loop_monitor")
+        handler = ListHandler()
+        logger.addHandler(handler)
+
+        async def main():
+            monitor = LoopMonitor(asyncio.get_running_loop(), logger, interval=0.05, threshold=0.2)
+            monitor.start()
+            await asyncio.sleep(0.2)
+            blocking_call()
+            await asyncio.sleep(0.2)
+            monitor.exit()
+            await asyncio.sleep(seconds)
+
+        try:
+            asyncio.run(main())
+        finally:
+            logger.removeHandler(handler)
+
+        return handler.messages
+
+    def test_blocking_call_is_logged_with_stack(self):
+        stalls = stall_count()
+
+        def blocking_serial_read():
+            time.sleep(0.6)
+
+        messages = self.run(blocking_serial_read, 0.1)
+
+        blocked = [message for message in messages if "loop blocked" in message]
+        assert len(blocked) == 1
+        assert "blocking_serial_read" in blocked[0]
+        assert any("unblocked" in message for message in messages)
+        assert stall_count() == stalls + 1
+
+    def test_lag_is_sampled(self):
+        before = sum(value["count"] for _, value in LOOP_LAG.samples())
+
+        messages = self.run(lambda: None, 0.1)
+
+        assert not messages
+        assert sum(value["count"] for _, value in LOOP_LAG.samples()) > before
@@ -0,0 +1,100 @@
+"""Tests for device mailboxes.
+
+Run with: pytest tests/test_mailbox.py -v
+"""
+import logging
+import threading
+import time
+
+from icefarm.worker.device.Mailbox import Mailbox, MailboxPool, MAILBOX_DROPPED
+
+logger = logging.getLogger("test_mailbox")
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+
+    return True
+
+
+class TestMailbox:
+    def test_messages_of_a_device_are_handled_in_order(self):
+        pool = MailboxPool(workers=4)
+        mailbox = Mailbox(pool, "A", logger)
+        handled = []
+        active = []
+
+        def message(i):
+            def handle():
+                active.append(i)
+                assert len(active) == 1
+                time.sleep(0.001)
+                handled.append(i)
+                active.remove(i)
+            return handle
+
+        for i in range(50):
+            assert mailbox.post(message(i))
+
+        assert wait_for(lambda: len(handled) == 50)
+        assert handled == list(range(50))
+
+    def test_devices_are_handled_concurrently(self):
+        pool = MailboxPool(workers=2)
+        release = threading.Event()
+        handled = []
+
+        blocked = Mailbox(pool, "A", logger)
+        other = Mailbox(pool, "B", logger)
+        blocked.post(release.wait)
+        blocked.post(lambda: handled.append("A"))
+        other.post(lambda: handled.append("B"))
+
+        assert wait_for(lambda: handled == ["B"])
+        release.set()
+        assert wait_for(lambda: handled == ["B", "A"])
+
+    def test_full_mailbox_refuses_messages(self):
+        pool = MailboxPool(workers=1)
+        release = threading.Event()
+        mailbox = Mailbox(pool, "full", logger, max_size=3)
+
+        mailbox.post(release.wait)
+        assert wait_for(lambda: len(mailbox) == 0)
+
+        assert all(mailbox.post(lambda: None) for _ in range(3))
+        assert not mailbox.post(lambda: None)
+        assert MAILBOX_DROPPED.samples() == [({"serial": "full"}, 1)]
+
+        release.set()
+        assert wait_for(lambda: len(mailbox) == 0)
+        mailbox.close()
+
+    def test_failed_messages_do_not_stop_the_mailbox(self):
+        pool = MailboxPool(workers=1)
+        mailbox = Mailbox(pool, "A", logger)
+        handled = []
+
+        mailbox.post(lambda: 1 / 0)
+        mailbox.post(lambda: handled.append(True))
+
+        assert wait_for(lambda: handled)
+
+    def test_closed_mailbox_drops_messages(self):
+        pool = MailboxPool(workers=1)
+        release = threading.Event()
+        mailbox = Mailbox(pool, "A", logger)
+        handled = []
+
+        mailbox.post(release.wait)
+        mailbox.post(lambda: handled.append(True))
+        mailbox.close()
+        release.set()
+
+        assert not mailbox.post(lambda: handled.append(True))
+        time.sleep(0.05)
+        assert not handled
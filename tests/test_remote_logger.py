@@ -0,0 +1,141 @@
+"""Tests for shipping worker logs to the control server.
+
+Run with: pytest tests/test_remote_logger.py -v
+"""
+import gzip
+import json
+import logging
+import time
+
+from icefarm.control.LogIngest import LogIngest, decompress_body
+from icefarm.utils import RemoteLogger
+from icefarm.worker.device.Device import DeviceLogger
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class FakeSession:
+    def __init__(self):
+        self.status_code = 200
+        self.batches = []
+
+    def post(self, url, data, headers, timeout):
+        if self.status_code == 200:
+            self.batches.append(json.loads(gzip.decompress(data)))
+
+        return FakeResponse(self.status_code)
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def make_logger(name, **kwargs):
+    base = logging.getLogger(name)
+    base.setLevel(logging.INFO)
+    base.propagate = False
+
+    # interval is long enough that batches are only sent by the tests
+    logger = RemoteLogger(base, "http://control", "worker", interval=3600, **kwargs)
+    logger._session = FakeSession()
+    return logger
+
+
+class TestRemoteLogger:
+    def test_records_are_structured(self):
+        logger = make_logger("test_remote_logger.structured")
+        DeviceLogger(logger, "ABC").info("flashed %s", "firmware.uf2")
+
+        assert logger._sendBatch()
+        record, = logger._session.batches[0]["records"]
+
+        assert record["msg"] == "[ABC] flashed firmware.uf2"
+        assert record["serial"] == "ABC"
+        assert record["level"] == logging.INFO
+        assert record["ts"] > 0
+
+    def test_disabled_levels_are_not_buffered(self):
+        logger = make_logger("test_remote_logger.levels")
+        logger.debug("bitstream uploaded")
+
+        assert not logger._backlog
+
+    def test_buffer_is_bounded(self):
+        logger = make_logger("test_remote_logger.bounded", max_records=10, batch_records=5)
+
+        # holding the condition keeps the sender thread from sending the full batch itself
+        with logger._backlog_cv:
+            for i in range(25):
+                logger.info(f"record {i}")
+
+            assert logger._sendBatch()
+
+        batch = logger._session.batches[0]
+
+        assert [record["msg"] for record in batch["records"]] == [f"record {i}" for i in range(15, 20)]
+        assert batch["dropped"] == 15
+
+    def test_failed_batches_are_kept(self):
+        logger = make_logger("test_remote_logger.failed", max_records=10, batch_records=10)
+        logger.interval = 0
+        logger._session.status_code = 503
+        with logger._backlog_cv:
+            for i in range(6):
+                logger.info(f"record {i}")
+
+            assert not logger._sendBatch()
+            for i in range(6, 12):
+                logger.info(f"record {i}")
+
+            logger._session.status_code = 200
+            assert logger._sendBatch()
+
+        batch = logger._session.batches[0]
+
+        assert [record["msg"] for record in batch["records"]] == [f"record {i}" for i in range(2, 12)]
+        assert batch["dropped"] == 2
+
+
+class TestLogIngest:
+    def test_decompress_body(self):
+        body = json.dumps({"records": []}).encode()
+
+        assert decompress_body(gzip.compress(body), "gzip") == body
+        assert decompress_body(body, None) == body
+        assert decompress_body(gzip.compress(body), "gzip", max_size=len(body) - 1) is None
+        assert decompress_body(b"not gzip", "gzip") is None
+        assert decompress_body(body, "br") is None
+
+    def test_records_keep_worker_timestamps(self):
+        base = logging.getLogger("test_remote_logger.ingest")
+        base.setLevel(logging.INFO)
+        base.propagate = False
+        handler = ListHandler()
+        base.addHandler(handler)
+
+        ingest = LogIngest(base)
+        ingest.submit("worker@127.0.0.1", [
+            {"ts": 1000.5, "level": logging.WARNING, "serial": "ABC", "msg": "device failed"},
+            {"ts": 1001, "level": logging.DEBUG, "serial": None, "msg": "not logged"},
+            [logging.INFO, "legacy record"]
+        ])
+
+        for _ in range(100):
+            if len(handler.records) == 2:
+                break
+            time.sleep(0.01)
+
+        first, second = handler.records
+
+        assert first.getMessage() == "[worker@127.0.0.1] device failed"
+        assert first.created == 1000.5
+        assert first.serial == "ABC"
+        assert second.getMessage() == "[worker@127.0.0.1] legacy record"
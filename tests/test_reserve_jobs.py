@@ -0,0 +1,54 @@
+"""Tests for the reserve job store of the worker.
+
+Run with: pytest tests/test_reserve_jobs.py -v
+"""
+from icefarm.worker.device.ReserveJobs import ReserveJobs, JOB_QUEUED, JOB_STARTING, JOB_INITIALIZED, JOB_FAILED, JOB_CANCELLED
+
+
+def test_job_lifecycle():
+    jobs = ReserveJobs()
+    job = jobs.create("a", "pulsecount")
+    assert job["status"] == JOB_QUEUED
+
+    assert jobs.update(job["job"], JOB_STARTING)
+    assert jobs.get(job["job"])["status"] == JOB_STARTING
+
+    jobs.finishDevice("a", JOB_INITIALIZED)
+    assert jobs.get(job["job"])["status"] == JOB_INITIALIZED
+
+    # finished jobs do not change
+    assert not jobs.update(job["job"], JOB_FAILED)
+    jobs.finishDevice("a", JOB_FAILED)
+    assert jobs.get(job["job"])["status"] == JOB_INITIALIZED
+
+
+def test_new_job_cancels_unfinished():
+    jobs = ReserveJobs()
+    first = jobs.create("a", "pulsecount")
+    other = jobs.create("b", "pulsecount")
+    second = jobs.create("a", "pulsecount")
+
+    assert jobs.get(first["job"])["status"] == JOB_CANCELLED
+    assert jobs.get(other["job"])["status"] == JOB_QUEUED
+    # a cancelled job is skipped once it reaches the front of the mailbox
+    assert not jobs.update(first["job"], JOB_STARTING)
+    assert jobs.update(second["job"], JOB_STARTING)
+
+
+def test_unknown_job():
+    jobs = ReserveJobs()
+    assert jobs.get("missing") is None
+    assert not jobs.update("missing", JOB_STARTING)
+    jobs.finishDevice("missing", JOB_CANCELLED)
+
+
+def test_finished_jobs_expire():
+    jobs = ReserveJobs(retention_seconds=0)
+    old = jobs.create("a", "pulsecount")
+    running = jobs.create("b", "pulsecount")
+    jobs.finishDevice("a", JOB_FAILED)
+
+    jobs.create("c", "pulsecount")
+
+    assert jobs.get(old["job"]) is None
+    assert jobs.get(running["job"])["status"] == JOB_QUEUED
@@ -0,0 +1,93 @@
+"""Tests for bounded session queues that spill to disk.
+
+Run with: pytest tests/test_session_queue.py -v
+"""
+import os
+
+from icefarm.utils.EventSender import SessionQueue, QUEUED_BYTES, SPILLED_BYTES
+from icefarm.utils.Metrics import METRICS
+
+
+def gauge(metric, client):
+    for labels, value in metric.samples():
+        if labels == {"client": client}:
+            return value
+
+    return None
+
+
+def drain(queue):
+    out = []
+    while queue:
+        out.extend(queue.take())
+    return out
+
+
+class TestSessionQueue:
+    def test_spills_past_budget_and_keeps_order(self, tmp_path):
+        queue = SessionQueue("test-spill", max_bytes=10, spill_dir=str(tmp_path))
+        messages = [f"msg{i}" for i in range(6)]
+
+        for message in messages:
+            assert queue.append(message)
+
+        assert queue.backpressured
+        assert queue.spill_count == 4
+        assert len(os.listdir(tmp_path)) == 1
+        assert gauge(QUEUED_BYTES, "test-spill") == 24
+        assert gauge(SPILLED_BYTES, "test-spill") == 16
+
+        assert drain(queue) == messages
+        assert not queue.backpressured
+        assert not os.listdir(tmp_path)
+        assert gauge(QUEUED_BYTES, "test-spill") == 0
+
+    def test_spills_binary_messages(self, tmp_path):
+        queue = SessionQueue("test-spill-binary", max_bytes=4, spill_dir=str(tmp_path))
+        messages = ["text", b"\x00\xffbin", "more"]
+
+        for message in messages:
+            assert queue.append(message)
+
+        assert drain(queue) == messages
+
+    def test_take_is_bounded(self, tmp_path):
+        queue = SessionQueue("test-take", max_bytes=10, spill_dir=str(tmp_path))
+
+        for i in range(6):
+            queue.append(f"msg{i}")
+
+        assert queue.take() == ["msg0", "msg1"]
+        assert queue.take() == ["msg2", "msg3"]
+        assert queue.take() == ["msg4", "msg5"]
+
+    def test_prepend_goes_before_spilled_messages(self, tmp_path):
+        queue = SessionQueue("test-prepend", max_bytes=4, spill_dir=str(tmp_path))
+        queue.append("msg0")
+        queue.append("msg1")
+
+        taken = queue.take()
+        queue.prepend(taken)
+
+        assert drain(queue) == ["msg0", "msg1"]
+
+    def test_drops_past_spill_limit(self, tmp_path):
+        queue = SessionQueue("test-drop", max_bytes=4, spill_dir=str(tmp_path), max_spill_bytes=4)
+
+        assert queue.append("msg0")
+        assert queue.append("msg1")
+        assert not queue.append("msg2")
+
+        assert drain(queue) == ["msg0", "msg1"]
+        assert METRICS.snapshot()["session_dropped_messages"]["samples"] == [{"labels": {"client": "test-drop"}, "value": 1}]
+
+    def test_clear_removes_spill(self, tmp_path):
+        queue = SessionQueue("test-clear", max_bytes=4, spill_dir=str(tmp_path))
+        queue.append("msg0")
+        queue.append("msg1")
+
+        queue.clear()
+
+        assert not queue
+        assert not os.listdir(tmp_path)
+        assert gauge(QUEUED_BYTES, "test-clear") is None
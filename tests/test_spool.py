@@ -0,0 +1,101 @@
+"""Tests for the worker spool and the restart_worker database function.
+
+The restart_worker tests require the Docker PostgreSQL database to be running on port 5433.
+Run with: pytest tests/test_spool.py -v
+"""
+import logging
+import pytest
+
+from icefarm.worker.Spool import Spool
+from test_clear_workers import call_add_worker, add_device, add_reservation
+
+
+@pytest.fixture
+def spool(tmp_path):
+    spool = Spool(str(tmp_path.joinpath("spool.sqlite")), logging.getLogger(__name__))
+    yield spool
+    spool.close()
+
+
+class TestSpool:
+    def test_work_survives_reopening(self, tmp_path, spool):
+        spool.recordReservation("serial", "pulsecount", {"flush_interval_seconds": 5})
+        ids = spool.addBitstreams("serial", [("/a", "a", "batch"), ("/b", "b", "batch")])
+        spool.completeBitstream(ids[0], "serial", "batch", "a", "123")
+        spool.close()
+
+        reopened = Spool(str(tmp_path.joinpath("spool.sqlite")), logging.getLogger(__name__))
+        assert reopened.getReservedSerials() == ["serial"]
+        assert reopened.getReservation("serial") == ("pulsecount", {"flush_interval_seconds": 5})
+        assert reopened.getBitstreams("serial") == [(ids[1], "/b", "b", "batch")]
+        assert [row[1:] for row in reopened.getResults("serial")] == [("batch", "a", "123")]
+        reopened.close()
+
+    def test_sent_results_are_removed(self, spool):
+        spool.recordReservation("serial", "pulsecount", {})
+        ids = spool.addBitstreams("serial", [("/a", "a", "batch"), ("/b", "b", "batch")])
+        first = spool.completeBitstream(ids[0], "serial", "batch", "a", [1, 2])
+        spool.completeBitstream(ids[1], "serial", "batch", "b", [3, 4])
+
+        spool.removeResults("serial", first)
+        assert [row[1:] for row in spool.getResults("serial")] == [("batch", "b", [3, 4])]
+
+    def test_new_reservation_drops_previous_work(self, spool):
+        spool.recordReservation("serial", "pulsecount", {})
+        spool.addBitstreams("serial", [("/a", "a", "batch")])
+        spool.recordReservation("serial", "varmax", {})
+
+        assert spool.getBitstreams("serial") == []
+        assert spool.getReservation("serial") == ("varmax", {})
+
+    def test_remove_device(self, spool):
+        spool.recordReservation("serial", "pulsecount", {})
+        spool.recordReservation("other", "pulsecount", {})
+        spool.removeDevice("serial")
+
+        assert spool.getReservedSerials() == ["other"]
+        assert spool.getReservation("serial") is None
+
+    def test_firmware_outlives_reservation(self, tmp_path, spool):
+        spool.recordReservation("serial", "pulsecount", {})
+        spool.recordFirmware("serial", "pulsecount")
+        spool.removeDevice("serial")
+        spool.close()
+
+        reopened = Spool(str(tmp_path.joinpath("spool.sqlite")), logging.getLogger(__name__))
+        assert reopened.getFirmware("serial") == "pulsecount"
+
+        reopened.recordFirmware("serial", None)
+        assert reopened.getFirmware("serial") is None
+        reopened.close()
+
+
+class TestRestartWorker:
+    def restart(self, cur, kept):
+        cur.execute(
+            "SELECT * FROM restart_worker(%s::varchar(255), %s::varchar(255), %s::int, %s::varchar(255), %s::varchar(255)[], %s::varchar(255)[])",
+            ("test-worker-restart", "localhost", 8081, "0.0.0", ["pulsecount"], kept)
+        )
+        return sorted(row[0] for row in cur.fetchall())
+
+    def test_keeps_reserved_devices(self, db):
+        with db.cursor() as cur:
+            call_add_worker(cur, "test-worker-restart")
+            add_device(cur, "test-device-restart-kept", "test-worker-restart", status="reserved")
+            add_device(cur, "test-device-restart-ended", "test-worker-restart", status="available")
+            add_device(cur, "test-device-restart-other", "test-worker-restart", status="reserved")
+            add_reservation(cur, "test-device-restart-kept", "test-client-restart")
+            add_reservation(cur, "test-device-restart-other", "test-client-restart")
+
+            kept = self.restart(cur, ["test-device-restart-kept", "test-device-restart-ended"])
+            assert kept == ["test-device-restart-kept"]
+
+            cur.execute("SELECT device_id FROM reservations WHERE client_id = 'test-client-restart'")
+            assert [row[0] for row in cur.fetchall()] == ["test-device-restart-kept"]
+
+    def test_adds_unknown_worker(self, db):
+        with db.cursor() as cur:
+            assert self.restart(cur, ["test-device-restart-kept"]) == []
+
+            cur.execute("SELECT shutting_down FROM worker WHERE id = 'test-worker-restart'")
+            assert cur.fetchone() == (False,)
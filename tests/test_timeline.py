@@ -0,0 +1,52 @@
+"""Tests for the device lifecycle timeline.
+
+Run with: pytest tests/test_timeline.py -v
+"""
+from icefarm.utils.dev import flash_stage, flash_stage_listener
+from icefarm.worker.device.Timeline import Timeline
+
+
+def test_switches_and_stages():
+    timeline = Timeline()
+    timeline.mark("before any state")
+    timeline.enter("FlashState")
+    timeline.stage("partition seen", 1.5)
+    timeline.enter("ReadyState")
+
+    entries = timeline.get()
+    assert [(entry["state"], entry["event"]) for entry in entries] == [
+        (None, "before any state"),
+        ("FlashState", "switch"),
+        ("FlashState", "partition seen"),
+        ("ReadyState", "switch"),
+    ]
+
+    assert entries[1]["seconds"] is None
+    assert entries[2]["seconds"] == 1.5
+    # time spent in FlashState
+    assert entries[3]["seconds"] >= 0
+    assert entries[0]["time"] <= entries[3]["time"]
+
+
+def test_ring_buffer():
+    timeline = Timeline(size=3)
+    for i in range(5):
+        timeline.mark(str(i))
+
+    assert [entry["event"] for entry in timeline.get()] == ["2", "3", "4"]
+
+
+def test_flash_stage_listener():
+    timeline = Timeline()
+
+    with flash_stage_listener(timeline.mark):
+        with flash_stage("direct", "write"):
+            pass
+
+    # stages outside of the listener are not recorded
+    with flash_stage("direct", "read"):
+        pass
+
+    entries = timeline.get()
+    assert [entry["event"] for entry in entries] == ["write"]
+    assert entries[0]["seconds"] >= 0
@@ -0,0 +1,50 @@
+"""Tests for probing firmware kept from the last reservation.
+
+Run with: pytest tests/test_upload_state.py -v
+"""
+import logging
+
+from icefarm.worker.device.state.core.UploadState import Reader
+
+logger = logging.getLogger("test_upload_state")
+
+
+class FakePort:
+    """Serial port that outputs lines once and then nothing."""
+    def __init__(self, lines):
+        self.output = b"".join(line.encode() + b"\r\n" for line in lines)
+        self.is_open = True
+
+    @property
+    def in_waiting(self):
+        return len(self.output)
+
+    def read(self, size):
+        data, self.output = self.output[:size], self.output[size:]
+        return data
+
+
+def reader(lines):
+    return Reader(FakePort(lines), lambda line : None, logger, ready=False)
+
+
+def test_prompt_after_reconnect():
+    probed = reader(["USB Reconnected :)", "Waiting for bitstream transfer"])
+    assert probed.waitForPrompt(1)
+    # the prompt is left for the first bitstream
+    assert probed.ready
+    probed.exit()
+
+
+def test_silent_firmware():
+    probed = reader([])
+    assert not probed.waitForPrompt(0.2)
+    assert not probed.failed
+    probed.exit()
+
+
+def test_watchdog_timeout_fails_probe():
+    probed = reader(["Watchdog timeout, 10 bytes received of 104000", "Waiting for bitstream transfer"])
+    assert not probed.waitForPrompt(1)
+    assert probed.failed
+    probed.exit()
@@ -0,0 +1,90 @@
+"""Tests for the warm pool of devices flashed ahead of reservations.
+
+The database tests require the Docker PostgreSQL database to be running on port 5433.
+Run with: pytest tests/test_warm_pool.py -v
+"""
+import time
+
+import pytest
+
+from icefarm.control.WarmPool import DemandTracker, split_targets
+from test_clear_workers import call_add_worker, add_device
+
+
+class TestDemandTracker:
+    def test_accumulates(self):
+        demand = DemandTracker(half_life_seconds=3600)
+        demand.record("pulsecount", 2)
+        demand.record("pulsecount", 3)
+        demand.record("variance", 1)
+
+        assert demand.get() == pytest.approx({"pulsecount": 5, "variance": 1}, rel=1e-3)
+
+    def test_decays(self):
+        demand = DemandTracker(half_life_seconds=0.05)
+        demand.record("pulsecount", 4)
+        time.sleep(0.05)
+
+        assert 1 < demand.get()["pulsecount"] < 2.5
+
+    def test_forgets_old_demand(self):
+        demand = DemandTracker(half_life_seconds=0.01)
+        demand.record("pulsecount", 1)
+        time.sleep(0.1)
+
+        assert demand.get() == {}
+
+
+class TestSplitTargets:
+    def test_proportional(self):
+        targets = split_targets({"pulsecount": 3, "variance": 1}, ["pulsecount", "variance"], 8)
+        assert targets == {"pulsecount": 6, "variance": 2}
+
+    def test_never_exceeds_budget(self):
+        targets = split_targets({"a": 1, "b": 1, "c": 1}, ["a", "b", "c"], 2)
+        assert sum(targets.values()) <= 2
+
+    def test_unsupported_kinds_ignored(self):
+        targets = split_targets({"pulsecount": 1, "variance": 10}, ["pulsecount"], 4)
+        assert targets == {"pulsecount": 4}
+
+    def test_no_demand(self):
+        assert split_targets({}, ["pulsecount", "variance"], 4) == {"pulsecount": 0, "variance": 0}
+
+
+def start_warming(cur, serial):
+    cur.execute("SELECT start_device_warming(%s::varchar(255))", (serial,))
+    return cur.fetchone()[0]
+
+
+class TestWarmingDatabase:
+    def test_start_warming_available(self, db):
+        with db.cursor() as cur:
+            call_add_worker(cur, "test-worker-warm")
+            add_device(cur, "test-device-warm-1", "test-worker-warm")
+
+            assert start_warming(cur, "test-device-warm-1")
+
+            cur.execute("SELECT device_status FROM device WHERE id = 'test-device-warm-1'")
+            assert cur.fetchone() == ("warming",)
+
+    def test_start_warming_reserved(self, db):
+        with db.cursor() as cur:
+            call_add_worker(cur, "test-worker-warm")
+            add_device(cur, "test-device-warm-1", "test-worker-warm", status="reserved")
+
+            assert not start_warming(cur, "test-device-warm-1")
+
+            cur.execute("SELECT device_status FROM device WHERE id = 'test-device-warm-1'")
+            assert cur.fetchone() == ("reserved",)
+
+    def test_idle_devices(self, db):
+        with db.cursor() as cur:
+            call_add_worker(cur, "test-worker-warm")
+            call_add_worker(cur, "test-worker-warm-empty")
+            add_device(cur, "test-device-warm-1", "test-worker-warm")
+            add_device(cur, "test-device-warm-2", "test-worker-warm", status="warming")
+            add_device(cur, "test-device-warm-3", "test-worker-warm", status="reserved")
+
+            cur.execute("SELECT worker_id, idle FROM get_idle_devices() WHERE worker_id LIKE 'test-worker-warm%' ORDER BY worker_id")
+            assert cur.fetchall() == [("test-worker-warm", 2), ("test-worker-warm-empty", 0)]
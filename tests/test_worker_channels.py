@@ -0,0 +1,39 @@
+"""Tests for registering worker command channels on the control server.
+
+Run with: pytest tests/test_worker_channels.py -v
+"""
+import logging
+
+from icefarm.control.WorkerChannels import WorkerChannels
+from icefarm.utils.web import get_remote_addr
+
+
+def channels():
+    return WorkerChannels(None, logging.getLogger(__name__))
+
+
+class TestAddWorker:
+    def test_live_channel_is_kept(self):
+        workers = channels()
+        assert workers.addWorker("sock-1", "worker", "http://10.0.0.1:8081")
+        assert not workers.addWorker("sock-2", "worker", "http://10.0.0.1:8081")
+
+        assert workers.sock_ids["http://10.0.0.1:8081"] == "sock-1"
+        assert "sock-2" not in workers.workers
+
+    def test_reconnect_after_disconnect(self):
+        workers = channels()
+        workers.addWorker("sock-1", "worker", "http://10.0.0.1:8081")
+        assert workers.removeWorker("sock-1")
+
+        assert workers.addWorker("sock-2", "worker", "http://10.0.0.1:8081")
+        assert workers.getConnectedWorkers() == {"worker"}
+
+
+class TestRemoteAddr:
+    def test_prefers_asgi_client(self):
+        environ = {"REMOTE_ADDR": "127.0.0.1", "asgi.scope": {"client": ("10.0.0.1", 40000)}}
+        assert get_remote_addr(environ) == "10.0.0.1"
+
+    def test_falls_back_to_remote_addr(self):
+        assert get_remote_addr({"REMOTE_ADDR": "10.0.0.2"}) == "10.0.0.2"
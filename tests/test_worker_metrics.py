@@ -0,0 +1,40 @@
+"""Tests for metrics maintained by the worker.
+
+Run with: pytest tests/test_worker_metrics.py -v
+"""
+import logging
+
+from icefarm.utils.Metrics import METRICS
+from icefarm.worker.device.state.core.UploadState import Reader
+
+logger = logging.getLogger("test_worker_metrics")
+
+
+class FakePort:
+    """Serial port that outputs lines once and then nothing."""
+    def __init__(self, lines):
+        self.output = b"".join(line.encode() + b"\r\n" for line in lines)
+        self.is_open = True
+
+    @property
+    def in_waiting(self):
+        return len(self.output)
+
+    def read(self, size):
+        data, self.output = self.output[:size], self.output[size:]
+        return data
+
+
+def parse_count():
+    samples = METRICS.snapshot()["worker_evaluation_seconds"]["samples"]
+    return sum(sample["value"]["count"] for sample in samples if sample["labels"] == {"step": "parse"})
+
+
+def test_reader_records_parse_time():
+    before = parse_count()
+
+    reader = Reader(FakePort(["pulses: 42", "Waiting for bitstream transfer"]), lambda line : int(line.split(": ")[1]) if line.startswith("pulses") else None, logger)
+    assert reader.waitUntilPulse() == 42
+    reader.exit()
+
+    assert parse_count() == before + 2